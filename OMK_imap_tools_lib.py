@@ -1,13 +1,25 @@
+import asyncio
+import collections
+import contextlib
 import getpass
+import heapq
 import imaplib
+import json
+import logging
 import os
+import queue
+import random
 import re
+import select
+import sqlite3
+import ssl
 import sys
-import email.message
+import threading
+import time
+import email.utils
 import datetime
 import keyring
 
-from email.parser import HeaderParser
 # See http://pymotw.com/2/imaplib/xb
 __author__ = 'Olaf Kolkman <olaf@NLnetLabs.nl> based on http://pymotw.com/2/imaplib/xb (link broken)'
 __license__ = 'PSF License'
@@ -16,29 +28,44 @@ __license__ = 'PSF License'
 
 
 
-def open_connection_to_IMAPServer(hostname,username):
-    """Opens SSL Connection to an IMAP Server and returns a imaplib.IMAP4_SSL object
+def get_password(hostname,username):
+    """Returns the password of username at hostname from the keyring
 
-    hostename: hostname to connect to
-    username: username
-    password: password
+    The password is asked for, and stored in the keyring, when it is not there.
     """
-
     password=keyring.get_password('archive_mail('+hostname+')',username)
 
     if not password:
         print (f"Enter password for {username}@{hostname}")
         password = getpass.getpass()
         keyring.set_password('archive_mail('+hostname+')',username,password)
+    return password
+
+
+def open_connection_to_IMAPServer(hostname,username,password=None,port=993,use_ssl=True):
+    """Opens SSL Connection to an IMAP Server and returns a imaplib.IMAP4_SSL object
+
+    hostename: hostname to connect to
+    username: username
+    password: password, looked up with get_password() when None
+    port: port to connect to
+    use_ssl: when False a plain imaplib.IMAP4 connection is made (e.g. to a local test server)
+    """
+
+    if password is None:
+        password=get_password(hostname,username)
     try:
-        connection = imaplib.IMAP4_SSL(hostname,'993')
+        if use_ssl:
+            connection = imaplib.IMAP4_SSL(hostname,port)
+        else:
+            connection = imaplib.IMAP4(hostname,port)
         connection.login(username, password)
     except imaplib.IMAP4.error as e:
         myre=re.compile('^\s*\[AUTHENTICATIONFAILED\].*')
         if (myre.match(e.message)):
             print (f"Authentication denied for {username}")
             keyring.delete_password('archive_mail('+hostname+')',username)
-            connection=open_connection_to_IMAPServer(hostname,username) #DEEP Recursion
+            connection=open_connection_to_IMAPServer(hostname,username,None,port,use_ssl) #DEEP Recursion
         else:
             print (f"Could not connect to IMAP server: {e.message}")
             exit(0)
@@ -52,17 +79,1808 @@ def parse_list_response(line):
     return (flags, delimiter, mailbox_name)
 
 
+def hierarchy_delimiter(connection):
+    """Returns the hierarchy delimiter of the server (LIST "" ""), or None if it has none"""
+    typ, data = connection.list('""', '""')
+    if typ != 'OK':
+        raise Exception("Failed to execute list command to IMAP server %s" % connection.host)
+    for line in data:
+        if line:
+            m=re.match(r'\(.*?\) (?:"((?:[^"\\]|\\.)*)"|NIL)', line.decode('utf-8'))
+            if m:
+                return m.group(1)
+    return None
+
+
+class MailboxSelection():
+    """MailboxSelection: The mailboxes a run is about
+
+    A mailbox is selected when it is one of the source mailboxes or below
+    one, unless it is one of the excluded mailboxes or below one. Names
+    may contain the IMAP LIST wildcards: * matches anything, % anything
+    but the hierarchy delimiter. The patterns are compiled once.
+
+    sources: list of source mailbox names
+    exclude: list of mailbox names that are never selected
+    delimiter: hierarchy delimiter of the server
+    """
+
+    def __init__(self, sources, exclude=(), delimiter='/'):
+        """Initiallize
+
+        sources: list of source mailbox names
+        exclude: list of mailbox names that are never selected
+        delimiter: hierarchy delimiter of the server
+        """
+        self.sources=list(sources)
+        self.exclude=list(exclude)
+        self.delimiter=delimiter or ''
+        self.include_pattern=self._compile(self.sources)
+        self.exclude_pattern=self._compile(self.exclude)
+
+    def _compile(self, names):
+        # One regular expression for names and everything below them
+        if not names:
+            return None
+        below='(?:%s.*)?' % re.escape(self.delimiter) if self.delimiter else ''
+        return re.compile('|'.join('(?:%s%s)' % (self._translate(name), below) for name in names), re.DOTALL)
+
+    def _translate(self, name):
+        other='[^%s]*' % re.escape(self.delimiter) if self.delimiter else '.*'
+        return ''.join('.*' if c == '*' else other if c == '%' else re.escape(c) for c in name)
+
+    def patterns(self):
+        """Returns the (quoted) LIST patterns with which the server selects the mailboxes"""
+        patterns=[]
+        for source in self.sources:
+            patterns.append(imap_quote(source))
+            if self.delimiter:
+                patterns.append(imap_quote(source + self.delimiter + '*'))
+        return patterns
+
+    def __contains__(self, name):
+        if not self.include_pattern or not self.include_pattern.fullmatch(name):
+            return False
+        return not (self.exclude_pattern and self.exclude_pattern.fullmatch(name))
+
+
+_status_response_pattern = re.compile(r'\s*(?P<name>"(?:[^"\\]|\\.)*"|\S+)\s+\((?P<items>[^)]*)\)')
+
+def parse_status_response(data):
+    """Returns a dict with mailbox: {item: number} for the untagged STATUS responses in data
+
+    data: list of STATUS responses as returned by imaplib (bytes, or a
+          tuple followed by bytes for a mailbox name sent as a literal)
+    """
+    status={}
+    name=None
+    for item in data:
+        if isinstance(item, tuple):
+            name=item[1].decode('utf-8')
+            continue
+        if not item:
+            continue
+        line=item.decode('utf-8')
+        if name is not None:
+            line='"" ' + line
+        m=_status_response_pattern.match(line)
+        if not m:
+            name=None
+            continue
+        if name is None:
+            name=m.group('name').strip('"')
+        values=m.group('items').split()
+        status[name]=dict((values[i].upper(), int(values[i+1])) for i in range(0, len(values)-1, 2))
+        name=None
+    return status
+
+
+def mailbox_status(connection, mailboxes, items=('MESSAGES', 'UIDNEXT', 'UIDVALIDITY'), pipeline_depth=4):
+    """Returns the STATUS of mailboxes, with the STATUS commands pipelined
+
+    Returns a dict as parse_status_response() does.
+
+    connection: imaplib.IMAP4 object
+    mailboxes: list of mailbox names
+    items: STATUS data items to ask for
+    pipeline_depth: maximum number of outstanding STATUS commands
+    """
+    status={}
+    commands=((mailbox, 'STATUS', (imap_quote(mailbox), '(%s)' % ' '.join(items)))
+              for mailbox in mailboxes)
+    for mailbox, typ, data in ImapPipeline(connection, pipeline_depth).run(commands):
+        if typ != 'OK':
+            raise Exception("Could not read the status of %s: %s" % (mailbox, data))
+        status.update(parse_status_response(data))
+    return status
+
+
+def _uid_ranges(uids):
+    # Returns the sorted list of [lo, hi] runs of consecutive UIDs
+    numbers=sorted(set(int(u) for u in uids))
+    ranges=[]
+    for n in numbers:
+        if ranges and ranges[-1][1] == n-1:
+            ranges[-1][1]=n
+        else:
+            ranges.append([n,n])
+    return ranges
+
+
+def uid_sets(uids, max_length=8000, max_count=None):
+    """Generator that splits a list of UIDs into IMAP message set strings
+
+    The UIDs are sorted and runs of consecutive UIDs are collapsed into
+    ranges (e.g. "100:250,300,402:900"). A new set is started when the
+    next range would make the set longer than max_length characters or
+    would make it hold more than max_count UIDs, so that a command stays
+    within the line length the server accepts however many UIDs it holds.
+
+    uids: iterable of UIDs (int, str or bytes)
+    max_length: maximum length of a set string
+    max_count: maximum number of UIDs in a set, None for no limit
+    """
+    pieces=[]
+    length=0
+    count=0
+    for lo, hi in _uid_ranges(uids):
+        while lo <= hi:
+            if max_count is not None and count >= max_count:
+                top=lo-1
+            elif max_count is not None:
+                top=min(hi, lo+max_count-count-1)
+            else:
+                top=hi
+            piece=str(lo) if lo == top else "%d:%d" % (lo,top)
+            if pieces and (top < lo or length+1+len(piece) > max_length):
+                yield ",".join(pieces)
+                pieces=[]
+                length=0
+                count=0
+                continue
+            pieces.append(piece)
+            length+=len(piece)+(len(pieces) > 1)
+            count+=top-lo+1
+            lo=top+1
+    if pieces:
+        yield ",".join(pieces)
+
+
+def imap_quote(s):
+    """Returns s as an IMAP quoted string"""
+    return '"' + s.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+_imap_months = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+                'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+def imap_date(date):
+    """Returns a date as used in IMAP SEARCH keys (e.g. 1-Feb-2020), independent of the locale"""
+    return "%d-%s-%04d" % (date.day, _imap_months[date.month-1], date.year)
+
+
+def expand_uid_set(uidset):
+    """Returns the list of UIDs (as strings) in an IMAP message set string without "*"
+
+    uidset: e.g. "1:5,7" (str or bytes)
+    """
+    if isinstance(uidset, bytes):
+        uidset=uidset.decode('ascii')
+    uids=[]
+    for part in uidset.split(','):
+        if ':' in part:
+            lo, hi = sorted(int(n) for n in part.split(':'))
+            uids.extend(str(n) for n in range(lo, hi+1))
+        elif part:
+            uids.append(str(int(part)))
+    return uids
+
+
+_fetch_uid_pattern = re.compile(rb'UID (\d+)')
+
+def parse_fetch_headers(data):
+    """Splits a multi-message FETCH response into (uid, header) pairs
+
+    data: the data list as returned by imaplib for a UID FETCH of a
+    BODY[HEADER]-like item. Every message comes as a (prefix, literal)
+    tuple followed by the bytes that close the message's response; the
+    UID can be either in the prefix or in that trailer.
+    Untagged FETCH responses without a literal (flag updates) are skipped.
+    """
+    literal=None
+    for item in data:
+        if isinstance(item, tuple):
+            m=_fetch_uid_pattern.search(item[0])
+            if m:
+                yield (m.group(1).decode('ascii'), item[1])
+                literal=None
+            else:
+                literal=item[1]
+        elif literal is not None and item:
+            m=_fetch_uid_pattern.search(item)
+            if m:
+                yield (m.group(1).decode('ascii'), literal)
+            literal=None
+
+
+# Header fields that are repeated by every hop or signer. A message
+# carries most of its header in these, so when one of them is needed the
+# complete header is fetched.
+trace_headers = set([
+    'received',
+    'x-received',
+    'received-spf',
+    'dkim-signature',
+    'x-google-dkim-signature',
+    'domainkey-signature',
+    'arc-seal',
+    'arc-message-signature',
+    'arc-authentication-results',
+    'authentication-results',
+    ])
+
+
+# Characters that may appear in an IMAP atom (RFC 3501 ATOM-CHAR)
+_atom_pattern = re.compile(r'[!#$&\'+-9;-Z^-z|}~\[]+')
+
+
+def header_fetch_item(fields=None):
+    """Returns the FETCH data item that retrieves the header fields of messages
+
+    BODY.PEEK[HEADER.FIELDS (...)] with the fields, or the complete header
+    with BODY.PEEK[HEADER] when all fields, a trace header (see
+    trace_headers) or a field name that cannot be sent as an atom is needed.
+
+    fields: set of lowercased header names, None for all
+    """
+    if (fields is None or not fields or fields & trace_headers
+            or not all(_atom_pattern.fullmatch(f) for f in fields)):
+        return '(BODY.PEEK[HEADER])'
+    return '(BODY.PEEK[HEADER.FIELDS (%s)])' % ' '.join(sorted(f.upper() for f in fields))
+
+
+# Length of the tag, command name and separators of a UID command line
+_command_overhead = 32
+
+
+def fetch_message_headers(connection, uids, batch_size=500, pipeline_depth=4, fields=None, max_length=8000):
+    """Generator that fetches the headers of messages and yields MessageContainer objects
+
+    The headers are requested for up to batch_size UIDs per UID FETCH
+    command instead of one command per message, with up to pipeline_depth
+    of those commands in flight at the same time. The UIDs are sent as
+    ranges (see uid_sets) and no command is longer than max_length.
+
+    connection: imaplib.IMAP4 object with the mailbox selected
+    uids: list of UIDs to fetch
+    batch_size: maximum number of messages per FETCH command
+    pipeline_depth: maximum number of outstanding FETCH commands
+    fields: set of lowercased header names kept in the MessageContainers,
+            None to keep all. Only these fields are requested from the
+            server (see header_fetch_item).
+    max_length: maximum length of a command line
+    """
+    commands=_header_fetch_commands(uids, batch_size, fields, max_length)
+    for context, typ, msg_data in ImapPipeline(connection, pipeline_depth).run(commands):
+        yield from _fetched_headers(typ, msg_data, fields)
+
+
+def _header_fetch_commands(uids, batch_size, fields, max_length):
+    # Returns the UID FETCH commands of fetch_message_headers, for a pipeline
+    item=header_fetch_item(fields)
+    return ((None, 'FETCH', (uidset, item))
+            for uidset in uid_sets(uids, max_length-len(item)-_command_overhead, batch_size))
+
+
+def _fetched_headers(typ, msg_data, fields):
+    # Generator yielding the MessageContainers of a response to one of
+    # the commands of _header_fetch_commands
+    if typ != 'OK':
+        raise Exception("Failed to fetch headers: %s" % msg_data)
+    for uid, hdr in parse_fetch_headers(msg_data):
+        yield MessageContainer(uid, hdr, wanted=fields)
+
+
+
+
+def enable_condstore(connection):
+    """Enables QRESYNC, or else CONDSTORE, if the server advertises it
+
+    Returns 'QRESYNC', 'CONDSTORE' or None if neither could be enabled.
+    Must be called before a mailbox is selected.
+    """
+    if 'ENABLE' not in connection.capabilities:
+        return None
+    for extension in ('QRESYNC', 'CONDSTORE'):
+        if extension in connection.capabilities:
+            typ, data = connection.enable(extension)
+            if typ == 'OK':
+                return extension
+    return None
+
+
+# imaplib (before Python 3.14) does not know these commands
+imaplib.Commands.setdefault('IDLE', ('AUTH', 'SELECTED'))
+imaplib.Commands.setdefault('NOTIFY', ('AUTH', 'SELECTED'))
+
+
+def idle(connection, timeout):
+    """Waits with IDLE (RFC 2177) until the server reports a change, at most timeout seconds
+
+    connection: imaplib.IMAP4 object
+    timeout: maximum number of seconds to wait. Servers may drop a
+             connection that is idle for 30 minutes, stay below that.
+    Returns the list of the names of the untagged responses that arrived
+    (e.g. EXISTS, EXPUNGE, or STATUS for mailboxes watched with NOTIFY),
+    an empty list when nothing happened. The responses themselves are
+    left in connection.untagged_responses. EXISTS and STATUS responses
+    that are there already count as arrived, so that no new message
+    waits for the timeout: the caller takes them out (with response())
+    when it has seen them.
+    """
+    def counts():
+        return dict((name, len(data)) for name, data in connection.untagged_responses.items())
+
+    def changes():
+        # Untagged OK responses are keep-alives
+        return [name for name, n in counts().items() if n > before.get(name, 0) and name != 'OK']
+
+    def buffered():
+        # Responses that were read from the socket together with an
+        # earlier one wait in connection.file, select() does not see them
+        if isinstance(sock, ssl.SSLSocket) and sock.pending():
+            return True
+        blocking=sock.gettimeout()
+        sock.settimeout(0)
+        try:
+            return bool(connection.file.peek(1))
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return False
+        finally:
+            sock.settimeout(blocking)
+
+    sock=connection.sock
+    before=dict((name, n) for name, n in counts().items() if name not in ('EXISTS', 'STATUS'))
+    while buffered() and not changes():
+        connection._get_response()
+    if changes():
+        return changes()
+
+    tag=connection._command('IDLE')
+    # Wait for the continuation, unless IDLE is refused
+    while connection._get_response() is not None:
+        if connection.tagged_commands.get(tag):
+            typ, dat = connection._command_complete('IDLE', tag)
+            raise Exception("IDLE refused by %s: %s" % (connection.host, dat))
+
+    # The socket itself is waited for: a timeout while reading would
+    # make the file object of the connection unusable.
+    deadline=time.monotonic()+timeout
+    try:
+        while not changes():
+            remaining=deadline-time.monotonic()
+            if remaining <= 0:
+                break
+            if not buffered():
+                if not select.select([sock], [], [], remaining)[0]:
+                    break
+            connection._get_response()
+    finally:
+        connection.send(b'DONE\r\n')
+    connection._command_complete('IDLE', tag)
+    return changes()
+
+
+def response_number(connection, code):
+    """Returns the number in the last untagged response code (e.g. UIDNEXT) or None"""
+    typ, data = connection.response(code)
+    if data and data[-1]:
+        try:
+            return int(data[-1])
+        except ValueError:
+            pass
+    return None
+
+
+def fetch_changes_since(connection, modseq):
+    """Asks a QRESYNC server which messages changed or vanished since modseq
+
+    A single UID FETCH 1:* (UID) (CHANGEDSINCE modseq VANISHED) is used.
+    Returns (changed, vanished): lists of UIDs (as strings) of messages whose
+    metadata changed or that were added, and of messages that were expunged.
+    """
+    typ, data = connection.uid('fetch', '1:*', '(UID)', '(CHANGEDSINCE %d VANISHED)' % modseq)
+    if typ != 'OK':
+        raise Exception("Failed to fetch changes since modseq %d: %s" % (modseq, data))
+    return _parse_changes(data, connection.response('VANISHED')[1])
+
+
+def _parse_changes(data, vanished_data):
+    # Returns the (changed, vanished) UIDs of the FETCH and VANISHED
+    # responses to UID FETCH 1:* (UID) (CHANGEDSINCE modseq VANISHED)
+    changed=[]
+    for item in data:
+        if isinstance(item, tuple):
+            item=item[0]
+        if item:
+            m=_fetch_uid_pattern.search(item)
+            if m:
+                changed.append(m.group(1).decode('ascii'))
+    vanished=[]
+    for item in vanished_data:
+        if item:
+            vanished.extend(expand_uid_set(item.replace(b'(EARLIER)', b'').strip()))
+    return (changed, vanished)
+
+
+
+
+class ImapPipeline():
+    """ImapPipeline: Keeps several tagged UID commands in flight on one connection
+
+    imaplib waits for the tagged response of every command before it sends
+    the next one. The pipeline sends up to depth commands before it waits
+    for the oldest one to complete, so that on high latency links the
+    throughput is limited by bandwidth rather than by the round-trip time.
+
+    Responses are matched back to their commands by tag. The untagged
+    responses of a command are collected when its tagged response has
+    been read; the server answers commands in the order they were sent.
+
+    Besides UID commands the commands in plain_commands (e.g. STATUS,
+    LIST) can be pipelined, they are sent as they are.
+
+    connection: imaplib.IMAP4 object
+    depth: maximum number of outstanding commands
+    """
+    plain_commands=('STATUS', 'CREATE', 'LIST')
+
+    def __init__(self, connection, depth=4):
+        """Initiallize
+
+        connection: imaplib.IMAP4 object
+        depth: maximum number of outstanding commands (at least 1)
+        """
+        self.connection=connection
+        self.depth=max(1, depth)
+        self.pending=collections.deque()
+
+    def _send(self, command, args):
+        command=command.upper()
+        if command in self.plain_commands:
+            return self.connection._command(command, *args)
+        if command not in imaplib.Commands:
+            raise self.connection.error("Unknown IMAP4 UID command: %s" % command)
+        return self.connection._command('UID', command, *args)
+
+    def _complete(self):
+        context, command, tag = self.pending.popleft()
+        typ, dat = self.connection._command_complete(command if command in self.plain_commands else 'UID', tag)
+        # Only FETCH claims the untagged FETCH responses: other commands
+        # may complete while FETCH commands of an outer pipeline are still
+        # in flight (a STORE is sent with .SILENT).
+        typ, dat = self.connection._untagged_response(typ, dat, command)
+        return (context, typ, dat)
+
+    def run(self, commands):
+        """Generator that sends UID commands and yields their responses
+
+        commands: iterable of (context, command, args) tuples, where command
+        is the UID command (e.g. 'FETCH', 'COPY', 'STORE') or one of
+        plain_commands and args is a tuple with its arguments. context is
+        passed back with the response.
+
+        Yields (context, typ, data) tuples in the order in which the
+        commands were given, as imaplib.IMAP4.uid() would have returned them.
+        """
+        try:
+            for context, command, args in commands:
+                if len(self.pending) >= self.depth:
+                    yield self._complete()
+                self.pending.append((context, command.upper(), self._send(command, args)))
+            while self.pending:
+                yield self._complete()
+        finally:
+            # Consumer stopped early: read the outstanding responses so
+            # that they do not end up in the results of later commands.
+            while self.pending:
+                self._complete()
+
+
+
+
+
+
+
+class ConnectionPool():
+    """ConnectionPool: Logged in connections to an IMAP server, for use by several threads
+
+    A thread takes a connection with get() and hands it back with put().
+    Connections are opened when they are first needed, up to size of them.
+    The password is looked up once (see get_password) for all connections.
+
+    hostname: hostname to connect to
+    username: username
+    size: maximum number of connections
+    setup: function called with every new connection (e.g. to ENABLE extensions)
+    port, use_ssl: see open_connection_to_IMAPServer
+    """
+
+    def __init__(self, hostname, username, size=1, setup=None, port=993, use_ssl=True):
+        """Initiallize
+
+        hostname: hostname to connect to
+        username: username
+        size: maximum number of connections (at least 1)
+        setup: function called with every new connection
+        port: port to connect to
+        use_ssl: when False the connections are not encrypted
+        """
+        self.hostname=hostname
+        self.username=username
+        self.port=port
+        self.use_ssl=use_ssl
+        self.size=max(1, size)
+        self.setup=setup
+        self.password=None
+        self.connections=[]
+        self.idle=queue.Queue()
+        self.lock=threading.Lock()
+
+    def get(self):
+        """Returns a connection that is not in use, waits for one if all are in use"""
+        with self.lock:
+            try:
+                return self.idle.get_nowait()
+            except queue.Empty:
+                pass
+            if len(self.connections) < self.size:
+                if self.password is None:
+                    self.password=get_password(self.hostname, self.username)
+                connection=open_connection_to_IMAPServer(self.hostname, self.username, self.password,
+                                                         self.port, self.use_ssl)
+                if self.setup:
+                    self.setup(connection)
+                self.connections.append(connection)
+                return connection
+        return self.idle.get()
+
+    def put(self, connection):
+        """Hands a connection obtained with get() back to the pool"""
+        self.idle.put(connection)
+
+    def replace(self, connection):
+        """Returns a new connection instead of connection (obtained with get()), e.g. after it broke"""
+        try:
+            connection.shutdown()
+        except:
+            pass
+        new=open_connection_to_IMAPServer(self.hostname, self.username, self.password,
+                                          self.port, self.use_ssl)
+        if self.setup:
+            self.setup(new)
+        with self.lock:
+            self.connections=[c for c in self.connections if c is not connection]
+            self.connections.append(new)
+        return new
+
+    def close(self):
+        """Closes the selected mailboxes and logs out all connections"""
+        for connection in self.connections:
+            try:
+                connection.close()
+            except:
+                pass
+            try:
+                connection.logout()
+            except:
+                pass
+        self.connections=[]
+
+
+class ServerConnectionLimit():
+    """ServerConnectionLimit: Caps the number of connections per server, for several accounts at once
+
+    Every account reserves the connections it is going to use with
+    acquire() before it connects and hands them back with release().
+    A reservation is all or nothing, so accounts that wait for each
+    other's connections cannot deadlock.
+
+    limit: maximum number of connections per server, None for no limit
+    in_use: dict with the number of reserved connections per server
+    """
+
+    def __init__(self, limit=None):
+        """Initiallize
+
+        limit: maximum number of connections per server, None for no limit
+        """
+        self.limit=limit
+        self.in_use={}
+        self.condition=threading.Condition()
+
+    def acquire(self, hostname, n=1):
+        """Waits until n connections to hostname can be made and reserves them
+
+        More than limit connections are never reserved, asking for more
+        reserves limit connections.
+        Returns the number of connections reserved
+        """
+        hostname=hostname.lower()
+        with self.condition:
+            if self.limit is not None:
+                n=max(1, min(n, self.limit))
+                self.condition.wait_for(lambda: self.in_use.get(hostname, 0)+n <= self.limit)
+            self.in_use[hostname]=self.in_use.get(hostname, 0)+n
+            return n
+
+    def release(self, hostname, n=1):
+        """Hands back n connections to hostname reserved with acquire()"""
+        hostname=hostname.lower()
+        with self.condition:
+            self.in_use[hostname]-=n
+            self.condition.notify_all()
+
+
+class ImapMetrics():
+    """ImapMetrics: Counts what a run does on the IMAP server, and how long it takes
+
+    The connections that are instrumented (see instrument_connection and
+    the metrics argument of AsyncImapConnection) report their commands,
+    the bytes they send and receive and the time they wait for the server.
+    The script adds the time it spends per phase. Connections in several
+    threads may report to the same ImapMetrics.
+
+    Phase times and server times are summed over the mailboxes and the
+    connections: when these are processed side by side the sum can be
+    larger than the wall time of the run.
+
+    labels: dict with labels (e.g. server) for the Prometheus metrics
+    commands: dict with the number of completed commands per command
+    latency: dict with per command a list with the number of commands per
+             bucket of latency_buckets, the number above the last bucket
+             and the summed latency
+    bytes_in, bytes_out: number of bytes received and sent
+    server_time: dict with the seconds spent waiting for the server per
+                 selected mailbox ('' when no mailbox was selected)
+    phases: dict with the seconds spent per phase
+    """
+    latency_buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, labels=None):
+        """Initiallize
+
+        labels: dict with labels for the Prometheus metrics
+        """
+        self.labels=labels or {}
+        self.lock=threading.Lock()
+        self.started=time.time()
+        self.clock=time.perf_counter()
+        self.commands={}
+        self.latency={}
+        self.bytes_in=0
+        self.bytes_out=0
+        self.server_time={}
+        self.phases={}
+
+    def sent(self, n):
+        with self.lock:
+            self.bytes_out+=n
+
+    def received(self, n):
+        with self.lock:
+            self.bytes_in+=n
+
+    def completed(self, command, seconds):
+        """Counts command, that took seconds from sending it to its tagged response"""
+        with self.lock:
+            self.commands[command]=self.commands.get(command, 0)+1
+            histogram=self.latency.get(command)
+            if histogram is None:
+                histogram=self.latency[command]=[0]*(len(self.latency_buckets)+1)+[0.0]
+            for i, bound in enumerate(self.latency_buckets):
+                if seconds <= bound:
+                    break
+            else:
+                i=len(self.latency_buckets)
+            histogram[i]+=1
+            histogram[-1]+=seconds
+
+    def waited(self, mailbox, seconds):
+        """Adds seconds of waiting for the server while mailbox was selected"""
+        with self.lock:
+            mailbox=mailbox or ''
+            self.server_time[mailbox]=self.server_time.get(mailbox, 0.0)+seconds
+
+    def add_phase(self, name, seconds):
+        with self.lock:
+            self.phases[name]=self.phases.get(name, 0.0)+seconds
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Context manager that adds the time spent in it to phase name"""
+        started=time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter()-started)
+
+    def timed(self, name, iterable):
+        """Generator yielding the items of iterable, the time spent producing them is added to phase name"""
+        spent=0.0
+        iterator=iter(iterable)
+        try:
+            while True:
+                started=time.perf_counter()
+                try:
+                    item=next(iterator)
+                finally:
+                    spent+=time.perf_counter()-started
+                yield item
+        except StopIteration:
+            return
+        finally:
+            self.add_phase(name, spent)
+
+    async def timed_async(self, name, iterable):
+        """Async generator version of timed() for an async iterable"""
+        spent=0.0
+        iterator=iterable.__aiter__()
+        try:
+            while True:
+                started=time.perf_counter()
+                try:
+                    item=await iterator.__anext__()
+                finally:
+                    spent+=time.perf_counter()-started
+                yield item
+        except StopAsyncIteration:
+            return
+        finally:
+            self.add_phase(name, spent)
+
+    def summary(self):
+        """Returns a dict with the metrics, for json"""
+        with self.lock:
+            bounds=[str(bound) for bound in self.latency_buckets]+['+Inf']
+            return {
+                'started': datetime.datetime.fromtimestamp(self.started).isoformat(timespec='seconds'),
+                'wall_time': round(time.perf_counter()-self.clock, 6),
+                'labels': dict(self.labels),
+                'commands': dict(self.commands),
+                'latency': dict((command, {'count': sum(histogram[:-1]),
+                                           'sum': round(histogram[-1], 6),
+                                           'buckets': dict(zip(bounds, histogram[:-1]))})
+                                for command, histogram in self.latency.items()),
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'server_time': dict((mailbox, round(seconds, 6)) for mailbox, seconds in self.server_time.items()),
+                'phases': dict((name, round(seconds, 6)) for name, seconds in self.phases.items()),
+                }
+
+    def write_json(self, filename):
+        """Writes the summary() to filename, '-' for stdout"""
+        if filename == '-':
+            json.dump(self.summary(), sys.stdout, indent=2)
+            print ()
+            return
+        with open(filename, 'w') as fp:
+            json.dump(self.summary(), fp, indent=2)
+
+    def prometheus_families(self, prefix='archive_mail'):
+        """Returns the metrics in the Prometheus text format
+
+        Returns a list of (name, type, help, sample lines) tuples, one per
+        metric, the samples carry the labels.
+        """
+        summary=self.summary()
+        families=[]
+
+        def metric(name, kind, help, samples):
+            lines=[]
+            for suffix, labels, value in samples:
+                labels=dict(self.labels, **labels)
+                text=','.join('%s="%s"' % (key, _prometheus_escape(value)) for key, value in sorted(labels.items()))
+                lines.append('%s_%s%s%s %s' % (prefix, name, suffix, '{%s}' % text if text else '', value))
+            families.append(('%s_%s' % (prefix, name), kind, help, lines))
+
+        metric('last_run_timestamp_seconds', 'gauge', 'Time at which the run started.',
+               [('', {}, round(self.started, 3))])
+        metric('run_seconds', 'gauge', 'Wall time of the run.', [('', {}, summary['wall_time'])])
+        metric('phase_seconds', 'gauge', 'Time spent per phase, summed over mailboxes and connections.',
+               [('', {'phase': name}, seconds) for name, seconds in sorted(summary['phases'].items())])
+        metric('imap_commands', 'gauge', 'IMAP commands completed, per command.',
+               [('', {'command': command}, count) for command, count in sorted(summary['commands'].items())])
+        samples=[]
+        for command, latency in sorted(summary['latency'].items()):
+            count=0
+            for bound, n in latency['buckets'].items():
+                count+=n
+                samples.append(('_bucket', {'command': command, 'le': bound}, count))
+            samples.append(('_sum', {'command': command}, latency['sum']))
+            samples.append(('_count', {'command': command}, latency['count']))
+        metric('imap_command_latency_seconds', 'histogram',
+               'Time from sending an IMAP command to its tagged response.', samples)
+        metric('imap_received_bytes', 'gauge', 'Bytes received from the IMAP server.',
+               [('', {}, summary['bytes_in'])])
+        metric('imap_sent_bytes', 'gauge', 'Bytes sent to the IMAP server.', [('', {}, summary['bytes_out'])])
+        metric('imap_server_seconds', 'gauge', 'Time spent waiting for the IMAP server, per selected mailbox.',
+               [('', {'mailbox': mailbox}, seconds) for mailbox, seconds in sorted(summary['server_time'].items())])
+        return families
+
+
+def write_metrics_json(metrics, filename):
+    """Writes the summary() of every ImapMetrics in the list metrics to filename as a JSON list, '-' for stdout"""
+    summaries=[m.summary() for m in metrics]
+    if filename == '-':
+        json.dump(summaries, sys.stdout, indent=2)
+        print ()
+        return
+    with open(filename, 'w') as fp:
+        json.dump(summaries, fp, indent=2)
+
+
+def write_metrics_prometheus(metrics, filename, prefix='archive_mail'):
+    """Writes the ImapMetrics in the list metrics to filename in the Prometheus text format
+
+    The samples of a metric are listed under a single HELP and TYPE
+    line, their labels (e.g. server and user) tell the runs apart.
+    For the textfile collector of the node exporter: the file is
+    written next to filename and then renamed, so that the collector
+    never reads half a file.
+    """
+    families={}
+    for m in metrics:
+        for name, kind, help, lines in m.prometheus_families(prefix):
+            families.setdefault(name, (kind, help, []))[2].extend(lines)
+    lines=[]
+    for name, (kind, help, samples) in families.items():
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s %s' % (name, kind))
+        lines.extend(samples)
+
+    with open(filename + '.tmp', 'w') as fp:
+        fp.write('\n'.join(lines) + '\n')
+    os.replace(filename + '.tmp', filename)
+
+
+def _prometheus_escape(value):
+    # Escapes a label value for the Prometheus text format
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def instrument_connection(connection, metrics):
+    """Makes connection report its commands, bytes and waiting time to metrics
+
+    The latency of a command is the time from sending it to reading its
+    tagged response. The time spent waiting for tagged responses counts
+    as server time of the mailbox that is selected. Pipelined commands
+    (see ImapPipeline) are measured as well.
+
+    connection: imaplib.IMAP4 object
+    metrics: ImapMetrics
+    Returns connection
+    """
+    send, read, readline = connection.send, connection.read, connection.readline
+    command, command_complete = connection._command, connection._command_complete
+    started={}
+    connection.mailbox=None
+
+    def _send(data):
+        metrics.sent(len(data))
+        return send(data)
+
+    def _read(size):
+        data=read(size)
+        metrics.received(len(data))
+        return data
+
+    def _readline():
+        line=readline()
+        metrics.received(len(line))
+        return line
+
+    def _command(name, *args):
+        if name in ('SELECT', 'EXAMINE') and args:
+            connection.mailbox=str(args[0]).strip('"')
+        tag=command(name, *args)
+        if name == 'UID' and args:
+            name='UID %s' % args[0].upper()
+        started[tag]=(name, time.perf_counter())
+        return tag
+
+    def _command_complete(name, tag):
+        waiting=time.perf_counter()
+        try:
+            return command_complete(name, tag)
+        finally:
+            now=time.perf_counter()
+            name, sent=started.pop(tag, (name, waiting))
+            metrics.completed(name, now-sent)
+            metrics.waited(connection.mailbox, now-waiting)
+
+    connection.send=_send
+    connection.read=_read
+    connection.readline=_readline
+    connection._command=_command
+    connection._command_complete=_command_complete
+    connection.metrics=metrics
+    return connection
+
+
+class DecisionLog():
+    """DecisionLog: Records per message what was decided, one JSON object per line
+
+    Meant to find out why a message went where it went. Lines from
+    several threads do not get mixed up.
+
+    filename: file to which the records are appended
+    """
+
+    def __init__(self, filename):
+        """Initiallize
+
+        filename: file to which the records are appended
+        """
+        self.fp=open(os.path.expanduser(filename), 'a')
+        self.lock=threading.Lock()
+
+    def write(self, **fields):
+        """Appends a record with fields"""
+        line=json.dumps(fields, default=str)
+        with self.lock:
+            self.fp.write(line + '\n')
+
+    def close(self):
+        with self.lock:
+            self.fp.close()
+
+
+class FolderRegistry():
+    """FolderRegistry: The folders on the server, to tell which destinations must be created
+
+    The folders below the top level folder of a destination are read into
+    an ImapNode tree the first time one of them is needed; the first time
+    the folders below all roots (the top level folders of the
+    destinations, when known in advance) are listed together. The LIST
+    commands are pipelined. After that ensure() answers from the tree;
+    missing folders, and their missing parents, are created with
+    pipelined CREATE commands and added to the tree.
+    Without a delimiter all folders are read with a single LIST "" *.
+
+    Shared by all MoveQueues of a run, also those of other threads and
+    tasks, so that the folders are listed once for all source mailboxes.
+
+    delimiter: hierarchy delimiter of the server, or None
+    roots: top level folders of the destinations
+    """
+    unselectable=('Noselect', 'NonExistent')
+
+    def __init__(self, delimiter=None, roots=()):
+        """Initiallize
+
+        delimiter: hierarchy delimiter of the server, or None
+        roots: top level folders of the destinations
+        """
+        self.tree=None
+        self.delimiter=delimiter
+        self.roots=set(roots)
+        self.listed=set()
+        self.lock=threading.Lock()
+        self.busy=None
+
+    def __contains__(self, path):
+        return not self._unlisted(path) and not self._missing(path)
+
+    def _unlisted(self, path):
+        # The top level folders that must be listed before the existence
+        # of path is known
+        if self.delimiter is None:
+            return set() if self.tree is not None else set(['*'])
+        roots=set([path.split(self.delimiter)[0]])
+        if not self.listed:
+            roots|=self.roots
+        return roots-self.listed
+
+    def _listing(self, roots):
+        # The LIST commands for roots
+        if self.delimiter is None:
+            return [(None, 'LIST', ('""', '*'))]
+        return [(None, 'LIST', ('""', pattern)) for root in sorted(roots)
+                for pattern in (imap_quote(root), imap_quote(root + self.delimiter + '*'))]
+
+    def _load(self, connection, roots, responses):
+        if self.tree is None:
+            self.tree=ImapNode("", delimiter=self.delimiter or '/')
+        for typ, response in responses:
+            if typ!='OK':
+                raise Exception ("Failed to execute list command to IMAP server %s"%connection.host)
+            for resp in response:
+                if not resp or isinstance(resp, tuple):
+                    # Names sent as literals do not occur in destinations
+                    continue
+                pflags, pdelimiter, pmailbox= parse_list_response(resp.decode('utf-8'))
+                self.tree.set_delimiter(pdelimiter)
+                self.tree.add_path(pmailbox, flags=re.findall(r"\w+", pflags))
+        logging.debug("Listed folders below %s on %s", ", ".join(sorted(roots)), connection.host)
+        self.listed|=roots
+
+    def _missing(self, path):
+        # The folders from the top down to path that do not exist. A
+        # parent only needs to be there, the folder must be selectable.
+        elements=path.split(self.tree.delimiter)
+        folders=[self.tree.delimiter.join(elements[:i+1]) for i in range(len(elements))]
+        for i, folder in enumerate(folders):
+            if self.tree.lookup(folder) is None:
+                return folders[i:]
+        if set(self.unselectable) & set(self.tree.lookup(path).flags):
+            return [path]
+        return []
+
+    def _created(self, connection, path, typ, dat):
+        if typ!='OK':
+            raise Exception ("Failed to create folder %s on  IMAP server %s. IMAP Server returned: %s"%(path,connection.host,dat[0]))
+        self.tree.add_path(path, flags=[])
+
+    def ensure(self, connection, path):
+        """Creates the folder path, and its missing parents, through connection unless it exists"""
+        with self.lock:
+            roots=self._unlisted(path)
+            if roots:
+                commands=self._listing(roots)
+                responses=[(typ, dat) for context, typ, dat in ImapPipeline(connection, len(commands)).run(commands)]
+                self._load(connection, roots, responses)
+            missing=self._missing(path)
+            if not missing:
+                return
+            logging.info("Creating Folders %s on Imap Server: %s", ", ".join(missing), connection.host)
+            commands=((folder, 'CREATE', (imap_quote(folder),)) for folder in missing)
+            for folder, typ, dat in ImapPipeline(connection, len(missing)).run(commands):
+                self._created(connection, folder, typ, dat)
+
+    async def ensure_async(self, connection, path):
+        """Coroutine version of ensure() for an AsyncImapConnection
+
+        Coroutines wait for the one that is listing or creating folders.
+        """
+        while self.busy is not None:
+            await self.busy
+        if path in self:
+            return
+        self.busy=asyncio.get_running_loop().create_future()
+        try:
+            roots=self._unlisted(path)
+            if roots:
+                responses=[(typ, dat) async for context, typ, dat in connection.pipeline(self._listing(roots))]
+                self._load(connection, roots, responses)
+            missing=self._missing(path)
+            if missing:
+                logging.info("Creating Folders %s on Imap Server: %s", ", ".join(missing), connection.host)
+                commands=((folder, 'CREATE', (imap_quote(folder),)) for folder in missing)
+                async for folder, typ, dat in connection.pipeline(commands):
+                    self._created(connection, folder, typ, dat)
+        finally:
+            busy=self.busy
+            self.busy=None
+            busy.set_result(None)
+
+
+class MoveQueue():
+    """MoveQueue: Collects the UIDs of messages per destination and moves them in batches
+
+    The messages of a mailbox are queued per destination while the mailbox
+    is being scanned. When the queue of a destination reaches threshold
+    messages they are moved, so that moving overlaps with scanning.
+
+    With the MOVE capability (RFC 6851) the messages are moved with UID
+    MOVE. Otherwise they are copied and flagged \\Deleted, and finish()
+    removes them from the source mailbox with a single UID EXPUNGE of
+    exactly those messages (UIDPLUS, RFC 4315), or else with a single
+    EXPUNGE of the mailbox.
+
+    connection: imaplib.IMAP4 object with the source mailbox selected
+    delimiter: hierarchy delimiter of the server
+    threshold: number of queued messages at which a destination is flushed
+    pipeline_depth: maximum number of outstanding COPY/STORE commands
+    move: when False the messages are only counted, not moved
+    folders: FolderRegistry, shared between queues
+    max_length: maximum length of a command line
+    destinations: dict with path: [destination_path_elements, number of messages]
+    seconds: time spent moving messages
+    """
+
+    def __init__(self, connection, delimiter, threshold=500, pipeline_depth=4, move=True, folders=None,
+                 max_length=8000):
+        """Initiallize
+
+        connection: imaplib.IMAP4 object with the source mailbox selected
+        delimiter: hierarchy delimiter of the server
+        threshold: number of queued messages at which a destination is flushed
+        pipeline_depth: maximum number of outstanding COPY/STORE commands
+        move: when False the messages are only counted, not moved
+        folders: FolderRegistry, shared between queues
+        max_length: maximum length of a command line (the UIDs are sent as
+                    ranges and split over as many commands as needed)
+        """
+        self.connection=connection
+        self.delimiter=delimiter
+        self.threshold=max(1, threshold)
+        self.pipeline_depth=pipeline_depth
+        self.move=move
+        self.folders=folders if folders is not None else FolderRegistry()
+        self.max_length=max_length
+        self.destinations={}
+        self.queues={}
+        self.deleted=[]
+        self.moved=[]
+        self.seconds=0.0
+        self.capabilities=connection.capabilities
+
+    def add(self, destination_path_elements, uids):
+        """Queues the messages with uids (list of strings) for destination_path_elements"""
+        path=self.delimiter.join(destination_path_elements)
+        if path in self.destinations:
+            self.destinations[path][1]+=len(uids)
+        else:
+            self.destinations[path]=[destination_path_elements, len(uids)]
+        if not self.move:
+            return
+        queue=self.queues.setdefault(path, [])
+        queue.extend(uids)
+        if len(queue) >= self.threshold:
+            self._full(path)
+
+    def _full(self, path):
+        # The queue of path reached threshold
+        self.flush(path)
+
+    def flush(self, path=None):
+        """Moves the queued messages of path (all destinations if None)
+
+        Without MOVE the messages are copied and flagged \\Deleted, they
+        are expunged by finish().
+        """
+        started=time.perf_counter()
+        for path in self._flushed_paths(path):
+            uids=self.queues.pop(path, [])
+            if not uids:
+                continue
+            self.folders.ensure(self.connection, path)
+            pipeline=ImapPipeline(self.connection, self.pipeline_depth)
+            for commands, check in self._move_steps(path, path, uids):
+                for mv_data, typ, response in pipeline.run(commands):
+                    check(mv_data, typ, response)
+            if 'MOVE' in self.capabilities:
+                # The EXPUNGE responses that come with MOVE are not needed
+                self.connection.untagged_responses.pop('EXPUNGE', None)
+        self.seconds+=time.perf_counter()-started
+
+    def finish(self):
+        """Moves all queued messages and expunges the source mailbox when needed
+
+        Returns the list of UIDs that were moved
+        """
+        self.flush()
+        started=time.perf_counter()
+        deleted, commands=self._expunge_commands()
+        for command, args in commands:
+            self._expunged(*getattr(self.connection, command)(*args))
+        return self._finished(deleted, started)
+
+    def _flushed_paths(self, path):
+        # Returns the paths that flush(path) moves messages to
+        return [path] if path is not None else list(self.queues)
+
+    def _move_steps(self, path, name, uids):
+        # Returns the steps in which uids are moved to path, a list of
+        # (commands, check): the commands of a step are pipelined, check
+        # is called with every (context, typ, data) response. name is
+        # path as it is sent to the server.
+        logging.info("Moving %d messages to %s", len(uids), path)
+        host=self.connection.host
+        # The UIDs are sent as ranges, split in chunks so that the
+        # commands do not become to long for IMAP to handle them.
+        chunks=list(uid_sets(uids, self.max_length-len(name)-_command_overhead))
+
+        def moved(mv_data, typ, response):
+            if typ!='OK':
+                raise Exception ("Failed to move data to %s on  IMAP server %s. IMAP Server returned: %s"%(path,host,response[0]))
+            self.moved.extend(expand_uid_set(mv_data))
+
+        def copied(mv_data, typ, response):
+            if typ!='OK':
+                raise Exception ("Failed to copy data to %s on  IMAP server %s. IMAP Server returned: %s"%(path,host,response[0]))
+
+        def flagged(mv_data, typ, response):
+            if typ!='OK':
+                raise Exception ("Failed to set DELETE Flag  IMAP server %s. IMAP Server returned: %s"%(host,response[0]))
+            self.deleted.extend(expand_uid_set(mv_data))
+
+        if 'MOVE' in self.capabilities:
+            return [(((mv_data,'move',(mv_data,name)) for mv_data in chunks), moved)]
+        # The Deleted flag is only set once every copy succeeded.
+        return [(((mv_data,'copy',(mv_data,name)) for mv_data in chunks), copied),
+                (((mv_data,'store',(mv_data,'+FLAGS.SILENT',r'(\Deleted)')) for mv_data in chunks), flagged)]
+
+    def _expunge_commands(self):
+        # Takes the messages that were copied and flagged \Deleted, returns
+        # them with the commands that expunge them, (method of the
+        # connection, arguments) tuples: UID EXPUNGE of exactly those
+        # messages with UIDPLUS, otherwise EXPUNGE of the mailbox.
+        deleted=self.deleted
+        self.deleted=[]
+        if not deleted:
+            return deleted, []
+        if 'UIDPLUS' in self.capabilities:
+            return deleted, [('uid', ('expunge', uidset))
+                             for uidset in uid_sets(deleted, self.max_length-_command_overhead)]
+        return deleted, [('expunge', ())]
+
+    def _expunged(self, typ, response):
+        # Checks the response to one of the commands of _expunge_commands
+        if typ!='OK':
+            raise Exception ("Failed to set expunge on IMAP server %s:%s"%(self.connection.host,response))
+
+    def _finished(self, deleted, started):
+        # Returns the UIDs that were moved by finish(), which started at started
+        moved=self.moved+deleted
+        self.moved=[]
+        self.seconds+=time.perf_counter()-started
+        return moved
+
+
+class TimerQueue():
+    """TimerQueue: Messages that are to be looked at again later, by the time they are due
+
+    Used to archive messages when they become old enough: a message is
+    scheduled for the moment it will be, the queue tells when the first
+    one is due and hands out the ones that are due, per mailbox.
+    Scheduling a message again replaces its earlier time. Several threads
+    may use the queue.
+
+    heap: heapq of (due, mailbox, uid) tuples
+    messages: dict with (mailbox, uid): (due, MessageContainer)
+    """
+
+    def __init__(self):
+        """Initiallize"""
+        self.heap=[]
+        self.messages={}
+        self.lock=threading.Lock()
+
+    def __len__(self):
+        return len(self.messages)
+
+    def schedule(self, due, mailbox, mc):
+        """Schedules MessageContainer mc in mailbox for datetime due"""
+        key=(mailbox, mc.get_uid())
+        with self.lock:
+            self.messages[key]=(due, mc)
+            heapq.heappush(self.heap, (due, mailbox, mc.get_uid()))
+
+    def forget(self, mailbox, uids):
+        """Drops the messages with uids in mailbox (e.g. because they were moved)"""
+        with self.lock:
+            for uid in uids:
+                self.messages.pop((mailbox, uid), None)
+
+    def next_due(self):
+        """Returns the datetime at which the first message is due, None if there is none"""
+        with self.lock:
+            self._drop_stale()
+            return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now):
+        """Removes the messages that are due at datetime now
+
+        Returns a dict with mailbox: list of MessageContainers
+        """
+        due={}
+        with self.lock:
+            self._drop_stale()
+            while self.heap and self.heap[0][0] <= now:
+                when, mailbox, uid = heapq.heappop(self.heap)
+                due.setdefault(mailbox, []).append(self.messages.pop((mailbox, uid))[1])
+                self._drop_stale()
+        return due
+
+    def _drop_stale(self):
+        # Drops heap entries of messages that were forgotten or rescheduled
+        while self.heap:
+            when, mailbox, uid = self.heap[0]
+            entry=self.messages.get((mailbox, uid))
+            if entry is not None and entry[0] == when:
+                return
+            heapq.heappop(self.heap)
+
+
+class AsyncImapConnection():
+    """AsyncImapConnection: IMAP client connection for asyncio
+
+    The commands are coroutines that return (typ, data) tuples like the
+    methods of imaplib.IMAP4, the responses are parsed the same way, so
+    that the result handling of the synchronous code applies to both.
+
+    Several commands can be in flight at the same time, also from
+    different tasks (up to pipeline_depth of them). A reader task reads
+    the responses; when the tagged response of a command arrives the
+    command gets the untagged responses of its own type, the server
+    answers commands in the order they were sent. A UID MOVE can thus be
+    sent while a UID FETCH on the same mailbox is still running.
+
+    host: hostname to connect to
+    port: port to connect to
+    use_ssl: when True the connection is made over TLS
+    pipeline_depth: maximum number of outstanding commands
+    metrics: ImapMetrics to which the commands are reported, or None.
+             The time during which commands are outstanding counts as
+             server time of the selected mailbox.
+    """
+    error=imaplib.IMAP4.error
+    abort=imaplib.IMAP4.abort
+
+    def __init__(self, host, port=993, use_ssl=True, pipeline_depth=4, metrics=None):
+        """Initiallize
+
+        host: hostname to connect to
+        port: port to connect to
+        use_ssl: when True the connection is made over TLS
+        pipeline_depth: maximum number of outstanding commands (at least 1)
+        metrics: ImapMetrics to which the commands are reported
+        """
+        self.host=host
+        self.port=port
+        self.use_ssl=use_ssl
+        self.pipeline_depth=max(1, pipeline_depth)
+        self.capabilities=()
+        self.untagged_responses={}
+        self.tagged_commands={}
+        self.tagnum=0
+        self.tagpre=imaplib.Int2AP(random.randint(4096, 65535))
+        self.tagre=re.compile(br'(?P<tag>' + self.tagpre + br'\d+) (?P<type>[A-Z]+) ?(?P<data>.*)', re.ASCII)
+        self.reader=None
+        self.writer=None
+        self.reading=None
+        self.slots=None
+        self.sending=None
+        self.continuation=None
+        self.closing=False
+        self.metrics=metrics
+        self.mailbox=None
+        self.outstanding=0
+        self.busy_since=None
+
+    async def open(self):
+        """Connects to the server and reads the greeting and the capabilities"""
+        context=ssl.create_default_context() if self.use_ssl else None
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port, ssl=context)
+        self.slots=asyncio.Semaphore(self.pipeline_depth)
+        self.sending=asyncio.Lock()
+        greeting=await self._get_line()
+        if not greeting.startswith((b'* OK', b'* PREAUTH')):
+            raise self.error("Unexpected greeting from %s: %s" % (self.host, greeting))
+        self.reading=asyncio.ensure_future(self._read_responses())
+        await self.capability()
+
+    async def _get_line(self):
+        line=await self.reader.readline()
+        if not line:
+            raise self.abort("socket error: EOF")
+        if not line.endswith(b'\r\n'):
+            raise self.abort("socket error: unterminated line: %r" % line)
+        if self.metrics:
+            self.metrics.received(len(line))
+        return line[:-2]
+
+    def _append_untagged(self, typ, dat):
+        self.untagged_responses.setdefault(typ, []).append(dat)
+
+    def _response_code(self, typ, dat):
+        # Bracketed response information, e.g. [UIDVALIDITY 123]
+        if typ in ('OK', 'NO', 'BAD'):
+            m=imaplib.Response_code.match(dat)
+            if m:
+                self._append_untagged(m.group('type').decode('ascii'), m.group('data'))
+
+    async def _read_responses(self):
+        # Reads the responses of the server and completes the commands
+        try:
+            while True:
+                line=await self._get_line()
+                if line.startswith(b'+'):
+                    if self.continuation is not None and not self.continuation.done():
+                        self.continuation.set_result(line)
+                    continue
+                m=self.tagre.match(line)
+                if m:
+                    typ=m.group('type').decode('ascii')
+                    dat=m.group('data')
+                    self._response_code(typ, dat)
+                    name, future=self.tagged_commands.pop(m.group('tag'))
+                    if typ in ('NO', 'BAD'):
+                        result=(typ, [dat])
+                    else:
+                        result=(typ, self.untagged_responses.pop(name, [None]))
+                    if not future.done():
+                        future.set_result(result)
+                    continue
+                m=imaplib.Untagged_status.match(line)
+                dat2=None
+                if m:
+                    dat2=m.group('data2')
+                else:
+                    m=imaplib.Untagged_response.match(line)
+                if not m:
+                    raise self.abort("unexpected response: %r" % line)
+                typ=m.group('type').decode('ascii')
+                dat=m.group('data') or b''
+                if dat2:
+                    dat=dat + b' ' + dat2
+                # Literals are kept as (prefix, literal) tuples like imaplib does
+                while True:
+                    literal=imaplib.Literal.match(dat)
+                    if not literal:
+                        break
+                    data=await self.reader.readexactly(int(literal.group('size')))
+                    if self.metrics:
+                        self.metrics.received(len(data))
+                    self._append_untagged(typ, (dat, data))
+                    dat=await self._get_line()
+                self._append_untagged(typ, dat)
+                self._response_code(typ, dat)
+        except Exception as e:
+            for name, future in self.tagged_commands.values():
+                if not future.done():
+                    future.set_exception(e)
+            self.tagged_commands={}
+            if not self.closing:
+                logging.debug("Connection to %s lost: %s", self.host, e)
+
+    def _busy(self, delta):
+        # Keeps count of the outstanding commands, the time during which
+        # there are any is reported as server time
+        if self.outstanding == 0:
+            self.busy_since=time.perf_counter()
+        self.outstanding+=delta
+        if self.outstanding == 0 and self.metrics:
+            self.metrics.waited(self.mailbox, time.perf_counter()-self.busy_since)
+
+    async def command(self, name, *args, untagged=None, literal=None):
+        """Sends command name with args, returns (typ, data) when it completed
+
+        data holds the untagged responses of type untagged (default: name),
+        or the text of the tagged response if the command failed.
+        A BAD response raises AsyncImapConnection.error.
+        literal: bytes sent as an IMAP literal after args, None for none.
+                 Without LITERAL+ the server is waited for before it is sent.
+        """
+        async with self.slots:
+            if self.reading.done():
+                raise self.abort("connection to %s is closed" % self.host)
+            self.tagnum+=1
+            tag=self.tagpre + str(self.tagnum).encode('ascii')
+            future=asyncio.get_running_loop().create_future()
+            self.tagged_commands[tag]=(untagged or name, future)
+            line=tag + b' ' + name.encode('ascii')
+            for arg in args:
+                if arg is None:
+                    continue
+                if isinstance(arg, str):
+                    arg=arg.encode('ascii')
+                line=line + b' ' + arg
+            synchronizing=literal is not None and 'LITERAL+' not in self.capabilities
+            if literal is not None:
+                line=line + b' {%d%s}' % (len(literal), b'' if synchronizing else b'+')
+            started=time.perf_counter()
+            self._busy(1)
+            try:
+                # No other command may be written between a command line
+                # and its literal
+                async with self.sending:
+                    self.writer.write(line + b'\r\n')
+                    if synchronizing:
+                        self.continuation=asyncio.get_running_loop().create_future()
+                        await self.writer.drain()
+                        await asyncio.wait([self.continuation, future], return_when=asyncio.FIRST_COMPLETED)
+                        self.continuation=None
+                    if literal is not None and not future.done():
+                        self.writer.write(literal + b'\r\n')
+                    await self.writer.drain()
+                typ, dat = await future
+            finally:
+                self._busy(-1)
+                if self.metrics:
+                    self.metrics.sent(len(line)+2+(len(literal)+2 if literal is not None else 0))
+                    self.metrics.completed(name if name != 'UID' else 'UID %s' % untagged, time.perf_counter()-started)
+        if typ == 'BAD':
+            raise self.error('%s command error: %s %s' % (name, typ, dat))
+        return typ, dat
+
+    def response(self, code):
+        """Returns (code, data) with the untagged responses code, like imaplib.IMAP4.response()"""
+        return code, self.untagged_responses.pop(code.upper(), [None])
+
+    async def capability(self):
+        typ, dat = await self.command('CAPABILITY')
+        if typ == 'OK' and dat[-1]:
+            self.capabilities=tuple(dat[-1].decode('ascii').upper().split())
+        return typ, dat
+
+    async def login(self, user, password):
+        """Logs in, raises AsyncImapConnection.error if that fails
+
+        A password that is not plain ASCII is sent as a literal in UTF-8.
+        """
+        if password.isascii() and password.isprintable():
+            typ, dat = await self.command('LOGIN', user, imap_quote(password))
+        else:
+            typ, dat = await self.command('LOGIN', user, literal=password.encode('utf-8'))
+        if typ != 'OK':
+            raise self.error(dat[-1])
+        # Servers often announce more capabilities once logged in
+        code, capability = self.response('CAPABILITY')
+        if capability[-1]:
+            self.capabilities=tuple(capability[-1].decode('ascii').upper().split())
+        else:
+            await self.capability()
+        return typ, dat
+
+    async def logout(self):
+        """Logs out and closes the connection"""
+        self.closing=True
+        try:
+            typ, dat = await self.command('LOGOUT', untagged='BYE')
+        except Exception as e:
+            typ, dat = 'NO', [str(e).encode()]
+        self.writer.close()
+        self.reading.cancel()
+        return typ, dat
+
+    async def list(self, directory='""', pattern='*'):
+        return await self.command('LIST', directory, pattern)
+
+    async def select(self, mailbox='INBOX', readonly=False):
+        """Selects mailbox, returns (typ, data) with data the number of messages, like imaplib
+
+        The commands that are still in flight complete first, with the
+        responses they expect, then those of the previous mailbox are dropped.
+        """
+        pending=[future for name, future in self.tagged_commands.values()]
+        if pending:
+            await asyncio.wait(pending)
+        self.untagged_responses={}
+        self.mailbox=mailbox.strip('"')
+        typ, dat = await self.command('EXAMINE' if readonly else 'SELECT', mailbox)
+        if typ != 'OK':
+            return typ, dat
+        return typ, self.untagged_responses.get('EXISTS', [None])
+
+    async def close(self):
+        return await self.command('CLOSE')
+
+    async def expunge(self):
+        return await self.command('EXPUNGE')
+
+    async def create(self, mailbox):
+        return await self.command('CREATE', mailbox)
+
+    async def enable(self, capability):
+        return await self.command('ENABLE', capability, untagged='ENABLED')
+
+    async def status(self, mailbox, names):
+        return await self.command('STATUS', mailbox, names)
+
+    async def uid(self, command, *args):
+        """Sends UID command, data holds the untagged responses of type command"""
+        command=command.upper()
+        if command not in imaplib.Commands:
+            raise self.error("Unknown IMAP4 UID command: %s" % command)
+        return await self.command('UID', command, *args, untagged=command)
+
+    async def pipeline(self, commands):
+        """Async generator that sends UID commands and yields their responses
+
+        Works like ImapPipeline.run(): commands is an iterable of (context,
+        command, args) tuples, (context, typ, data) tuples are yielded in
+        the order of the commands, with up to pipeline_depth of them in flight.
+        """
+        pending=collections.deque()
+        try:
+            for context, command, args in commands:
+                if len(pending) >= self.pipeline_depth:
+                    context_, task = pending.popleft()
+                    typ, dat = await task
+                    yield (context_, typ, dat)
+                if command.upper() in ImapPipeline.plain_commands:
+                    task=asyncio.ensure_future(self.command(command.upper(), *args))
+                else:
+                    task=asyncio.ensure_future(self.uid(command, *args))
+                pending.append((context, task))
+            while pending:
+                context_, task = pending.popleft()
+                typ, dat = await task
+                yield (context_, typ, dat)
+        finally:
+            # Consumer stopped early: the responses of the outstanding
+            # commands are read and dropped by the reader.
+            for context_, task in pending:
+                task.cancel()
+
+
+async def open_async_connection(hostname, username, password=None, port=993, use_ssl=True, pipeline_depth=4,
+                                metrics=None):
+    """Opens an SSL connection to an IMAP Server for asyncio and logs in
+
+    Returns an AsyncImapConnection.
+
+    hostname: hostname to connect to
+    username: username
+    password: password, looked up with get_password() when None
+    port: port to connect to
+    use_ssl: when False the connection is not encrypted
+    pipeline_depth: maximum number of outstanding commands
+    metrics: ImapMetrics to which the commands are reported
+    """
+    if password is None:
+        password=get_password(hostname, username)
+    connection=AsyncImapConnection(hostname, port, use_ssl, pipeline_depth, metrics)
+    await connection.open()
+    try:
+        await connection.login(username, password)
+    except AsyncImapConnection.error as e:
+        await connection.logout()
+        raise Exception("Failed to log in to %s as %s: %s" % (hostname, username, e))
+    return connection
 
 
+async def enable_condstore_async(connection):
+    """Coroutine version of enable_condstore() for an AsyncImapConnection"""
+    if 'ENABLE' not in connection.capabilities:
+        return None
+    for extension in ('QRESYNC', 'CONDSTORE'):
+        if extension in connection.capabilities:
+            typ, data = await connection.enable(extension)
+            if typ == 'OK':
+                return extension
+    return None
 
 
+async def fetch_changes_since_async(connection, modseq):
+    """Coroutine version of fetch_changes_since() for an AsyncImapConnection"""
+    typ, data = await connection.uid('fetch', '1:*', '(UID)', '(CHANGEDSINCE %d VANISHED)' % modseq)
+    if typ != 'OK':
+        raise Exception("Failed to fetch changes since modseq %d: %s" % (modseq, data))
+    return _parse_changes(data, connection.response('VANISHED')[1])
 
-class MessageContainer(email.message.Message):
+
+async def fetch_message_headers_async(connection, uids, batch_size=500, fields=None, max_length=8000):
+    """Async generator version of fetch_message_headers() for an AsyncImapConnection
+
+    The FETCH commands are pipelined up to the pipeline_depth of the connection.
+    """
+    commands=_header_fetch_commands(uids, batch_size, fields, max_length)
+    async for context, typ, msg_data in connection.pipeline(commands):
+        for mc in _fetched_headers(typ, msg_data, fields):
+            yield mc
+
+
+class AsyncMoveQueue(MoveQueue):
+    """AsyncMoveQueue: MoveQueue for an AsyncImapConnection
+
+    A destination whose queue reaches threshold is moved by a task of its
+    own, so that the messages are moved while the scan of the mailbox,
+    on the same connection, goes on. flush() and finish() are coroutines.
+    Destination names are quoted, the connection sends arguments as they are.
+    """
+
+    def __init__(self, connection, delimiter, threshold=500, move=True, folders=None, max_length=8000):
+        """Initiallize
+
+        connection: AsyncImapConnection with the source mailbox selected
+        delimiter: hierarchy delimiter of the server
+        threshold: number of queued messages at which a destination is flushed
+        move: when False the messages are only counted, not moved
+        folders: FolderRegistry, shared between queues
+        max_length: maximum length of a command line
+        """
+        MoveQueue.__init__(self, connection, delimiter, threshold, connection.pipeline_depth, move, folders,
+                           max_length)
+        self.tasks=[]
+
+    def _full(self, path):
+        self.tasks.append(asyncio.ensure_future(self.flush(path)))
+
+    async def flush(self, path=None):
+        """Coroutine version of MoveQueue.flush()"""
+        started=time.perf_counter()
+        for path in self._flushed_paths(path):
+            uids=self.queues.pop(path, [])
+            if not uids:
+                continue
+            await self.folders.ensure_async(self.connection, path)
+            for commands, check in self._move_steps(path, imap_quote(path), uids):
+                async for mv_data, typ, response in self.connection.pipeline(commands):
+                    check(mv_data, typ, response)
+        self.seconds+=time.perf_counter()-started
+
+    async def finish(self):
+        """Coroutine version of MoveQueue.finish()"""
+        tasks=self.tasks
+        self.tasks=[]
+        await asyncio.gather(*tasks)
+        await self.flush()
+        started=time.perf_counter()
+        # The EXPUNGE responses that come with MOVE are not needed
+        self.connection.untagged_responses.pop('EXPUNGE', None)
+        deleted, commands=self._expunge_commands()
+        for command, args in commands:
+            self._expunged(*await getattr(self.connection, command)(*args))
+        return self._finished(deleted, started)
+
+
+_header_name_pattern = re.compile(rb'[\041-\071\073-\176]+')
+
+
+def parse_header_fields(header, wanted=None, decode=True):
+    """Returns a list with the (name, value) fields of a header block
+
+    Only the fields named in wanted are kept, the others are skipped.
+    Values are unfolded the way email.message.Message returns them
+    (compat32): the leading blanks and the trailing line break are removed.
+
+    header: bytes (or string) with the header block of a message
+    wanted: set of lowercased header names to keep, None to keep all
+    decode: False to leave the values as bytes, see _header_value
+    """
+    if isinstance(header, str):
+        header=header.encode('utf-8', 'surrogateescape')
+    fields=[]
+    name=None
+    current=None  # The value lines of field name, while it is kept
+    for line in header.splitlines(True):
+        if line[:1] in (b' ', b'\t'):
+            if current is not None:
+                current.append(line)
+            continue
+        if current is not None:
+            fields.append((name, b''.join(current).rstrip(b'\r\n')))
+            current=None
+        colon=line.find(b':')
+        if colon <= 0 or not _header_name_pattern.fullmatch(line, 0, colon):
+            break  # An empty line (or garbage) ends the header
+        name=line[:colon].decode('ascii')
+        if wanted is None or name.lower() in wanted:
+            current=[line[colon+1:].lstrip(b' \t')]
+    if current is not None:
+        fields.append((name, b''.join(current).rstrip(b'\r\n')))
+    if decode:
+        fields=[(field, _header_value(value)) for field, value in fields]
+    return fields
+
+
+def _header_value(value):
+    """Returns header field value as a string, value may be bytes or a string"""
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+class MessageContainer():
     """MessageContainer: A helper class for processing information from messages
 
+    Only the header fields that are needed are kept, so that the
+    containers of large mailboxes stay small. The values of fetched
+    headers are kept as bytes until they are first read, most of them
+    never are.
+
     uid: The uid of the message
-    header: Key-value-pair of header
+    fields: list of (name, value) header fields, value is bytes while
+            it has not been read
+    datetime: the Date of the message as a datetime, None if unknown
+    moved: the destination the message is to be moved to
     """
+    __slots__=('uid', 'fields', 'datetime', 'moved')
+
     def get_datetime(self):
         """Returns the time (float) associated with the Message in the Container"""
         return self.datetime
@@ -71,16 +1889,19 @@ class MessageContainer(email.message.Message):
         """Returns the uid associated with the Message in the Container"""
         return self.uid
 
-    def __init__(self, uid, headerstr):
+    def __init__(self, uid, headerstr=None, fields=None, wanted=None):
         """Initiallize
 
         uid: a string with the UID
-        headerstr: a string containing a header
+        headerstr: a string (or bytes) containing a header
+        fields: list of (name, value) header fields, used instead of headerstr
+        wanted: set of lowercased header names to keep, None to keep all
         """
-        # Trial and error object copy. NEEDS REVIEW
-        parser=email.parser.HeaderParser()
-        msg=parser.parsestr(headerstr)
-        self.__dict__=msg.__dict__
+        if fields is None:
+            fields=parse_header_fields(headerstr, wanted, decode=False)
+        elif wanted is not None:
+            fields=[(name, value) for name, value in fields if name.lower() in wanted]
+        self.fields=list(fields)
         self.uid=uid
         date=None
         date_str=self.get("Date")
@@ -90,9 +1911,39 @@ class MessageContainer(email.message.Message):
                 date=datetime.datetime.fromtimestamp(email.utils.mktime_tz(date_tuple))
         self.datetime= date
         self.moved=''
-        
+
+    def get(self, name, failobj=None):
+        """Returns the value of the first header field called name, failobj if there is none"""
+        name=name.lower()
+        for i, (field, value) in enumerate(self.fields):
+            if field.lower() == name:
+                return self._value(i)
+        return failobj
+
+    def get_all(self, name, failobj=None):
+        """Returns a list with the values of all header fields called name, failobj if there are none"""
+        name=name.lower()
+        values=[self._value(i) for i, (field, value) in enumerate(self.fields) if field.lower() == name]
+        return values or failobj
+
+    def _value(self, i):
+        """Returns the value of the i-th header field, decoded the first time it is read"""
+        name, value=self.fields[i]
+        if isinstance(value, bytes):
+            value=_header_value(value)
+            self.fields[i]=(name, value)
+        return value
+
+    def __getitem__(self, name):
+        """Returns the value of the header field called name, None if there is none"""
+        return self.get(name)
+
+    def raw_items(self):
+        """Returns an iterator over the (name, value) header fields"""
+        return ((self.fields[i][0], self._value(i)) for i in range(len(self.fields)))
+
     def __repr__(self):
-        """Returns as string representing the object by uid and email.message instance"""
+        """Returns as string representing the object by uid and date"""
         return 'MessageContainer (uid=%s %s)' % (self.uid,str(self.datetime))
 
 
@@ -100,6 +1951,518 @@ class MessageContainer(email.message.Message):
 
 
 
+class CompiledRule():
+    """CompiledRule: An ArchiveRule with its regular expressions compiled
+
+    name: name of the rule
+    priority: priority of the rule, higher priority rules are tried first
+    rule: the rule as it appears in the configuration
+    conditions: list of (header, regex, compiled regex) tuples. The compiled
+                regex is None for an empty regex, which requires the header
+                to be absent.
+    """
+
+    def __init__(self, rule):
+        """Initiallize
+
+        rule: dict with the rule from the configuration
+        raises re.error if one of the regexes does not compile
+        """
+        self.rule=rule
+        self.name=rule.get("name", "")
+        self.priority=rule.get("Priority", 0)
+        self.conditions=[]
+        for i in rule.get("Regexps", []):
+            # Header names may be written with the colon, as in "List-Id:"
+            header=i["header"].strip().rstrip(":")
+            regex=i["regex"]
+            compiled=re.compile(regex, re.DOTALL) if regex else None
+            self.conditions.append((header, regex, compiled))
+
+    def matches(self, values):
+        """Returns True if all conditions of the rule hold
+
+        values: dict with the lowercased header name as key and the list
+                of values of that header in the message as value
+        """
+        for header, regex, compiled in self.conditions:
+            found=values.get(header.lower())
+            if compiled is None:
+                if found:
+                    return False
+            elif not found or not any(compiled.match(v) for v in found):
+                return False
+        return True
+
+    def __repr__(self):
+        return 'CompiledRule (%s %s)' % (self.name, self.priority)
+
+
+def _required_literals(regex):
+    """Returns the literal strings that every match of regex contains
+
+    Only the characters at the top level of the expression are considered,
+    groups, classes, quantified characters and "." end a literal run.
+    Returns [] when the expression cannot be taken apart this way.
+    """
+    if re.search(r'\(\?[aiLmsux]', regex):
+        return []  # inline flags change what the literal means
+    runs=[""]
+    depth=0
+    i=0
+    while i < len(regex):
+        c=regex[i]
+        if c == "\\" and i+1 < len(regex):
+            if depth == 0 and not regex[i+1].isalnum():
+                runs[-1]+=regex[i+1]
+            elif depth == 0:
+                runs.append("")
+            i+=2
+            continue
+        if c == "[":
+            # A "]" right after "[" or "[^" belongs to the class
+            j=i+1
+            if regex.startswith("^", j):
+                j+=1
+            if regex.startswith("]", j):
+                j+=1
+            while j < len(regex) and regex[j] != "]":
+                j+=2 if regex[j] == "\\" else 1
+            if j >= len(regex):
+                return []
+            i=j+1
+            if depth == 0:
+                runs.append("")
+            continue
+        if c == "{" and depth == 0:
+            # A {m,n} quantifier: the quantified character may be absent
+            # or repeated, nothing inside the braces is literal
+            j=regex.find("}", i)
+            if j < 0:
+                return []
+            runs[-1]=runs[-1][:-1]
+            runs.append("")
+            i=j+1
+            continue
+        if c == "(":
+            depth+=1
+        elif c == ")":
+            depth-=1
+            if depth == 0:
+                runs.append("")
+        elif depth == 0:
+            if c == "|":
+                return []
+            if c in "*?+":
+                # the quantified character may be absent or repeated
+                runs[-1]=runs[-1][:-1]
+                runs.append("")
+            elif c in ".^$":
+                runs.append("")
+            else:
+                runs[-1]+=c
+        i+=1
+    return [run for run in runs if run]
+
+
+def _trie_regex(literals):
+    """Returns a regex that finds the literals, with common prefixes factored out"""
+    trie={}
+    for literal in literals:
+        node=trie
+        for c in literal:
+            node=node.setdefault(c, {})
+        node[""]=True
+
+    def build(node):
+        branches=[re.escape(c) + build(child) for c, child in sorted(node.items()) if c]
+        if not branches:
+            return ""
+        if "" in node:
+            return "(?:%s)?" % "|".join(branches)
+        if len(branches) == 1:
+            return branches[0]
+        return "(?:%s)" % "|".join(branches)
+
+    return re.compile("(?=(%s))" % build(trie), re.DOTALL), trie
+
+
+def _exact_key(regex):
+    """Returns the key under which a rule with regex can be found by hash lookup, or None
+
+    Two kinds of regex qualify:
+    - an angle-bracket id, optionally after literal text: "<id>",
+      ".*<id>", ".*Name <id>.*" or ".*<id>\\s*$". The key is "<id>", found
+      among the <...> tokens of a header value.
+    - an exact value: "value$", "^value\\s*$". The key is the value, found
+      as the whole (stripped) header value, so a value that starts or ends
+      with whitespace does not qualify.
+    A "." in the key is taken as a literal dot. Candidates found by key are
+    always checked against the regex itself. The anchors are kept apart
+    from the characters of the key, an escaped "$" or "^" is part of it.
+    """
+    tokens=[]
+    i=0
+    while i < len(regex):
+        c=regex[i]
+        if regex.startswith(".*", i):
+            tokens.append(".*")
+            i+=2
+        elif regex.startswith("\\s*", i):
+            tokens.append("\\s*")
+            i+=3
+        elif c == "\\":
+            if i+1 >= len(regex) or regex[i+1].isalnum():
+                return None
+            tokens.append(regex[i+1])
+            i+=2
+        elif c in "$^":
+            tokens.append("anchor" + c)
+            i+=1
+        elif c in "*+?{}[]|()":
+            return None
+        else:
+            tokens.append(c)
+            i+=1
+    if tokens[:1] == ["anchor^"]:
+        tokens=tokens[1:]
+    anchored=False
+    if tokens[-1:] == ["anchor$"]:
+        anchored=True
+        tokens=tokens[:-1]
+        if tokens[-1:] == ["\\s*"]:
+            tokens=tokens[:-1]
+    elif tokens[-1:] == [".*"]:
+        tokens=tokens[:-1]
+    leading=tokens[:1] == [".*"]
+    if leading:
+        tokens=tokens[1:]
+    if not tokens or any(len(t) != 1 for t in tokens):
+        return None
+    text="".join(tokens)
+    m=re.fullmatch(r'[^<>]*(<[^<>]+>)', text)
+    if m:
+        return m.group(1)
+    if anchored and not leading and text == text.strip():
+        return text
+    return None
+
+
+_angle_token_pattern = re.compile(r'<[^<>]*>')
+
+
+class _HeaderMatcher():
+    """_HeaderMatcher: Finds the first of the single-regex rules on one header that a value satisfies
+
+    Of the literal strings that a regex requires, the one that the fewest
+    other rules require is put in a prefix trie, which is matched at every
+    position of the value in one pass. Only the rules whose literal occurs
+    (and rules without a literal) are then tested.
+    """
+
+    def __init__(self, members):
+        """Initiallize
+
+        members: list of (position, regex, compiled regex) of the rules
+        """
+        self.compiled={}
+        self.unconditional=[]
+        self.by_literal={}
+        required={}
+        shared=collections.Counter()
+        for position, regex, compiled in members:
+            self.compiled[position]=compiled
+            required[position]=set(_required_literals(regex))
+            shared.update(required[position])
+        for position, literals in required.items():
+            if literals:
+                literal=min(literals, key=lambda l: (shared[l], -len(l)))
+                self.by_literal.setdefault(literal, []).append(position)
+            else:
+                self.unconditional.append(position)
+        self.finder=None
+        if self.by_literal:
+            self.finder, self.trie = _trie_regex(self.by_literal)
+
+    def candidates(self, values):
+        """Returns the positions of the rules that may match one of values"""
+        found=set(self.unconditional)
+        if self.finder:
+            for v in values:
+                for m in self.finder.finditer(v):
+                    # every literal that is a prefix of the found one occurs too
+                    node=self.trie
+                    literal=""
+                    for c in m.group(1):
+                        node=node[c]
+                        literal+=c
+                        if "" in node:
+                            found.update(self.by_literal[literal])
+        return found
+
+    def first(self, values):
+        """Returns the position of the first rule that one of values satisfies, or None"""
+        for position in sorted(self.candidates(values)):
+            compiled=self.compiled[position]
+            for v in values:
+                if compiled.match(v):
+                    return position
+        return None
+
+
+class RuleSet():
+    """RuleSet: The ArchiveRules, compiled once
+
+    The rules are sorted by priority (highest first, the order in the
+    configuration breaks ties) and their regexes are precompiled, so that
+    matching a message only reads the headers that the rules test, once.
+
+    The rules that consist of a single regex are indexed per header. Rules
+    that pin an exact value or angle-bracket id (see _exact_key) go in a
+    dict keyed by that value, the others in a _HeaderMatcher: one lookup
+    per <...> token and one pass over the values of a header yield the
+    first of those rules that matches. Other rules (several conditions or
+    an empty regex) are tested one by one.
+
+    rules: list of CompiledRule in the order in which they are tried
+    headers: lowercased names of all headers that are tested
+    by_header: dict with the rules that test a header, by lowercased name
+    exact: dict with per lowercased header name a dict of key: rule positions
+    matchers: dict with the _HeaderMatcher per lowercased header name
+    sequential: positions in rules of the rules that are tested one by one
+    """
+
+    def __init__(self, rules):
+        """Initiallize
+
+        rules: list of rule dicts from the configuration
+        raises re.error if one of the regexes does not compile
+        """
+        self.rules=sorted((CompiledRule(r) for r in rules), key=lambda r: r.priority, reverse=True)
+        self.by_header={}
+        for rule in self.rules:
+            for header, regex, compiled in rule.conditions:
+                tested=self.by_header.setdefault(header.lower(), [])
+                if rule not in tested:
+                    tested.append(rule)
+        self.headers=set(self.by_header)
+
+        self.sequential=[]
+        self.exact={}
+        indexed={}
+        for position, rule in enumerate(self.rules):
+            if len(rule.conditions) == 1 and rule.conditions[0][2] is not None:
+                header, regex, compiled = rule.conditions[0]
+                key=_exact_key(regex)
+                if key:
+                    self.exact.setdefault(header.lower(), {}).setdefault(key, []).append(position)
+                else:
+                    indexed.setdefault(header.lower(), []).append((position, regex, compiled))
+            else:
+                self.sequential.append(position)
+        self.matchers=dict((header, _HeaderMatcher(members)) for header, members in indexed.items())
+
+    def header_values(self, mc):
+        """Returns a dict with the values of the tested headers in message mc"""
+        values={}
+        for header in self.headers:
+            found=mc.get_all(header)
+            if found:
+                values[header]=[str(v) for v in found]
+        return values
+
+    def matching(self, mc):
+        """Generator yielding the rules that match message mc, in priority order"""
+        values=self.header_values(mc)
+        hits=set()
+        for header, keys in self.exact.items():
+            if header in values:
+                found=set()
+                for v in values[header]:
+                    for key in _angle_token_pattern.findall(v) + [v.strip()]:
+                        found.update(keys.get(key, ()))
+                for position in sorted(found):
+                    compiled=self.rules[position].conditions[0][2]
+                    if any(compiled.match(v) for v in values[header]):
+                        hits.add(position)
+                        break
+        for header, matcher in self.matchers.items():
+            if header in values:
+                position=matcher.first(values[header])
+                if position is not None:
+                    hits.add(position)
+        for position in sorted(hits.union(self.sequential)):
+            rule=self.rules[position]
+            if position in hits or rule.matches(values):
+                yield rule
+                # Only the first match is known per header: when more
+                # matches are wanted the remaining rules are tested one by one
+                for rule in self.rules[position+1:]:
+                    if rule.matches(values):
+                        yield rule
+                return
+
+
+
+
+class HeaderCache():
+    """HeaderCache: On-disk cache of message headers
+
+    The header fields of scanned messages are stored in an SQLite database
+    keyed by (account, mailbox, UID). The UIDVALIDITY of every mailbox is
+    kept as well: when it changes the UIDs have been reassigned by the
+    server and all cached headers of that mailbox are dropped. The same
+    happens when the cached header fields of a mailbox do not include all
+    fields that are now needed.
+
+    A HeaderCache can be shared by threads, the database is used by one
+    thread at a time. Several HeaderCaches (e.g. of different accounts)
+    can use the same file, a write waits for the others to finish.
+
+    filename: name of the SQLite database file
+    account: string identifying the account (e.g. user@server)
+    fields: set of lowercased header names that are cached, None for all
+    """
+
+    def __init__(self, filename, account='', fields=None):
+        """Initiallize
+
+        filename: name of the SQLite database file, created when needed
+        account: string identifying the account (e.g. user@server)
+        fields: set of lowercased header names that are cached, None for all
+        """
+        self.account=account
+        self.fields=fields
+        self.fieldset=' '.join(sorted(fields)) if fields is not None else None
+        self.lock=threading.Lock()
+        self.db=sqlite3.connect(os.path.expanduser(filename), timeout=60, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS mailboxes ("
+                        "account TEXT, mailbox TEXT, uidvalidity INTEGER, "
+                        "PRIMARY KEY (account, mailbox))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS headers ("
+                        "account TEXT, mailbox TEXT, uid INTEGER, fields TEXT, "
+                        "PRIMARY KEY (account, mailbox, uid))")
+        # Synchronisation state (CONDSTORE) added to older cache files
+        columns=[row[1] for row in self.db.execute("PRAGMA table_info(mailboxes)")]
+        for column, sqltype in (('highestmodseq', 'INTEGER'), ('uidnext', 'INTEGER'), ('criteria', 'TEXT'),
+                                ('fieldset', 'TEXT')):
+            if column not in columns:
+                self.db.execute("ALTER TABLE mailboxes ADD COLUMN %s %s" % (column, sqltype))
+        self.db.commit()
+
+    def set_uidvalidity(self, mailbox, uidvalidity):
+        """Records the UIDVALIDITY of mailbox, drops its headers when it changed
+
+        The headers are dropped as well when they were cached with fewer
+        header fields than are needed now.
+
+        Returns True if the cached headers of the mailbox are still valid
+        """
+        with self.lock:
+            row=self.db.execute("SELECT uidvalidity, fieldset FROM mailboxes WHERE account=? AND mailbox=?",
+                                (self.account, mailbox)).fetchone()
+            if row and row[0] == uidvalidity:
+                if row[1] is None:
+                    covered=True  # All fields were cached
+                else:
+                    covered=self.fields is not None and self.fields <= set(row[1].split())
+                if covered:
+                    # From now on only self.fields are cached
+                    self.db.execute("UPDATE mailboxes SET fieldset=? WHERE account=? AND mailbox=?",
+                                    (self.fieldset, self.account, mailbox))
+                    self.db.commit()
+                    return True
+            self.db.execute("DELETE FROM headers WHERE account=? AND mailbox=?",
+                            (self.account, mailbox))
+            self.db.execute("INSERT OR REPLACE INTO mailboxes (account, mailbox, uidvalidity, fieldset) VALUES (?,?,?,?)",
+                            (self.account, mailbox, uidvalidity, self.fieldset))
+            self.db.commit()
+            return False
+
+    def get_state(self, mailbox):
+        """Returns (highestmodseq, uidnext, criteria) as recorded for mailbox, Nones if unknown"""
+        with self.lock:
+            row=self.db.execute("SELECT highestmodseq, uidnext, criteria FROM mailboxes WHERE account=? AND mailbox=?",
+                                (self.account, mailbox)).fetchone()
+        if not row:
+            return (None, None, None)
+        return tuple(row)
+
+    def set_state(self, mailbox, highestmodseq, uidnext, criteria='ALL'):
+        """Records the state of mailbox that the cached headers reflect
+
+        highestmodseq, uidnext: as reported by the server when the mailbox was selected
+        criteria: the SEARCH criteria that selected the cached messages
+        """
+        with self.lock:
+            self.db.execute("UPDATE mailboxes SET highestmodseq=?, uidnext=?, criteria=? WHERE account=? AND mailbox=?",
+                            (highestmodseq, uidnext, criteria, self.account, mailbox))
+            self.db.commit()
+
+    def uids(self, mailbox):
+        """Returns the set of UIDs (as strings) cached for mailbox"""
+        with self.lock:
+            return set(str(row[0]) for row in
+                       self.db.execute("SELECT uid FROM headers WHERE account=? AND mailbox=?",
+                                       (self.account, mailbox)))
+
+    def iterate(self, mailbox, uids=None, batch_size=500):
+        """Generator yielding a MessageContainer for every cached message of mailbox
+
+        The rows are read batch_size at a time, so that the database is
+        not locked while the messages are processed.
+
+        uids: if given, only these UIDs are yielded
+        """
+        if uids is not None:
+            uids=set(str(int(u)) for u in uids)
+        last=-1
+        while True:
+            with self.lock:
+                rows=self.db.execute("SELECT uid, fields FROM headers WHERE account=? AND mailbox=? AND uid>? "
+                                     "ORDER BY uid LIMIT ?",
+                                     (self.account, mailbox, last, batch_size)).fetchall()
+            if not rows:
+                return
+            for uid, fields in rows:
+                last=uid
+                uid=str(uid)
+                if uids is None or uid in uids:
+                    yield MessageContainer(uid, fields=json.loads(fields), wanted=self.fields)
+
+    def store(self, mailbox, containers):
+        """Stores the header fields of MessageContainer objects for mailbox"""
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO headers (account, mailbox, uid, fields) VALUES (?,?,?,?)",
+                                ((self.account, mailbox, int(mc.get_uid()), json.dumps(list(mc.raw_items())))
+                                 for mc in containers))
+            self.db.commit()
+
+    def forget(self, mailbox, uids):
+        """Removes the cached headers of uids (e.g. after they were moved)"""
+        with self.lock:
+            self.db.executemany("DELETE FROM headers WHERE account=? AND mailbox=? AND uid=?",
+                                ((self.account, mailbox, int(u)) for u in uids))
+            self.db.commit()
+
+    def prune(self, mailbox, uids):
+        """Removes the cached headers of messages that are no longer in mailbox
+
+        uids: the UIDs currently in the mailbox
+        """
+        current=set(str(int(u)) for u in uids)
+        self.forget(mailbox, [u for u in self.uids(mailbox) if u not in current])
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+
+
+
+
+
 #Shamelessly copied from
 # http://stackoverflow.com/questions/3041986/python-command-line-yes-no-input
 
@@ -144,38 +2507,74 @@ def query_yes_no(question, default="no"):
 class ImapNode():
     """ImapNode
 
-    children: array of ImapNode Children
+    children: tuple of ImapNode Children (in the order they were added),
+              use add_child or add_path to add one
+    nodes: dict with name: ImapNode of the children
     parent: parent of the node
     name: name of the node
     number_of_messages
+
+    The root node keeps an index with the full path of every node in
+    the tree, so that lookup() does not walk the tree.
     """
 
     def add_path(self,fullname,flags=[],number_of_messages=0):
-        path=fullname.split(self.delimiter)
-        childname=path.pop(0)
+        """Adds the node fullname (relative to this node) and the nodes above it
+
+        Returns the child of this node on the way to fullname
+        """
+        node=self
         child=None
-        if self.children:
-            for c in self.children:
-                if c.name == childname:
-                    if path:
-                        c.add_path(self.delimiter.join(path),flags,number_of_messages)
-                        child=c
-                        break
-        if not child:    
-                 child=ImapNode(name=childname,parent=self,delimiter=self.delimiter,depth=self.depth+1, flags=flags, number_of_messages=number_of_messages)
-                 self.children.append(child)
-                 if path:
-                     child.add_path(self.delimiter.join(path),flags,number_of_messages)
+        for childname in fullname.split(self.delimiter):
+            new=childname not in node.nodes
+            if new:
+                node.add_child(ImapNode(name=childname,parent=node,delimiter=self.delimiter,depth=node.depth+1,
+                                        flags=flags, number_of_messages=number_of_messages))
+            node=node.nodes[childname]
+            if child is None:
+                child=node
+        if not new:
+            # Listed after one of its children
+            node.flags=flags
+            node.number_of_messages=number_of_messages
         return child
 
-        
+    def add_child(self, node):
+        """Adds node, of which this node is the parent, as a child
+
+        The node is entered in the index of the root as well.
+        """
+        if node.parent is not self:
+            raise Exception("%s is not a child of %s" % (node.path(), self.path()))
+        self.nodes[node.name]=node
+        self.root.index[node.path()]=node
+
+    @property
+    def children(self):
+        return tuple(self.nodes.values())
+
     def set_delimiter(self,delimiter):
+        if delimiter == self.delimiter:
+            return
         self.delimiter=delimiter
+        # The paths below this node change with the delimiter
+        for node in self.walk():
+            node.delimiter=delimiter
+            node._set_path()
+        self.root.index=dict((node.path(), node) for node in self.root.walk() if node.parent)
+
+    def walk(self):
+        """Generator that yields the nodes below this node, depth first, parents before children"""
+        stack=list(reversed(self.children))
+        while stack:
+            node=stack.pop()
+            yield node
+            stack.extend(reversed(node.children))
 
     def recursive_print(self):
         print (self)
-        for i in self.children:
-            i.recursive_print()
+        for i in self.walk():
+            print (i)
         return
 
 
@@ -189,17 +2588,24 @@ class ImapNode():
         
         self.name=name
         self.parent=parent
-        self.children=[]
+        self.nodes={}
         self.number_of_messages= number_of_messages
         self.delimiter=delimiter
         self.depth=depth
         self.flags=flags
-        parentname=""
         if parent:
-            parentname=parent.name
-            pass
-        
-        #print (f'Initialized {parentname} -> {self.name} ({" ".join(flags)})')
+            self.root=parent.root
+        else:
+            self.root=self
+            self.index={}
+        self._set_path()
+
+    def _set_path(self):
+        # The path is made once, from the path of the parent
+        if self.parent and self.parent.path():
+            self._path=self.parent.path() + self.delimiter + self.name
+        else:
+            self._path=self.name
 
     def delete_empty_branches(self, connection):
         """delete the node  and all its child nodes if there are no messages in the branch
@@ -221,44 +2627,44 @@ class ImapNode():
                 print ("Failed to delete directory")
                 print (resp)
 
+    def iter_child_mailboxes(self):
+        """Generator that yields the path to the mailboxes that contain any messages"""
+        nodes=self.walk() if self.nodes else [self]
+        for node in nodes:
+            if node.nodes:
+                continue
+            if "NoInferiors" in node.flags or "HasNoChildren" in node.flags:
+                if node.number_of_messages:
+                    yield node.path()
+            else:
+                print (f"Empty mailbox {node.path()}")
+
     def child_mailboxes(self):
         """Returns an array with the path to the mailboxes that contain any messages
         """
-        mailboxes=[]
-        if self.children:
-            for i in self.children:
-                mailboxes= mailboxes + i.child_mailboxes()
-        elif "NoInferiors" in self.flags or "HasNoChildren" in self.flags:
-            if self.number_of_messages:
-                mailboxes.append(self.path())
-        else:
-            print (f"Empty mailbox {self.path()}")
-        return mailboxes
+        return list(self.iter_child_mailboxes())
         
 
     def findnode(self,fullname):
         "Returns an ImapMode instance that is located at fullname, or None"""
-        path=fullname.split(self.delimiter)
-        if path:
-            childname=path.pop(0)
-            # We need to go into depth
-            for c in self.children:
-                if c.name == childname:
-                    node=c.findnode(self.delimiter.join(path))
-                    if node:
-                        return node
-                    else:
-                        return c
-        else:
-            return None
+        # The deepest node on the way to fullname is returned when
+        # fullname itself is not there (see lookup() for an exact match)
+        node=None
+        nodes=self.nodes
+        for childname in fullname.split(self.delimiter):
+            c=nodes.get(childname)
+            if c is None:
+                break
+            node=c
+            nodes=c.nodes
+        return node
+
+    def lookup(self,fullname):
+        """Returns the ImapNode with the full path fullname, or None"""
+        return self.root.index.get(fullname)
             
     def path(self):
-        path=""
-        if self.parent and self.parent.path():
-            path=self.parent.path() + self.delimiter + self.name
-        else:
-            path=self.name
-        return path
+        return self._path
         
     def __repr__(self):
         #def __repr__(self):
@@ -280,4 +2686,3 @@ class ImapNode():
             
         return ('%s  [%s] : %s' % (self.path(),  children, other))
                                     
-
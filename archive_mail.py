@@ -8,20 +8,27 @@ on a particular rule set and a few heuristics
 """
 
 from OMK_imap_tools_lib import *
-from pprint import pprint
 from progressbar import *         
 import yaml
 import logging
 import re
-from time import (mktime)
+from time import (perf_counter, sleep)
 from datetime import datetime, timedelta
 import argparse
-import keyring
+import asyncio
+import collections
+import concurrent.futures
+import imaplib
+import io
+import itertools
+import json
+import os
+import signal
+import sys
+import threading
 from cerberus import Validator
 
 
-logging.basicConfig(level = logging.DEBUG, filename="tmp.log")
-
 #demaplib.Debug  =  4
 
 
@@ -34,62 +41,63 @@ logging.basicConfig(level = logging.DEBUG, filename="tmp.log")
 
 
 
-def _match_against_regex(mc,regex_array):
-    # mc: the message container
-    # the regex_array datastructure:
-    #    Regexps:
-    #           type: list
-    #           schema:
-    #             type: dict
-    #             schema:
-    #              header:
-    #                type: string
-    #              regex:
-    #                type: string
-    
-    matches = 0
-    expected_matches = len (regex_array)
-    logging.debug(f"Match against Regex: {expected_matches} matches expected")
-    
-    for i in list(regex_array):
-        header=i["header"]
-        regex=i["regex"]
-        try:
-            try:
-                logging.debug(f'{header}: {mc.get(header)}    c:{regex}')
-            except UnicodeDecodeError:
-                logging.debug(f'h {header}: c: UNICODE ERROR')
-                
-            if not regex and not mc.get_all(header):
-                logging.debug(f"found match for {header}: NOT IN HEADER")
-                matches += 1
+def _literal_of_regex(regex):
+    # Returns the literal string that regex looks for anywhere in a
+    # header (regexes of the form .*literal or .*literal.*) or None.
+    # A "." in the literal is taken as a literal dot.
+    m = re.fullmatch(r"\.\*(.*?)(\.\*)?", regex, re.DOTALL)
+    if not m:
+        return None
+    literal = ""
+    body = m.group(1)
+    i = 0
+    while i < len(body):
+        c = body[i]
+        if c == "\\":
+            if i+1 < len(body) and not body[i+1].isalnum():
+                literal += body[i+1]
+                i += 2
                 continue
-
-            elif  regex and mc.get_all(header):
-                for h in mc.get_all(header):    
-                    if re.match(regex,h,re.DOTALL)!=None:
-                        logging.debug(f"found match for {header}: {mc.get(h)}")
-                        matches += 1
-                        logging.debug(f"expected {expected_matches}, actual {matches}")
-                        continue
-            else:
-                pass
-            
-
-        except (re.error, e):
-            print (f"Error in regexp against {header} : {regex}")
-            print (e)
-            exit (0) 
-        
-    logging.debug(f"After all matches I expected {expected_matches}, and got actual {matches}")
-    
-    if expected_matches == matches:
-        return True
-    else:
-        return False
-pass
-#END FUNCTION
-
+            return None
+        if c in "^$*+?{}[]|()":
+            return None
+        literal += c
+        i += 1
+    if not literal or not literal.isascii() or not literal.isprintable():
+        return None
+    return literal
+
+
+def _plan_server_side_rules(rules, box, delimiter):
+    # Returns the leading rules of the RuleSet, in priority order, that
+    # the server can evaluate with UID SEARCH HEADER: Flat rules of which
+    # every regex is a literal substring (or empty, for an absent header).
+    # Evaluation stops at the first rule that needs the headers, so that
+    # first match wins still holds. The server compares case-insensitively
+    # and may decode MIME words, so its hits are to be checked against
+    # the compiled regexes (see Account._server_rule_destination).
+    # Returns a list of (rule, destination_path_elements, search keys) tuples
+    planned = []
+    for rule in rules.rules:
+        if rule.rule.get("DestinationArchivePolicy", "Flat") != "Flat":
+            break
+        destination_path_elements = rule.rule["DestinationArchive"].split("/")
+        if delimiter.join(destination_path_elements).startswith(box + delimiter):
+            continue # Never applied to messages in box
+        keys = []
+        for header, regex, compiled in rule.conditions:
+            if not regex:
+                keys.extend(["NOT", "HEADER", imap_quote(header), '""'])
+                continue
+            literal = _literal_of_regex(regex)
+            if literal is None:
+                break
+            keys.extend(["HEADER", imap_quote(header), imap_quote(literal)])
+        else:
+            planned.append((rule, destination_path_elements, keys))
+            continue
+        break
+    return planned
 
 
 def _create_rule_based_destination(mc,rule):
@@ -117,56 +125,1180 @@ def _create_rule_based_destination(mc,rule):
     else:
         # Treat as Flat
         pass
-    logging.debug("Destination set to " + "/".join(destination_path_elements)) 
+    if log_debug:
+        logging.debug("Destination set to %s", "/".join(destination_path_elements))
     return (destination_path_elements)
 pass
-            
+
+
+def _frequent_hints(hints):
+    # Returns the keys of the hints shared by 5 or more messages, least
+    # frequent first
+    sorted_hints= sorted(hints, key=lambda i: hints[i][2])
+    return [i for i in sorted_hints if hints[i][2] >= 5]
+
+
+def _print_report(box, destinations, hints, present, out=sys.stdout):
+    # Prints what was done with the messages of box and the hints
+    # (keys in present) about headers that unmatched messages share
+    if destinations and movethem:
+        print ("\nDone", file=out)
+    else:
+        # There were no destinations.. i.e. no matches
+        print ("\n(Nothing to be) Done", file=out)
+
+    print ("Potential Other Lists", file=out)
+
+    for i in present:
+        header=hints[i][0]
+        content=hints[i][1]
+        messagecont=hints[i][3]
+        print ("---------------------------------------------", file=out)
+        print (f"{header}\":\"{content}\"", file=out)
+        print (f'Similar messages: {hints[i][2]}', file=out)
+        print (f'Subject: {messagecont.get("Subject")}', file=out)
+        print (f'Date: {messagecont.get("Date")}', file=out)
+        print (f'To: {messagecont.get("To")}', file=out)
+        print ("---------------------------------------------\n", file=out)
+    #print Results
+    print (f"Harverst for {box}: ", file=out)
+    if destinations:
+        for (path,mv_data_list) in list(destinations.items()):
+            if not movethem:
+                print("I would have moved", end='', file=out)
+            else:
+                print ("- Moved", end='', file=out)
+            print (f" {mv_data_list[1]} messages to {path}", file=out)
+    else:
+        print ("No luck", file=out)
+
+
+def _leave_mailbox(connection):
+    # Leaves the selected mailbox, without expunging it when the server
+    # has UNSELECT
+    if connection.state != 'SELECTED':
+        return
+    if 'UNSELECT' in connection.capabilities:
+        connection.unselect()
+    else:
+        connection.close()
+
+
+def _search_uids(msg_ids):
+    # Returns the UIDs (as strings) in the response to UID SEARCH
+    return [msguid.decode("utf-8") for msguid in msg_ids[0].split()]
+
+
+def _undated(messages):
+    # Returns the UIDs of the MessageContainers in messages of which the
+    # Date cannot be parsed
+    return [mc.get_uid() for mc in messages if mc.get_datetime() is None]
+
+
+class MailboxScan():
+    """MailboxScan: What is done while a mailbox is archived, apart from talking to the server
+
+    _archive_mailbox and _archive_mailbox_async only differ in how they
+    talk to the server: they send the commands and hand the responses to
+    a MailboxScan. It decides whether the header cache is still valid,
+    which headers are fetched and which searches the server does for the
+    server side rules, classifies the messages, queues them on move_queue
+    and keeps the cache, the metrics and the report up to date.
+
+    account: Account of which a mailbox is archived
+    box: name of the mailbox
+    move_queue: MoveQueue or AsyncMoveQueue for the selected mailbox
+    msgarray: list of UIDs of the messages to scan, None until it is known
+    cached: set of the UIDs of which the header is taken from the cache
+    tofetch: list of the UIDs of which the header is fetched
+    server_fields: set of the fields that the server side rules test
+    hints: dict with hints about the unmatched messages (see _classify_message)
+    """
+
+    def __init__(self, account, box, delimiter, move_queue, out=sys.stdout, progress=sys.stderr):
+        """Initiallize
+
+        account: Account of which a mailbox is archived
+        box: name of the mailbox
+        delimiter: hierarchy delimiter of the server
+        move_queue: MoveQueue or AsyncMoveQueue for the mailbox
+        out: file to which the report is printed
+        progress: file to which the progress bar is printed
+        """
+        self.started=perf_counter()
+        self.account=account
+        self.box=box
+        self.delimiter=delimiter
+        self.move_queue=move_queue
+        self.out=out
+        self.progress=progress
+        self.highestmodseq=None
+        self.uidnext=None
+        self.known=set()
+        self.msgarray=None
+        self.cached=set()
+        self.tofetch=[]
+        self.planned=None
+        self.server_fields=set()
+        self.hits=set()
+        self.server_matched=set()
+        self.hints={}
+        self.fetched=[]
+        self.index=0
+        self.classify_seconds=0.0
+        self.pbar=None
+
+    def selected(self, connection, typ, mb):
+        """Takes the response to SELECT of the mailbox
+
+        Returns the modseq since which the changes are to be fetched (see
+        fetch_changes_since and changes()), or None.
+        """
+        account=self.account
+        if typ != "OK":
+            raise Exception("Could not select %s (%s)"% (self.box,typ))
+        if  int(mb[0]) == 0:
+            raise Exception("Nothing")
+        uidval = connection.response('UIDVALIDITY')
+        self.highestmodseq = response_number(connection, 'HIGHESTMODSEQ')
+        self.uidnext = response_number(connection, 'UIDNEXT')
+
+        # With CONDSTORE the cache knows which messages were in the
+        # mailbox at the last run. If nothing changed since then no SEARCH
+        # is needed, with QRESYNC only the changes since then are asked for.
+        if not account.cache:
+            return None
+        if not account.cache.set_uidvalidity(self.box, int(uidval[1][0])):
+            logging.debug("No valid header cache for %s (UIDVALIDITY %s)", self.box, uidval[1][0])
+        last_modseq, last_uidnext, last_criteria = account.cache.get_state(self.box)
+        if account.condstore and self.highestmodseq and last_modseq and last_criteria == account.search_criteria:
+            self.known = account.cache.uids(self.box)
+            # When every message is searched the cache holds them all,
+            # so their number tells whether another client expunged some
+            if (self.highestmodseq == last_modseq and self.uidnext == last_uidnext
+                    and (account.search_criteria != 'ALL' or len(self.known) == int(mb[0]))):
+                logging.info("%s unchanged since modseq %s", self.box, last_modseq)
+                self.msgarray = sorted(self.known, key=int)
+            elif account.condstore == 'QRESYNC':
+                return last_modseq
+        return None
+
+    def changes(self, modseq, changed, vanished):
+        """Takes the messages that changed and vanished since modseq"""
+        logging.info("%s since modseq %s: %d changed, %d vanished", self.box, modseq, len(changed), len(vanished))
+        self.account.cache.forget(self.box, vanished)
+        self.msgarray = sorted((self.known - set(vanished)) | set(changed), key=int)
+
+    def searched(self, msg_ids, unparseable=None):
+        """Takes the response to UID SEARCH search_criteria
+
+        unparseable: UIDs of the young messages of which the Date cannot
+                     be parsed (see _unparseable_dates), None without
+                     young_criteria
+        """
+        self.msgarray = _search_uids(msg_ids)
+        if unparseable is not None:
+            self.msgarray = sorted(set(self.msgarray) | set(unparseable), key=int)
+        if self.account.cache:
+            self.account.cache.prune(self.box, self.msgarray)
+
+    def plan(self):
+        """Decides which headers are taken from the cache and which are fetched
+
+        Returns the UID SEARCH commands (for a pipeline) that let the
+        server match the literal rules against the messages of which the
+        headers are not known yet, or None.
+        """
+        account=self.account
+        if args.breakpoint >0:
+            self.msgarray=self.msgarray[:args.breakpoint]   #USE WHILE DEVELOPING
+
+        if account.cache:
+            self.cached=account.cache.uids(self.box).intersection(self.msgarray)
+        self.tofetch=[msguid for msguid in self.msgarray if msguid not in self.cached]
+        logging.info("%d messages in %s taken from the cache, %d to fetch", len(self.cached), self.box,
+                     len(self.tofetch))
+
+        # Let the server match the literal rules against the messages of
+        # which the headers are not known yet. The searches are pipelined.
+        # Only the fields that those rules test are fetched for the hits,
+        # a hit is moved if the compiled regexes agree with the server, the
+        # other hits are scanned like any other message.
+        if not (account.server_side_rules and self.tofetch):
+            return None
+        self.planned=_plan_server_side_rules(account.rules, self.box, self.delimiter)
+        self.server_fields=set(header.lower() for rule, destination_path_elements, keys in self.planned
+                               for header, regex, compiled in rule.conditions)
+        return ((rule, 'SEARCH',
+                 ['UID', uidset, 'SENTBEFORE', imap_date(account.old_enough)] + keys)
+                for rule, destination_path_elements, keys in self.planned
+                for uidset in uid_sets(self.tofetch, account.max_command_length-len(' '.join(keys))-64))
+
+    def server_searched(self, typ, data):
+        """Takes the response to one of the searches of plan()"""
+        if typ != 'OK':
+            raise Exception("Failed to search %s: %s" % (self.box, data))
+        self.hits.update(_search_uids(data))
+
+    def server_hits(self):
+        """Returns the UIDs found by the searches, of which server_fields are to be fetched"""
+        return sorted(self.hits, key=int)
+
+    def server_fetched(self, mc):
+        """Moves server hit mc if the compiled regexes agree with the server"""
+        destination_path_elements=self.account._server_rule_destination(mc, self.planned, self.box,
+                                                                        self.delimiter)
+        if destination_path_elements:
+            self.server_matched.add(mc.get_uid())
+            self.move_queue.add(destination_path_elements, [mc.get_uid()])
+
+    def start(self):
+        """Starts the scan, after the server side rules"""
+        if self.planned is not None:
+            logging.info("%d messages in %s matched by %d rules on the server (%d hits)",
+                         len(self.server_matched), self.box, len(self.planned), len(self.hits))
+            self.tofetch=[msguid for msguid in self.tofetch if msguid not in self.server_matched]
+
+        # Set up Progress Bar
+        widgets = ['Scanning %s: ' % self.box,
+                   SimpleProgress(), ' ',
+                   Bar(marker='=',left='[',right=']'),
+                   ' ', ETA(), ' '] #see docs for other options
+
+        self.pbar  =  ProgressBar(maxval = len(self.cached)+len(self.tofetch),widgets = widgets, fd = self.progress)
+        self.pbar.start()
+        self.account.metrics.add_phase('scan', perf_counter()-self.started)
+
+    def classify(self, mc):
+        """Classifies message mc and queues it for its destination
+
+        The messages are handed over in order: first the cached ones, then
+        the fetched ones, which are stored in the cache in batches.
+        """
+        account=self.account
+        self.pbar.update(self.index)
+        if account.cache and self.index >= len(self.cached):
+            self.fetched.append(mc)
+            if len(self.fetched) >= account.fetch_batch_size:
+                account.cache.store(self.box, self.fetched)
+                self.fetched=[]
+        self.index+=1
+        classify_started=perf_counter()
+        destination_path_elements=account._classify_message(mc, self.box, self.delimiter, self.hints, self.out)
+        self.classify_seconds+=perf_counter()-classify_started
+        if destination_path_elements:
+            self.move_queue.add(destination_path_elements, [mc.get_uid()])
+
+    def scanned(self):
+        """Ends the scan, after the last message was classified"""
+        if self.fetched:
+            self.account.cache.store(self.box, self.fetched)
+            self.fetched=[]
+        self.pbar.finish()
+        self.account.metrics.add_phase('classify', self.classify_seconds)
+
+    def moved(self, moved):
+        """Takes the UIDs that move_queue.finish() returned"""
+        account=self.account
+        account.metrics.add_phase('move', self.move_queue.seconds)
+        if account.cache:
+            account.cache.forget(self.box, moved)
+        # The cache now holds every message of the mailbox as of
+        # highestmodseq, except for those matched on the server that
+        # were not moved.
+        if account.cache and self.highestmodseq and not args.breakpoint and (movethem or not self.server_matched):
+            account.cache.set_state(self.box, self.highestmodseq, self.uidnext, account.search_criteria)
+
+    def hinted(self):
+        """Returns (key, UID) for the frequent hints, of which is checked whether the message is still there"""
+        return [(i, self.hints[i][3].get_uid()) for i in _frequent_hints(self.hints)]
+
+    def report(self, present):
+        """Prints the report, with the hints of which the key is in present"""
+        _print_report(self.box, self.move_queue.destinations, self.hints, present, self.out)
+
+
+class Account():
+    """Account: Archives the mailboxes of an account on an IMAP server
+
+    The settings come from a configuration file, or from one of the
+    accounts listed in it. Accounts with the same ArchiveRules share the
+    compiled rules. Several accounts can run side by side, each in a
+    thread of its own.
+    """
+
+    def __init__(self, configuration_data, rules, header_fields, out=sys.stdout, progress=sys.stderr):
+        """Initiallize
+
+        configuration_data: validated configuration of the account
+        rules: RuleSet of the ArchiveRules
+        header_fields: set of the (lowercased) header fields that are kept for the scanned messages
+        out: file to which the reports are printed
+        progress: file to which the progress bars are written
+        """
+        self.configuration_data=configuration_data
+        self.rules=rules
+        self.header_fields=header_fields
+        self.out=out
+        self.progress=progress
+
+        self.server   = configuration_data["connection"]["server"]
+        self.username = configuration_data["connection"]['user']
+        self.port     = configuration_data["connection"].get('port', 993)
+        self.use_ssl  = configuration_data["connection"].get('ssl', True)
+        self.name     = configuration_data.get('name', f"{self.username}@{self.server}")
+
+        # Mailboxes from which messages are moved, with the mailboxes below them
+        self.mailboxes = configuration_data['mailbox']
+        if isinstance(self.mailboxes, str):
+            self.mailboxes=[self.mailboxes]
+        if args.mailbox:
+            self.mailboxes=args.mailbox
+
+        # Number of messages for which the headers are fetched with a single command
+        self.fetch_batch_size = configuration_data.get('FetchBatchSize', 500)
+        # Number of IMAP commands that are kept in flight on the connection
+        self.pipeline_depth = configuration_data.get('PipelineDepth', 4)
+        # Number of messages queued for a destination before they are moved
+        self.move_queue_size = configuration_data.get('MoveQueueSize', 500)
+        # Longest command line that is sent to the server
+        self.max_command_length = configuration_data.get('MaxCommandLength', 8000)
+        # Number of connections over which the mailboxes are processed
+        self.connections = configuration_data.get('Connections', 1)
+
+        # In daemon mode the messages that are too young to be archived are
+        # remembered until they are old enough
+        self.timers=None
+        if args.daemon:
+            self.timers=TimerQueue()
+
+        # Set up by run()
+        self.metrics=None
+        self.cache=None
+        self.condstore=None
+        self.pool=None
+
+    def _setup_connection(self, connection):
+        # Called for every new connection of the pool
+        instrument_connection(connection, self.metrics)
+        # Incremental synchronisation needs the cache to remember the mailbox state
+        if self.cache:
+            self.condstore = enable_condstore(connection)
+
+    def run(self):
+        """Archives the mailboxes of the account, with --daemon it keeps doing so
+
+        The connections of the account are reserved (see limits) for as
+        long as it runs, a daemon never hands them back: the daemons are
+        given connections that fit within the limit together.
+        """
+        reserved=limits.acquire(self.server, self.connections)
+        try:
+            self.connections=reserved
+            # The commands and the time per phase are counted for --metrics and --prometheus
+            self.metrics=ImapMetrics({'server': self.server, 'user': self.username})
+            # Headers of messages that were scanned in earlier runs are kept in a cache
+            if self.configuration_data.get('HeaderCache') and not args.nocache:
+                self.cache=HeaderCache(self.configuration_data['HeaderCache'],
+                                       account=f"{self.username}@{self.server}", fields=self.header_fields)
+            print (f"Connecting to: {self.server}", file=self.out)
+            self.pool = ConnectionPool(self.server, self.username, self.connections, self._setup_connection,
+                                       self.port, self.use_ssl)
+            try: # If anything fails close the connections gracefully
+                self._archive()
+            finally:
+                self.pool.close()
+                if self.cache:
+                    self.cache.close()
+        finally:
+            limits.release(self.server, reserved)
+
+    def _archive(self):
+        # Scans the structure below the source mailboxes and archives
+        # them, then keeps watching them with --daemon
+        ImapConnection = self.pool.get()
+        structure_started=perf_counter()
+        # The server selects the source mailboxes and the mailboxes below
+        # them (LIST "" "Archive" and LIST "" "Archive/*", pipelined), the
+        # excluded ones are left out here. The number of messages in the
+        # mailboxes comes with the LIST response when the server supports
+        # LIST-STATUS, otherwise the STATUS of the leaf mailboxes is asked
+        # for afterwards.
+        delimiter=hierarchy_delimiter(ImapConnection)
+        selection=MailboxSelection(self.mailboxes, self.configuration_data.get('ExcludeMailboxes', []), delimiter)
+        status_items=['MESSAGES', 'UIDNEXT', 'UIDVALIDITY']
+        if 'CONDSTORE' in ImapConnection.capabilities:
+            status_items.append('HIGHESTMODSEQ')
+        status=None
+        list_arguments=()
+        if 'LIST-STATUS' in ImapConnection.capabilities:
+            list_arguments=('RETURN', '(STATUS (%s))' % ' '.join(status_items))
+        listing=((pattern, 'LIST', ('""', pattern) + list_arguments) for pattern in selection.patterns())
+        data=[]
+        for pattern, typ, dat in ImapPipeline(ImapConnection, self.pipeline_depth).run(listing):
+            if typ != "OK":
+                raise Exception(f"Could not read {pattern}")
+            data.extend(line for line in dat if isinstance(line, bytes) and line)
+        if list_arguments:
+            status=parse_status_response(ImapConnection.response('STATUS')[1])
+
+        # Set up Progress Bar
+        widgets = ['Scanning structure ', 
+                   SimpleProgress(), ' ', 
+                   Bar(marker='=',left='[',right=']'),
+                   ' ', ETA(), ' '] #see docs for other options
+         
+        pbar  =  ProgressBar(maxval = len(data),widgets = widgets, fd = self.progress)
+        pbar.start()        
+        #scann the whole lot.
+        RootNode=ImapNode("")
+        found={}
+        for i in range(len(data)):
+            line=data[i].decode('utf-8')
+            logging.debug ("line: %s", line)
+            pbar.update(i)
+            pflags, pdelimiter, pmailbox= parse_list_response(line)
+            RootNode.set_delimiter(pdelimiter)
+            if pmailbox in selection:
+                found[pmailbox]=flag_pattern.findall(pflags)
+
+        for source in self.mailboxes:
+            source_selection=MailboxSelection([source], [], delimiter)
+            if not any(pmailbox in source_selection for pmailbox in found):
+                print (f"Mailbox {source} doesn't exist", file=self.out)
+        if not found:
+            return
+
+        # Only the leaf mailboxes are counted
+        leaves=[pmailbox for pmailbox, theflags in found.items()
+                if "NoInferiors" in theflags or "HasNoChildren" in theflags]
+        if status is None:
+            status=mailbox_status(ImapConnection, leaves, status_items, self.pipeline_depth)
+        for pmailbox, theflags in found.items():
+            n=0
+            if pmailbox in leaves:
+                if pmailbox not in status:
+                    raise Exception("Could not read %s"%pmailbox)
+                logging.debug ("status of %s: %s", pmailbox, status[pmailbox])
+                n=status[pmailbox].get('MESSAGES', 0)
+            RootNode.add_path(pmailbox, flags= theflags, number_of_messages=n)
+
+        pbar.finish()
+        self.metrics.add_phase('structure', perf_counter()-structure_started)
+
+        # The folders below the top level folders of the destinations are
+        # listed when the first message is moved
+        self.folders=FolderRegistry(delimiter, self._destination_roots(RootNode.delimiter))
+
+        # Only the messages that can be older than OlderThen days are
+        # selected on the server. IMAP dates have no time or timezone,
+        # hence the margin of two days, the exact age is tested later on.
+        # Messages without a Date header are selected as well so that they
+        # reach the Unknown-Date-Destination. So are the messages of which
+        # the Date cannot be parsed, see _unparseable_dates.
+        # The daemon needs to see the young messages to schedule them.
+        self.search_criteria='ALL'
+        self.young_criteria=None
+        if self.configuration_data.get('ServerSideAgeFilter') and not args.daemon:
+            cutoff=(datetime.now() - timedelta(days=self.configuration_data["OlderThen"])).date() + timedelta(days=2)
+            self.search_criteria=f'OR NOT SENTSINCE {imap_date(cutoff)} NOT HEADER Date ""'
+            self.young_criteria=f'SENTSINCE {imap_date(cutoff)} HEADER Date ""'
+
+        # Rules that only look for literal strings in headers can be
+        # evaluated by the server, for messages that are surely old enough.
+        self.server_side_rules=self.configuration_data.get('ServerSideRules')
+        if self.server_side_rules:
+            self.old_enough=((datetime.now() - timedelta(days=self.configuration_data["OlderThen"])).date()
+                             - timedelta(days=1))
+
+        boxes=RootNode.child_mailboxes()
+        if args.asynchronous:
+            asyncio.run(self._archive_mailboxes_async(boxes, RootNode.delimiter))
+        elif self.connections > 1 and len(boxes) > 1:
+            # Every mailbox is processed on a connection of its own, the
+            # reports are printed in mailbox order.
+            self.pool.put(ImapConnection)
+            print (f"Processing {len(boxes)} mailboxes over {self.connections} connections", file=self.out)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.connections) as executor:
+                reports=[executor.submit(self._archive_mailbox_pooled, box, RootNode.delimiter)
+                         for box in boxes]
+                for report in reports:
+                    print (report.result(), end='', file=self.out)
+        else:
+            for box in boxes:
+                self._archive_mailbox(ImapConnection, box, RootNode.delimiter, self.out, self.progress)
+
+        if args.daemon:
+            # The source mailboxes are watched from now on, also the empty ones
+            if not args.asynchronous and self.connections > 1 and len(boxes) > 1:
+                ImapConnection = self.pool.get()
+            uidnext=dict((box, status.get(box, {}).get('UIDNEXT', 1)) for box in leaves)
+            self._run_daemon(ImapConnection, leaves, RootNode.delimiter, uidnext)
+
+    def _destination_roots(self, delimiter):
+        # Returns the set of top level folders of the destinations
+        destinations=[delimiter.join(rule["DestinationArchive"].split("/"))
+                      for rule in self.configuration_data['ArchiveRules']]
+        for key in ('List-Id-Destination', 'Date-Destination', 'Unknown-Date-Destination'):
+            if self.configuration_data.get(key):
+                destinations.append(self.configuration_data[key])
+        return set(destination.split(delimiter)[0] for destination in destinations)
+
+
+    def _classify_message(self, mc, box, delimiter, hints, out):
+        # Returns the destination_path_elements for message mc in box, or
+        # None if the message stays where it is. Date failures are
+        # reported to out, with the rest of the report of box. The first rule that
+        # matches (in priority order) determines the destination, after
+        # that the List-Id heuristics and the date are tried.
+        # Unmatched messages are counted in the hints dict:
+        # key: [header, value, number of messages, first message, last message]
+        # The debug logging in here is skipped unless it is enabled, it
+        # would otherwise cost more than the classification itself.
+
+        if log_debug:
+            logging.debug("------------------------------------")
+            logging.debug('Assessing %s: "%s" (%s)', mc.get_uid(), mc.get("Subject"), mc.get("Date"))
+
+        try: #Sometimes date parsing fails
+            if  (( datetime.now() -  mc.get_datetime() ) <
+                 timedelta (days = self.configuration_data["OlderThen"])):
+                if log_debug:
+                    logging.debug('Message is younger than %s (%s)', self.configuration_data["OlderThen"],
+                                  mc.get("Date"))
+                if self.timers is not None:
+                    # The daemon archives it once it is old enough
+                    self.timers.schedule(mc.get_datetime()
+                                         + timedelta(days=self.configuration_data["OlderThen"], seconds=1),
+                                         box, mc)
+                if decision_log:
+                    decision_log.write(account=self.name, mailbox=box, uid=mc.get_uid(),
+                                       action='keep', reason='younger')
+                return None
+        except TypeError: 
+            print ("datetime failure", file=out)
+            mc.moved= self.configuration_data['Unknown-Date-Destination']
+            if decision_log:
+                decision_log.write(account=self.name, mailbox=box, uid=mc.get_uid(),
+                                   action='move', reason='unknown-date', destination=mc.moved)
+            return self.configuration_data['Unknown-Date-Destination'].split(delimiter)
+
+        #
+        # Parse all Rules
+        # The first rule that matches (in priority order) determines the destination
+        for rule in self.rules.matching(mc):
+            if log_debug:
+                logging.debug("creating rule %s", rule.name)
+            destination_path_elements=_create_rule_based_destination(mc,rule.rule);
+            destination_path= delimiter.join(destination_path_elements)
+            if re.match(r"\s", destination_path):
+                raise Exception(
+                    "Better review the destination, it contains a space: %s" %
+                    destination_path)
+
+            if re.match("^"+box+delimiter, destination_path):
+                logging.info ("You are trying to move to the same or a subfolder of %s", box)
+                continue
+
+            # Store destination with message might come in
+            # handy
+            mc.moved=destination_path
+            if decision_log:
+                decision_log.write(account=self.name, mailbox=box, uid=mc.get_uid(),
+                                   action='move', reason='rule', rule=rule.name, destination=destination_path)
+            return destination_path_elements
+        # All rules are parsed.
+
+        destination_path_elements = []
+        reason='list-id'
+        if mc.get("List-Id"):
+            # These generic all.ietf.org  and attendees.ietf.org lists all go to all.ietf.org or attendees.ietf.org
+            m = re.search('<?.*((all|attendees|newcomers|reg)\.(mail\.)?ietf\.org)>?\s*$', mc.get("List-Id"))
+            if m and not destination_path_elements:
+                if log_debug:
+                    logging.debug("1 Matched *(all|attendees|newcommers).ietf.org with %s", m.group(1))
+                destination_path_elements= [
+                    self.configuration_data['List-Id-Destination'],
+                    m.group(1)
+                    ]
+
+        if mc.get("List-Id"):
+            # Typical mailchimp
+            # List-ID: 10b02e112ca0db3806c3cdfd4mc list <10b02e112ca0db3806c3cdfd4.16513.list-id.mcsv.net>
+            m = re.search('(.*) list <?((\w|-)*(\.(\w|-)*)*)>?\s*$', mc.get("List-Id"))
+            if m and not destination_path_elements and mc.get("Reply-To"):
+                p = re.search('<?.*@((\w|-)*(\.(\w|-)*)*)>?\s*$', mc.get("Reply-To"))
+                if log_debug:
+                    logging.debug("1 Matched Mailchimp with %s", p.group(1))
+                destination_path_elements= [
+                    self.configuration_data['List-Id-Destination'],
+                    p.group(1)
+                    ]
+
+        if mc.get("List-Id"):
+            # Typical other type of list
+            # List-ID: <7296028.xt.local> get the domain part from the FROM address.
+            m = re.search('<.*\.xt\.local>\s*$', mc.get("List-Id"))
+            if m and not destination_path_elements and mc.get("Reply-To"):
+                p = re.search('<?.*@((\w|-)*(\.(\w|-)*)*)>?\s*$', mc.get("Reply-To"))
+                if log_debug:
+                    logging.debug("1 Matched Mailchimp with %s", p.group(1))
+                destination_path_elements= [
+                    self.configuration_data['List-Id-Destination'],
+                    p.group(1)
+                    ]
+
+            # Match anything that vaguely looks like a domain name in <> brackets
+            m = re.search('<?((\w|-)*(\.(\w|-)*)*)>?\s*$', mc.get("List-Id"))
+            if m and not destination_path_elements:
+                if log_debug:
+                    logging.debug("2 Matched List-ID with %s", m.group(1))
+                destination_path_elements= [
+                    self.configuration_data['List-Id-Destination'],
+                    m.group(1)
+                    ]
+
+        if not destination_path_elements:   
+
+            # The message was not matched Fill a datastructure
+            # for hints about Headers that are Unique
+            # After that Date based archive
+            for header in ["List-Id",
+                           "Reply-To",
+                           "List-Unsubscribe",
+                           "Return-Path",
+                           "Delivered-To",
+                           "X-Env-Sender",
+                           "Delivered-To",
+                           "Envelope-To",
+                           ]:
+                if mc.get(header):
+                    key='%s -- %s'%(header,mc.get(header))
+                    if key  in hints:
+                        if not (hints[key][4]==mc):
+                            hints[key][2]+=1
+                            hints[key][4]=mc
+                            break
+                    else:
+                        hints[key] = [header,mc.get(header),1,mc,mc]
+                        if log_debug:
+                            logging.debug("Keep UID %s", mc.get_uid())
+
+            dest_year=mc.get_datetime().year
+            destination_path_elements= [
+                self.configuration_data['Date-Destination'],
+                str(dest_year)  #,dest_quarter
+                ]
+            reason='date'
+
+        destination_path= delimiter.join(destination_path_elements)
+
+        if re.match(r"\s", destination_path):
+            raise Exception(
+                "Better review the destination, it contains a space: %s" %
+                destination_path)
+
+        if re.match("^"+box, destination_path):
+            # print "You are trying to move to the same or a subfolder of %s" % box
+            if decision_log:
+                decision_log.write(account=self.name, mailbox=box, uid=mc.get_uid(),
+                                   action='keep', reason='same-mailbox', destination=destination_path)
+            return None
+
+        mc.moved=destination_path
+        if decision_log:
+            decision_log.write(account=self.name, mailbox=box, uid=mc.get_uid(),
+                               action='move', reason=reason, destination=destination_path)
+        return destination_path_elements
+
+
+    def _server_rule_destination(self, mc, planned, box, delimiter):
+        # Returns the destination_path_elements of the first of the planned
+        # rules that message mc matches, or None. The server found mc with
+        # one of them, but SEARCH HEADER ignores case and matches decoded
+        # text, so the hit only counts if the compiled regexes agree.
+        values=self.rules.header_values(mc)
+        for rule, destination_path_elements, keys in planned:
+            if rule.matches(values):
+                if decision_log:
+                    decision_log.write(account=self.name, mailbox=box, uid=mc.get_uid(),
+                                       action='move', reason='server-rule',
+                                       destination=delimiter.join(destination_path_elements))
+                return destination_path_elements
+        return None
+
+    def _unparseable_dates(self, connection):
+        # Returns the UIDs of the messages in the selected mailbox that the
+        # age filter leaves out although their Date cannot be parsed: a
+        # server may take the arrival time for their date. Only the Date
+        # field of the recent messages is fetched to find them.
+        typ, msg_ids = connection.uid('search', None, self.young_criteria)
+        return _undated(fetch_message_headers(connection, _search_uids(msg_ids), self.fetch_batch_size,
+                                              self.pipeline_depth, set(['date']), self.max_command_length))
+
+    async def _unparseable_dates_async(self, connection):
+        # Coroutine version of _unparseable_dates for an AsyncImapConnection
+        typ, msg_ids = await connection.uid('search', self.young_criteria)
+        return _undated([mc async for mc in fetch_message_headers_async(connection, _search_uids(msg_ids),
+                                                                        self.fetch_batch_size, set(['date']),
+                                                                        self.max_command_length)])
+
+    def _archive_mailbox(self, connection, box, delimiter, out=sys.stdout, progress=sys.stderr):
+        # Scans mailbox box through connection and moves the messages that
+        # are matched. The report is printed to out, the progress bar to
+        # progress, so that mailboxes can be processed side by side.
+        # The messages are queued per destination while the mailbox is
+        # scanned. A destination is moved to as soon as its queue holds
+        # move_queue_size messages, the rest is moved at the end.
+        # What is done with the responses is up to the MailboxScan.
+        move_queue=MoveQueue(connection, delimiter, self.move_queue_size, self.pipeline_depth,
+                             movethem, self.folders, self.max_command_length)
+        scan=MailboxScan(self, box, delimiter, move_queue, out, progress)
+        typ, mb = connection.select(box,readonly=False)
+        modseq=scan.selected(connection, typ, mb)
+        if modseq:
+            scan.changes(modseq, *fetch_changes_since(connection, modseq))
+        if scan.msgarray is None:
+            # Get all message UIDs (or those of the messages old enough)
+            typ, msg_ids = connection.uid('search',None, self.search_criteria)
+            scan.searched(msg_ids, self._unparseable_dates(connection) if self.young_criteria else None)
+
+        searches=scan.plan()
+        if searches is not None:
+            for rule, typ, data in ImapPipeline(connection,self.pipeline_depth).run(searches):
+                scan.server_searched(typ, data)
+            for mc in fetch_message_headers(connection, scan.server_hits(), self.fetch_batch_size,
+                                            self.pipeline_depth, scan.server_fields, self.max_command_length):
+                scan.server_fetched(mc)
+        scan.start()
+
+        # Scan all messages in the box: first the cached ones, then the
+        # ones of which the headers are fetched, in batches of
+        # fetch_batch_size messages. Every message is classified as soon
+        # as its header is there.
+        messages=fetch_message_headers(connection,scan.tofetch,self.fetch_batch_size,self.pipeline_depth,
+                                       self.header_fields,self.max_command_length)
+        if scan.cached:
+            messages=itertools.chain(self.cache.iterate(box, scan.cached), messages)
+        for mc in self.metrics.timed('scan', messages):
+            scan.classify(mc)
+        scan.scanned()
+
+        # Move what is left in the queues and expunge the mailbox
+        scan.moved(move_queue.finish())
+
+        # Only the hints of which the message is still there are shown
+        with self.metrics.phase('hints'):
+            present=[]
+            for i, uid in scan.hinted():
+                typ,response = connection.uid('fetch',uid,'FAST')
+                if response[0]:
+                    present.append(i)
+            scan.report(present)
+
+
+    async def _archive_mailbox_async(self, connection, box, delimiter, out=sys.stdout, progress=sys.stderr):
+        # Coroutine version of _archive_mailbox for an AsyncImapConnection.
+        # Destinations are moved to by tasks of their own while the scan
+        # goes on, and other mailboxes can be archived on the same event loop.
+        move_queue=AsyncMoveQueue(connection, delimiter, self.move_queue_size, movethem, self.folders,
+                                  self.max_command_length)
+        scan=MailboxScan(self, box, delimiter, move_queue, out, progress)
+        typ, mb = await connection.select(imap_quote(box),readonly=False)
+        modseq=scan.selected(connection, typ, mb)
+        if modseq:
+            scan.changes(modseq, *await fetch_changes_since_async(connection, modseq))
+        if scan.msgarray is None:
+            typ, msg_ids = await connection.uid('search', self.search_criteria)
+            scan.searched(msg_ids, await self._unparseable_dates_async(connection) if self.young_criteria else None)
+
+        searches=scan.plan()
+        if searches is not None:
+            async for rule, typ, data in connection.pipeline(searches):
+                scan.server_searched(typ, data)
+            async for mc in fetch_message_headers_async(connection, scan.server_hits(), self.fetch_batch_size,
+                                                        scan.server_fields, self.max_command_length):
+                scan.server_fetched(mc)
+        scan.start()
+
+        for mc in self.metrics.timed('scan', self.cache.iterate(box, scan.cached) if scan.cached else ()):
+            scan.classify(mc)
+        messages=fetch_message_headers_async(connection,scan.tofetch,self.fetch_batch_size,self.header_fields,
+                                             self.max_command_length)
+        async for mc in self.metrics.timed_async('scan', messages):
+            scan.classify(mc)
+        scan.scanned()
+
+        scan.moved(await move_queue.finish())
+
+        with self.metrics.phase('hints'):
+            present=[]
+            for i, uid in scan.hinted():
+                typ,response = await connection.uid('fetch',uid,'FAST')
+                if response[0]:
+                    present.append(i)
+            scan.report(present)
+
+
+    async def _archive_mailboxes_async(self, boxes, delimiter):
+        # Archives boxes on one event loop over up to self.connections
+        # AsyncImapConnections, each of which takes the next mailbox when it
+        # is done with one. The reports are printed in mailbox order.
+        todo=collections.deque(boxes)
+        reports={}
+        workers=min(self.connections, len(boxes))
+
+        async def worker():
+            connection=await open_async_connection(self.server, self.username, self.pool.password, self.port,
+                                                   self.use_ssl, self.pipeline_depth, self.metrics)
+            try:
+                if self.condstore:
+                    await enable_condstore_async(connection)
+                while todo:
+                    box=todo.popleft()
+                    out=io.StringIO()
+                    if workers == 1:
+                        await self._archive_mailbox_async(connection, box, delimiter, out, self.progress)
+                    else:
+                        with open(os.devnull, 'w') as progress:
+                            await self._archive_mailbox_async(connection, box, delimiter, out, progress)
+                    reports[box]=out.getvalue()
+            finally:
+                await connection.logout()
+
+        try:
+            await asyncio.gather(*(worker() for i in range(workers)))
+        finally:
+            for box in boxes:
+                if box in reports:
+                    print (reports[box], end='', file=self.out)
+
+
+    def _archive_messages(self, connection, box, delimiter, messages):
+        # Classifies messages (MessageContainers of box, which is selected)
+        # and moves the ones that have a destination. Used by the daemon,
+        # messages that are still too young are scheduled again.
+        move_queue=MoveQueue(connection, delimiter, self.move_queue_size, self.pipeline_depth,
+                             movethem, self.folders, self.max_command_length)
+        hints={}
+        for mc in messages:
+            destination_path_elements=self._classify_message(mc, box, delimiter, hints, self.out)
+            if destination_path_elements:
+                move_queue.add(destination_path_elements, [mc.get_uid()])
+        moved=move_queue.finish()
+        if self.cache:
+            self.cache.forget(box, moved)
+        if move_queue.destinations:
+            _print_report(box, move_queue.destinations, hints, [], self.out)
+
+
+    def _archive_new_messages(self, connection, box, delimiter, first_uid):
+        # Archives the messages of box with a UID of first_uid or higher,
+        # returns the UID from which the next new message will be
+        typ, mb = connection.select(box,readonly=False)
+        if typ != "OK":
+            raise Exception("Could not select %s (%s)"% (box,typ))
+        uidnext = response_number(connection, 'UIDNEXT') or first_uid
+        # UID n:* always includes the last message, also when its UID is below n
+        typ, msg_ids = connection.uid('search', None, 'UID %d:*' % first_uid)
+        msgarray = [msguid.decode("utf-8") for msguid in msg_ids[0].split() if int(msguid) >= first_uid]
+        logging.info("%d new messages in %s", len(msgarray), box)
+        messages = list(fetch_message_headers(connection, msgarray, self.fetch_batch_size, self.pipeline_depth,
+                                              self.header_fields, self.max_command_length))
+        if self.cache and messages:
+            self.cache.store(box, messages)
+        self._archive_messages(connection, box, delimiter, messages)
+        return max([uidnext] + [int(msguid)+1 for msguid in msgarray])
+
+
+    def _run_daemon(self, connection, watched, delimiter, uidnext):
+        # Keeps connection open and archives the messages of the watched
+        # mailboxes as they arrive, or when they become older than
+        # OlderThen (see timers). New messages are waited for with NOTIFY
+        # and IDLE when the server has them, with IDLE alone when a single
+        # mailbox is watched, and otherwise by polling the UIDNEXT of the
+        # mailboxes with STATUS every PollInterval seconds.
+        # uidnext: dict with per watched mailbox the UID of the next new message
+        # Returns only when interrupted, a broken connection is replaced.
+        idle_timeout = self.configuration_data.get('IdleTimeout', 1500)
+        poll_interval = self.configuration_data.get('PollInterval', 300)
+        notify = None
+        recheck = False
+        while True:
+            try:
+                if notify is None:
+                    notify = False
+                    if 'NOTIFY' in connection.capabilities and 'IDLE' in connection.capabilities:
+                        typ, dat = connection._simple_command(
+                            'NOTIFY', 'SET (mailboxes (%s) (MessageNew MessageExpunge))' %
+                            ' '.join(imap_quote(box) for box in watched))
+                        notify = typ == 'OK'
+                    if notify:
+                        how = "NOTIFY"
+                    elif len(watched) == 1 and 'IDLE' in connection.capabilities:
+                        how = "IDLE"
+                    else:
+                        how = f"STATUS every {poll_interval} seconds"
+                    print (f"Watching {len(watched)} mailboxes with {how}, {len(self.timers)} messages scheduled",
+                           file=self.out)
+
+                for box, messages in self.timers.pop_due(datetime.now()).items():
+                    typ, mb = connection.select(box,readonly=False)
+                    if typ == "OK":
+                        self._archive_messages(connection, box, delimiter, messages)
+                    recheck = True
+
+                timeout = idle_timeout
+                due = self.timers.next_due()
+                if due is not None:
+                    timeout = min(timeout, max(1, (due - datetime.now()).total_seconds()))
+
+                changed = []
+                if notify and not recheck:
+                    # Changes of mailboxes that are not selected come as STATUS responses
+                    _leave_mailbox(connection)
+                    if idle(connection, timeout):
+                        status = parse_status_response(connection.response('STATUS')[1])
+                        connection.response('EXISTS')
+                        changed = [box for box in watched if status.get(box, {}).get('UIDNEXT', 0) > uidnext[box]]
+                elif how == "IDLE":
+                    box = watched[0]
+                    connection.select(box,readonly=False)
+                    # The EXISTS of the SELECT itself is no change, a message
+                    # that came in while others were archived shows in UIDNEXT
+                    connection.response('EXISTS')
+                    if ((response_number(connection, 'UIDNEXT') or 0) > uidnext[box]
+                            or 'EXISTS' in idle(connection, timeout)):
+                        changed = [box]
+                elif notify:
+                    # A SELECT drops the STATUS responses that came before
+                    # it: after archiving, the mailboxes are looked at once
+                    _leave_mailbox(connection)
+                    status = mailbox_status(connection, watched, ['UIDNEXT'], self.pipeline_depth)
+                    changed = [box for box in watched if status.get(box, {}).get('UIDNEXT', 0) > uidnext[box]]
+                else:
+                    _leave_mailbox(connection)
+                    sleep(min(timeout, poll_interval))
+                    status = mailbox_status(connection, watched, ['UIDNEXT'], self.pipeline_depth)
+                    changed = [box for box in watched if status.get(box, {}).get('UIDNEXT', 0) > uidnext[box]]
+
+                for box in changed:
+                    uidnext[box] = self._archive_new_messages(connection, box, delimiter, uidnext[box])
+                recheck = bool(changed)
+            except (imaplib.IMAP4.abort, OSError) as e:
+                logging.warning("Connection to %s lost (%s), reconnecting", self.server, e)
+                sleep(10)
+                connection = self.pool.replace(connection)
+                notify = None
+
+
+    def _archive_mailbox_pooled(self, box, delimiter):
+        # Runs _archive_mailbox on a connection taken from the pool and returns
+        # its report. The progress bars of concurrent mailboxes are not shown.
+        connection=self.pool.get()
+        out=io.StringIO()
+        try:
+            with open(os.devnull, 'w') as progress:
+                self._archive_mailbox(connection, box, delimiter, out, progress)
+        finally:
+            self.pool.put(connection)
+        return out.getvalue()
+
+
+def _load_configuration(filename):
+    # Returns the configuration data in YAML file filename, after
+    # checking it against the schema. Exits when it is not usable.
+    try:
+        with open(filename, 'rb') as fp:
+            configuration_data = yaml.load(fp,Loader=yaml.SafeLoader)
+
+        logging.debug("Opened Configurationa File: %s", filename)
+    except IOError:
+        print (f"Error: Configuration file {filename} cannot be opened")
+        exit(0)
+    except ValueError as e:
+        print (f"Error: Check your YAML config file for errors:\n      {e}")
+        exit(0)
+
+    if not v.validate(configuration_data):
+        print(f"Error: Configuration file {filename} does not comply to the scheme")
+        print(v.errors)
+        exit(0)
+    return configuration_data
+
+
+def _compile_rules(archive_rules, filename):
+    # Returns the RuleSet of archive_rules (from configuration file
+    # filename) and the header fields that are kept for the scanned
+    # messages. Rules are compiled once: configuration files with the
+    # same ArchiveRules share the RuleSet.
+    key=json.dumps(archive_rules, sort_keys=True)
+    if key in compiled_rules:
+        return compiled_rules[key]
+
+    try:
+        rules=RuleSet(archive_rules)
+    except re.error as e:
+        print (f"\nERROR Parsing config\nInvalid regular expression in ArchiveRules: {e}\n\n")
+        exit(0)
+
+    # Only these header fields are kept for the scanned messages: the ones the
+    # rules test, the ones used by the List-Id heuristics and the hints,
+    # and the ones that are printed.
+    header_fields=rules.headers | set(h.lower() for h in [
+        "List-Id",
+        "Reply-To",
+        "List-Unsubscribe",
+        "Return-Path",
+        "Delivered-To",
+        "X-Env-Sender",
+        "Envelope-To",
+        "Subject",
+        "To",
+        "Date",
+        ])
+
+    for rule in list(archive_rules):
+        for p in rule['DestinationArchive']:
+            try:
+                if re.search('\s',p):
+                    raise Exception (
+                        "Rule has Destination with space\n" + 
+                        "Look for string \"%s\" in %s" % (p, filename) )
+            except Exception as e:
+                print (f"\nERROR Parsing config\n{e}\n\n")
+                exit(0)
+
+    compiled_rules[key]=(rules, header_fields)
+    return compiled_rules[key]
+
+
+def _account_configurations(configuration_data, filename):
+    # Returns the configuration of every account in configuration_data
+    # (from configuration file filename): the file itself, or when it
+    # has a list of accounts, the file with the settings of each of them.
+    # The connection of an account adds to that of the file, so that
+    # e.g. only the user needs to be given per account.
+    accounts=configuration_data.get('accounts')
+    if not accounts:
+        accounts=[configuration_data]
+    else:
+        defaults=dict((key, value) for key, value in configuration_data.items() if key not in ('accounts', 'name'))
+        accounts=[dict(defaults, **dict(account, connection=dict(configuration_data.get('connection', {}),
+                                                                 **account.get('connection', {}))))
+                  for account in accounts]
+    for account in accounts:
+        if not account.get('connection', {}).get('server') or not account['connection'].get('user'):
+            print (f"Error: Configuration file {filename} has no server or user in connection")
+            exit(0)
+    return accounts
+
+
+def _run_account(account):
+    # Runs account, one of several, and returns its report when it is
+    # printed to a buffer. A failing account does not stop the others,
+    # the failure ends up in its report.
+    print (f"\n=== {account.name} ===", file=account.out)
+    try:
+        account.run()
+    except Exception as e:
+        logging.error("Archiving %s failed: %s", account.name, e)
+        print (f"ERROR: Archiving {account.name} failed: {e}", file=account.out)
+    if isinstance(account.out, io.StringIO):
+        return account.out.getvalue()
+    return ''
+
+
 ##########################################################3
 
 
 ##########
 #  Parse commandLine
 parser = argparse.ArgumentParser()
-parser.add_argument("YAMLconfig",help="name of YAML configuration file")
+parser.add_argument("YAMLconfig", nargs="+",
+                    help="name of YAML configuration file, several can be given (each with one or more accounts)")
 parser.add_argument("-b", "--breakpoint", type=int, default=0,
                     help="break after scanning BREAK messages")
 parser.add_argument("-n", "--nomove",  action="store_true", default=False,
                     help="do all the work, except moving the messages")
 
-parser.add_argument("-m", "--mailbox", 
-                    help="Use this mailbox instead of the configured one")
+parser.add_argument("-m", "--mailbox", action="append",
+                    help="Use this mailbox instead of the configured ones (can be repeated)")
+parser.add_argument("--nocache",  action="store_true", default=False,
+                    help="do not use the header cache")
+parser.add_argument("--async", dest="asynchronous", action="store_true", default=False,
+                    help="process the mailboxes with asyncio, over Connections connections")
+parser.add_argument("--metrics", metavar="FILE",
+                    help="write a JSON summary of the IMAP commands and the time per phase to FILE (- for stdout),"
+                         " a list of them when there are several accounts")
+parser.add_argument("--prometheus", metavar="FILE",
+                    help="write the metrics to FILE in the Prometheus textfile format")
+parser.add_argument("-v", "--verbose", action="count", default=0,
+                    help="log more: -v for what is done per mailbox, -vv for every message as well")
+parser.add_argument("--logfile", metavar="FILE",
+                    help="write the log to FILE instead of to stderr")
+parser.add_argument("--daemon", action="store_true", default=False,
+                    help="keep running: archive messages as they arrive and as they become old enough")
+parser.add_argument("--decision-log", metavar="FILE",
+                    help="append what is decided for every message to FILE, one JSON object per line")
+parser.add_argument("--parallel", type=int, default=4, metavar="N",
+                    help="number of accounts that are archived at the same time (default 4)")
+parser.add_argument("--max-connections-per-server", type=int, metavar="N",
+                    help="number of connections to a server that all accounts together may use")
 args = parser.parse_args()
+if args.parallel < 1 or (args.max_connections_per_server is not None and args.max_connections_per_server < 1):
+    parser.error("--parallel and --max-connections-per-server need at least 1")
 
-############################
-# Load and test the config file
-
-try:
-    with open(args.YAMLconfig, 'rb') as fp:
-        configuration_data = yaml.load(fp,Loader=yaml.SafeLoader)
-
-    logging.debug(f"Opened Configurationa File: {args.YAMLconfig}")
-except IOError:
-    print (f"Error: Configuration file {args.YAMLconfig} cannot be opened")
-    exit(0)
-except ValueError as e:
-    print (f"Error: Check your YAML config file for errors:\n      {e}")
-    exit(0)
-pass
-
-#pprint(configuration_data)
-
+logging.basicConfig(level = [logging.WARNING, logging.INFO, logging.DEBUG][min(args.verbose, 2)],
+                    filename = args.logfile)
+# The debug logging per message is only done when it is enabled,
+# its arguments are not even looked up otherwise
+log_debug = logging.getLogger().isEnabledFor(logging.DEBUG)
 
 raw_schema_yaml ="""
 name:
     type: string
 mailbox:
-    type: string
+    type: [string, list]
+    schema:
+        type: string
+ExcludeMailboxes:
+    type: list
+    schema:
+        type: string
 List-Id-Destination:
     type: string
 Date-Destination:
     type: string
 OlderThen:
     type: integer
+FetchBatchSize:
+    type: integer
+    min: 1
+PipelineDepth:
+    type: integer
+    min: 1
+MoveQueueSize:
+    type: integer
+    min: 1
+MaxCommandLength:
+    type: integer
+    min: 200
+Connections:
+    type: integer
+    min: 1
+HeaderCache:
+    type: string
+ServerSideAgeFilter:
+    type: boolean
+ServerSideRules:
+    type: boolean
+IdleTimeout:
+    type: integer
+    min: 10
+PollInterval:
+    type: integer
+    min: 1
 Unknown-Date-Destination:
     type: string
 connection:
@@ -176,6 +1308,10 @@ connection:
         type: string
       user:
         type: string
+      port:
+        type: integer
+      ssl:
+        type: boolean
 ArchiveRules:
     type: list
     required: true
@@ -210,465 +1346,101 @@ ArchiveRules:
 """
 
 schema = yaml.load(raw_schema_yaml,Loader=yaml.SafeLoader)
+# An account in accounts can have every setting of the file, except for
+# the rules: those are shared by the accounts of a file
+schema['accounts'] = {'type': 'list', 'schema': {'type': 'dict', 'schema':
+                          dict((key, value) for key, value in schema.items() if key != 'ArchiveRules')}}
 
 ##pprint (schema)
 
 v = Validator(schema)
 
-if not v.validate(configuration_data):
-    print(f"Error: Configuration file {args.YAMLconfig} does not comply to the scheme")
-    print(v.errors)
-    exit(0)
-
-
-
-for rule in list(configuration_data['ArchiveRules']):
-    for p in rule['DestinationArchive']:
-        try:
-            if re.search('\s',p):
-                raise Exception (
-                    "Rule has Destination with space\n" + 
-                    "Look for string \"%s\" in %s" % (p, args.YAMLconfig) )
-        except Exception as e:
-            print (f"\nERROR Parsing config\n{e}\n\n")
-            exit(0)
-
 
 
 ############################
-# Connect to the server
-server   = configuration_data["connection"]["server"]
-username = configuration_data["connection"]['user']
+# Load the config files, every one with one or more accounts
 
+# The RuleSets, keyed by their ArchiveRules (see _compile_rules)
+compiled_rules={}
 
-mailbox  = configuration_data['mailbox']
-if args.mailbox:
-    mailbox=args.mailbox
+configurations=[]
+for filename in args.YAMLconfig:
+    configuration_data=_load_configuration(filename)
+    rules, header_fields=_compile_rules(configuration_data['ArchiveRules'], filename)
+    for account_data in _account_configurations(configuration_data, filename):
+        configurations.append((account_data, rules, header_fields))
 
 movethem=not args.nomove
 
-RootNode=ImapNode("")
-print (f"Connecting to: {server}")
-ImapConnection = open_connection_to_IMAPServer(server,username)
-
-try: # If anything fails close the connection gracefully
-    typ, data = ImapConnection.list(mailbox)
-    if typ != "OK":
-        raise Exception("Could not read {mailbox}")
-    if not data[0]:
-        print (f"Nonexistent mailbox: {mailbox}")
-        exit(0)
-
-    # Set up Progress Bar
-    widgets = ['Scanning structure ', 
-               SimpleProgress(), ' ', 
-               Bar(marker='=',left='[',right=']'),
-               ' ', ETA(), ' '] #see docs for other options
-     
-    pbar  =  ProgressBar(maxval = len(data),widgets = widgets)
-    pbar.start()        
-    #scann the whole lot.
-    matchfound=0
-    for i in range(len(data)):
-        line=data[i].decode('utf-8')
-        logging.debug (f"line: {line}")
-        pbar.update(i)
-        #print(line)
-        pflags, pdelimiter, pmailbox= parse_list_response(line)
-        RootNode.set_delimiter(pdelimiter)
-        f=re.compile("\w+")
-        theflags=f.findall(pflags)
-        logging.info (f"evaluating {pmailbox} against {mailbox} delimiter: {pdelimiter}")
-        # We only want the exact mailbox, or its children
-        mre=re.compile("^"+mailbox+"("+pdelimiter+".*)?$")
-        if not mre.match(pmailbox):
-            continue
-        else:
-            matchfound=1
-
-        n=0
-        if "NoInferiors" in theflags or "HasNoChildren" in theflags:
-            typ, mb = ImapConnection.select(pmailbox,readonly=True)
-            if typ != "OK":
-                raise Exception("Could not read %s"%pmailbox)
-            uidval = ImapConnection.response('UIDVALIDITY')
-            typ, msg_ids = ImapConnection.uid('search',None, 'ALL')
-            n=len(msg_ids[0].split())
-            ImapConnection.close()
-        RootNode.add_path(pmailbox, flags= theflags, number_of_messages=n)
-
-
-    pbar.finish()
-    if not matchfound:
-        print (f"Mailbox {mailbox} doesn't exist")
-        exit(0)
-        
-    node=RootNode.findnode(mailbox)
-    
-    for box in node.child_mailboxes():
-        msglist = []
-        typ, mb = ImapConnection.select(box,readonly=False)
-        if typ != "OK":
-            raise Exception("Could not select %s (%s)"% (mailbox,typ))
-        if  int(mb[0]) == 0:
-            raise Exception("Nothing")
-        uidval = ImapConnection.response('UIDVALIDITY')
-
-        # Get all message UIDs
-        typ, msg_ids = ImapConnection.uid('search',None, 'ALL')
-        msgarray = (msg_ids[0].split())
-
-
-        # Set up Progress Bar
-        widgets = ['Scanning %s: ' % box, 
-                   SimpleProgress(), ' ', 
-                   Bar(marker='=',left='[',right=']'),
-                   ' ', ETA(), ' '] #see docs for other options
-     
-        pbar  =  ProgressBar(maxval = len(msgarray),widgets = widgets)
-        pbar.start()        
-
-        # Scann all messages in the box and create an arracy with
-        # MessageContainer objects to work on later.
-        for index, msguid in enumerate(msgarray):
-            if args.breakpoint >0:
-                if index == args.breakpoint:
-                    break   #USE WHILE DEVELOPING
-            typ, msg_data = ImapConnection.uid('fetch',msguid,'(BODY.PEEK[HEADER] ENVELOPE)')
-            # DATA Structure in MSG_DATA
-            # [('1 (UID 127055 BODY[HEADER] {1669}', 'Return-Path: <kassa@
-            pbar.update(index)
-            hdr = msg_data[0][1]
-            mc=MessageContainer(msguid.decode("utf-8"),hdr.decode("utf-8"));
-            msglist.append(mc)
-            pass
-        pbar.finish()
-     
-        # Sort the lot, just for fun
-        try:
-            msglist.sort(key=lambda mc: mc.get_datetime())
-        except:
-            pass #just don't bork over it.
-         
-        # Initialize a Destination dict
-        # It is going to contain the name of a destination folders as key
-        # and message message container references as values
-        destinations = {}
-
-        # Initialize a hints dict
-        # It will contain List-IDs that can be filtered on
-        # Those can be used to adapt the configuration
-        hints={}
-
-
-        widgets = ['Matching rules: ', 
-                   Percentage(), ' ', 
-                   Bar(marker='=',left='[',right=']'),
-                   ' ', ETA(), ' '] #see docs for other options
-        
-        pbar  =  ProgressBar(maxval = len(msglist),widgets = widgets)
-        pbar.start()        
-        i=0
-
-
-        ############################
-        #
-        # Scan all mails by going through the list of message container objects
-        for mc in msglist:
-            pbar.update(i)
-            i+=1
-
-            logging.debug( "------------------------------------" )
-            logging.debug(f'Assessing {mc.get_uid()}: \"{mc.get("Subject")}\" ({mc.get("Date")})')
-
-            try: #Sometimes date parsing fails
-                if  (( datetime.now() -  mc.get_datetime() ) <
-                     timedelta (days = configuration_data["OlderThen"])):
-                    logging.debug( f'Message is younger than {configuration_data["OlderThen"]} ({mc.get("Date")})')
-                    
-                    continue
-            except TypeError: 
-                print ("datetime failure")
-
-                
-                destinations[configuration_data['Unknown-Date-Destination']]= [ configuration_data['Unknown-Date-Destination'].split(node.delimiter), [(mc.get_uid())]]
-                mc.moved= configuration_data['Unknown-Date-Destination']
-                continue
-                
-
-
-
-            logging.debug("processing UID %s"%mc.get_uid())
-            #
-            # Parse all Rules
-            if not mc.moved:             
-                PrioritizedRules = sorted(configuration_data['ArchiveRules'], key=lambda x: x['Priority'] , reverse=True)
-##                pprint (PrioritizedRules)
-                for rule in PrioritizedRules:
-                    destination_path_elements = []
-                    if _match_against_regex(mc,rule["Regexps"]):
-                        logging.debug("creating rule %s"% rule) 
-                        destination_path_elements=_create_rule_based_destination(mc,rule);
-                    if destination_path_elements: # no rulse matched. Just don't archive
-                        destination_path= node.delimiter.join(destination_path_elements)
-                        if re.match(r"\s", destination_path):
-                            raise Exception(
-                                "Better review the destination, it contains a space: %s" %
-                                destination_path)
-                        
-                        if re.match("^"+box+node.delimiter, destination_path):
-                            logging.info ("You are trying to move to the same or a subfolder of %s" % box)
-                            continue
-
-            
-                        # Store destination with message might come in
-                        # handy
-                        #print "Setting mc.moved to %s" % destination_path
-                        mc.moved=destination_path
-                        #print "Destination: %s" % destination_path
-                        # Fill the destinations dict
-                        if destination_path in destinations:
-                            destinations[destination_path][1].append(mc.get_uid())
-                        else:
-                            destinations[destination_path]= [destination_path_elements, [(mc.get_uid())]]
-                            break # Se are done with parsing rules for this message
-                # All rules are parsed.a
-
-            if not mc.moved:
-                if mc.get("List-Id"):
-                    # These generic all.ietf.org  and attendees.ietf.org lists all go to all.ietf.org or attendees.ietf.org
-                    m = re.search('<?.*((all|attendees|newcomers|reg)\.(mail\.)?ietf\.org)>?\s*$', mc.get("List-Id"))
-                    if m and not destination_path_elements:
-                        logging.debug("1 Matched *(all|attendees|newcommers).ietf.org with %s" % m.group(1))
-                        destination_path_elements= [
-                            configuration_data['List-Id-Destination'],
-                            m.group(1)
-                            ]
-                    
-                if mc.get("List-Id"):
-                    # Typical mailchimp
-                    # List-ID: 10b02e112ca0db3806c3cdfd4mc list <10b02e112ca0db3806c3cdfd4.16513.list-id.mcsv.net>
-                    m = re.search('(.*) list <?((\w|-)*(\.(\w|-)*)*)>?\s*$', mc.get("List-Id"))
-                    if m and not destination_path_elements and mc.get("Reply-To"):
-                        p = re.search('<?.*@((\w|-)*(\.(\w|-)*)*)>?\s*$', mc.get("Reply-To"))
-                        logging.debug("1 Matched Mailchimp with %s" % p.group(1))
-                        destination_path_elements= [
-                            configuration_data['List-Id-Destination'],
-                            p.group(1)
-                            ]
-                    
-
-
-
-                if mc.get("List-Id"):
-                    # Typical other type of list
-                    # List-ID: <7296028.xt.local> get the domain part from the FROM address.
-                    m = re.search('<.*\.xt\.local>\s*$', mc.get("List-Id"))
-                    if m and not destination_path_elements and mc.get("Reply-To"):
-                        p = re.search('<?.*@((\w|-)*(\.(\w|-)*)*)>?\s*$', mc.get("Reply-To"))
-                        logging.debug("1 Matched Mailchimp with %s" % p.group(1))
-                        destination_path_elements= [
-                            configuration_data['List-Id-Destination'],
-                            p.group(1)
-                            ]
-                    
-
-                            
-                    # Match anything that vaguely looks like a domain name in <> brackets
-                    m = re.search('<?((\w|-)*(\.(\w|-)*)*)>?\s*$', mc.get("List-Id"))
-                    if m and not destination_path_elements:
-                        logging.debug("2 Matched List-ID with %s" % m.group(1))
-                        destination_path_elements= [
-                            configuration_data['List-Id-Destination'],
-                            m.group(1)
-                            ]
-              
-                        
-                        
-
-                if not destination_path_elements:   
-
-                    # The message was not matched Fill a datastructure
-                    # for hints about Headers that are Unique
-                    # After that Date based archive
-                    for header in ["List-Id",
-                                   "Reply-To",
-                                   "List-Unsubscribe",
-                                   "Return-Path",
-                                   "Delivered-To",
-                                   "X-Env-Sender",
-                                   "Delivered-To",
-                                   "Envelope-To",
-                                   ]:
-                        if mc.get(header):
-                            key='%s -- %s'%(header,mc.get(header))
-                            if key  in hints:
-                                if not (hints[key][2][-1]==mc):
-                                    hints[key][2].append(mc)
-                                    break
-                            else:
-                                hints[key] = [header,mc.get(header),[mc] ]
-                                logging.debug("Keep UID %s"%mc.get_uid())
-                    
-
-                    dest_year=mc.get_datetime().year
-                    # dest_month=mc.get_datetime().month
-                    # if 1 <= dest_month <=3 :
-                    #    dest_quarter="Q1"
-                    # if 4 <= dest_month <=6 :
-                    #    dest_quarter="Q2"
-                    # if 7 <= dest_month <=9 :
-                    #    dest_quarter="Q3"
-                    # if 10 <= dest_month <=12 :
-                    #    dest_quarter="Q4"
-                
-                    destination_path_elements= [
-                        configuration_data['Date-Destination'],
-                        str(dest_year)  #,dest_quarter
-                        ]
-                
-                if destination_path_elements:
-                    destination_path= node.delimiter.join(destination_path_elements)
-
-                else:  
-                    continue  # no rulse matched. Just don't archive
-
-                if re.match(r"\s", destination_path):
-                    raise Exception(
-                        "Better review the destination, it contains a space: %s" %
-                        destination_path)
-
-                if re.match("^"+box, destination_path):
-                    # print "You are trying to move to the same or a subfolder of %s" % box
-                    continue
-
-                # Fill the destinations dict
-                if destination_path in destinations:
-                    destinations[destination_path][1].append(mc.get_uid())
-                else:
-                    destinations[destination_path]= [destination_path_elements, [(mc.get_uid())]]
-        #Done with  looking at all  messages and determining  whether they
-        #should be moved
-        pbar.finish()              
-
-        # All messages have been parsed.  Now move them to their
-        # destinations        move
-        if destinations and movethem:
-            widgets = ['Moving messages: ', Percentage(), ' ',
-                       Bar(marker='=',left='[',right=']'),' ',
-                       ETA(), ' '] #see docs for other options
-            numbertomove=0
-            for (key,mv_data_list) in list(destinations.items()):
-                numbertomove+=len(mv_data_list[1])
-
-            pbar = ProgressBar(maxval=numbertomove,widgets=widgets)
-            logging.debug(f"We need to move {numbertomove} messages" )
-
-            pbar.start()     
-            
-            numbermoved=0
-
-            for (key,mv_data_list) in list(destinations.items()):
-                # Check existence of directory, create if necessary
-                path=(node.delimiter.join(mv_data_list[0]))
-                logging.debug("Calling List with argument: %s" % path )
-                typ, response = ImapConnection.list(path)
-                if typ!='OK':
-                    raise Exception ("Failed to execute list command to IMAP server %s"%server)
-                #print len(response)
-                foundpath=0
-                for resp in response:
-                    if not resp: continue 
-                    dummyf, dummydel, potentialpath= parse_list_response(resp.decode('utf-8'))
-                    if potentialpath ==  path:
-                        foundpath=1
-                if not (foundpath):
-                    # Create IMAP Folder
-                    logging.debug("Creating Folder %s on Imap Server: %s"%(path,server))
-                    typ, dat = ImapConnection.create(path)
-                    if typ!='OK':
-                        logging.debug("Imap Server returned: %s"%(typ))
-                        raise Exception ("Failed to create folder %s on  IMAP server %s. IMAP Server returned: %s"%(path,server,response[0]))
-                logging.debug(f"list command for {path} returned: {response[0]}")
-
-                # Copy the messages
-                # Do this in chuncks of chunk messages so that the msg lists do not become to long for IMAP to handle them
-               
-                chunk=int (50)
-                length=len(mv_data_list[1])
-                chunkcount=int(length/chunk)
-                cycle=int(0)
-                while ( cycle <= chunkcount ):
-                    if (cycle == chunkcount):
-                        mv_data= (mv_data_list[1])[cycle*chunk:]
-                        numbermoved += ( length % chunk )
-                    else:
-                        mv_data= (mv_data_list[1])[cycle*chunk:(cycle+1)*chunk]                   
-                        numbermoved += chunk
-                    typ,response =ImapConnection.uid('copy',','.join(mv_data),path)  #msg set is comma separated UIDs
-                    if typ!='OK':
-                        raise Exception ("Failed to copy data to %s on  IMAP server %s. IMAP Server returned: %s"%(path,server,response[0]))
-
-                    # Set the delete flag
-                    typ, before = ImapConnection.uid('store',','.join(mv_data), '+FLAGS', r'(\Deleted)')
-                    if typ!='OK':
-                        raise Exception ("Failed to set DELETE Flag  IMAP server %s. IMAP Server returned: %s"%(server,response[0]))
-
-                                    #expunge
-                    typ,response=ImapConnection.expunge()
-                    if typ!='OK':
-                        raise Exception ("Failed to set expunge on IMAP server %s (working on %s):%s"%(server,box,response))
-                    pbar.update(numbermoved)
-                    cycle += 1
-
-                    
-            pbar.finish()
-            print ("\nDone")
-        else:
-            # There were no destinations.. i.e. no matches
-            print ("\n(Nothing to be) Done")
-
-        print ("Potential Other Lists")
-
-        sorted_hints= sorted(hints, key=lambda i: int(len(hints[i][2])))
-    
-    
-        for i in sorted_hints:
-            
-            if ((int(len(hints[i][2]))) < 5) :
-                continue
-            header=hints[i][0]
-            content=hints[i][1]
-            messagecont=hints[i][2][0]
-            typ,response = ImapConnection.uid('fetch',messagecont.get_uid(),'FAST')
-            if response[0]:
-                print ("---------------------------------------------")
-                print (f"{header}\":\"{content}\"")
-                print (f'Similar messages: {len (hints[i][2])}')
-                print (f'Subject: {messagecont.get("Subject")}')
-                print (f'Date: {messagecont.get("Date")}')
-                print (f'To: {messagecont.get("To")}')
-                print ("---------------------------------------------\n")
-            #print Results
-        print (f"Harverst for {box}: ")
-        if destinations:
-            for (key,mv_data_list) in list(destinations.items()):
-                path=node.delimiter.join(mv_data_list[0])
-                if not movethem:
-                    print("I would have moved", end='')
-                else:
-                    print ("- Moved", end='')
-                print (f" {len(mv_data_list[1])} messages to {path}")
-        else:
-            print ("No luck")
+# What was decided per message, for finding out why a message went where it went
+decision_log=None
+if args.decision_log:
+    decision_log=DecisionLog(args.decision_log)
+
+# The flags in a LIST response
+flag_pattern=re.compile(r"\w+")
+
+# The connections of all accounts to the same server are capped
+limits=ServerConnectionLimit(args.max_connections_per_server)
+
+# A single account (or one account at a time) prints straight away.
+# Accounts that run side by side do not show their progress bars, their
+# reports are printed when they are done; daemons print straight away.
+devnull=open(os.devnull, 'w')
+accounts=[]
+for account_data, rules, header_fields in configurations:
+    if len(configurations) == 1 or (args.parallel == 1 and not args.daemon):
+        accounts.append(Account(account_data, rules, header_fields))
+    elif args.daemon:
+        accounts.append(Account(account_data, rules, header_fields, sys.stdout, devnull))
+    else:
+        accounts.append(Account(account_data, rules, header_fields, io.StringIO(), devnull))
+
+if args.daemon and args.max_connections_per_server is not None:
+    # A daemon keeps its connections, an account that waited for them
+    # would wait forever: the accounts on a server share the limit.
+    daemons=collections.Counter(account.server.lower() for account in accounts)
+    for server, n in daemons.items():
+        if n > args.max_connections_per_server:
+            parser.error(f"--max-connections-per-server {args.max_connections_per_server} is less than"
+                         f" the {n} accounts on {server} that --daemon keeps connected")
+    for account in accounts:
+        account.connections=max(1, min(account.connections,
+                                        args.max_connections_per_server // daemons[account.server.lower()]))
+
+if args.daemon:
+    # A TERM signal ends the daemon like an interrupt does
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
+try:
+    if len(accounts) == 1:
+        accounts[0].run()
+    elif args.daemon:
+        # Every account is watched by a thread of its own until the
+        # process ends. The main thread only waits, so that it gets the
+        # signals.
+        threads=[threading.Thread(target=_run_account, args=(account,), daemon=True) for account in accounts]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1)
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.parallel) as executor:
+            for report in executor.map(_run_account, accounts):
+                print (report, end='')
                 
 finally:
-    try:
-        ImapConnection.close()
-    except:
-        pass
-    ImapConnection.logout()
+    if decision_log:
+        decision_log.close()
+    ran=[account.metrics for account in accounts if account.metrics]
+    if args.metrics and ran:
+        if len(accounts) == 1:
+            ran[0].write_json(args.metrics)
+        else:
+            write_metrics_json(ran, args.metrics)
+    if args.prometheus and ran:
+        write_metrics_prometheus(ran, args.prometheus)
 
 
     
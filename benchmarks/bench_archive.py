@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+""" bench_archive
+
+Benchmarks archive_mail against imap_stand_in, a local IMAP server with a
+synthetic mailbox tree, so that performance changes can be measured
+without a production mailbox.
+
+archive_mail.py is run against a freshly seeded server with --metrics.
+For the whole run the wall time, the number of IMAP commands and of
+round-trips (the times the server waited for the client), the bytes
+sent and received (as counted by the server) and the peak RSS are
+reported. The time per phase (structure, scan, classify, move) is taken
+from the --metrics summary of archive_mail, with --async these times
+are summed over the mailboxes processed side by side.
+
+The server runs in the same process, the peak RSS includes its memory.
+The peak is reset before every run where the kernel allows that
+(Linux), otherwise it is the peak of the process so far.
+
+    python benchmarks/bench_archive.py --messages 20000 --latency 0.02
+    python benchmarks/bench_archive.py --capabilities "IMAP4rev1 UIDPLUS" --json base.json
+
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import resource
+import runpy
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import yaml
+import OMK_imap_tools_lib as lib
+from imap_stand_in import DEFAULT_CAPABILITIES, ImapStandInServer, Store, seed
+
+
+################
+# Function defs
+################
+
+
+def _reset_peak_rss():
+    # Resets the peak RSS of the process (Linux only)
+    try:
+        with open('/proc/self/clear_refs', 'w') as fp:
+            fp.write('5')
+    except OSError:
+        pass
+
+
+def _peak_rss():
+    # Returns the peak RSS of the process in kB
+    try:
+        with open('/proc/self/status') as fp:
+            for line in fp:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Phase():
+    """Phase: Measures a run of archive_mail
+
+    Used as a context manager, the measurements are added to results.
+    """
+
+    def __init__(self, name, server, results):
+        """Initiallize
+
+        name: name of the row in the results
+        server: ImapStandInServer of which the counters are read
+        results: list to which the measurements are appended
+        """
+        self.name=name
+        self.server=server
+        self.results=results
+
+    def __enter__(self):
+        _reset_peak_rss()
+        self.counters=self.server.counters.snapshot()
+        self.start=time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall=time.perf_counter()-self.start
+        counters=self.server.counters.snapshot()
+        self.results.append({
+            'phase': self.name,
+            'wall_time': round(wall, 4),
+            'commands': sum(counters['commands'].values())-sum(self.counters['commands'].values()),
+            'round_trips': counters['round_trips']-self.counters['round_trips'],
+            'bytes_in': counters['bytes_in']-self.counters['bytes_in'],
+            'bytes_out': counters['bytes_out']-self.counters['bytes_out'],
+            'peak_rss_kb': _peak_rss(),
+            })
+        return False
+
+
+def make_rules(count):
+    # Returns count ArchiveRules for the lists and senders of the
+    # synthetic messages: List-Id rules on the id in angle brackets
+    # (looked up by exact key), substring From rules and ByYear rules,
+    # the way a real configuration mixes them.
+    rules=[]
+    for i in range(count):
+        if i % 3 == 0:
+            rules.append({'name': f'list{i}', 'Priority': 30,
+                          'DestinationArchive': f'Archived-Lists/List{i}',
+                          'DestinationArchivePolicy': 'Flat',
+                          'Regexps': [{'header': 'List-Id:', 'regex': f'.*<list{i}.lists.example.org>'}]})
+        elif i % 3 == 1:
+            rules.append({'name': f'sender{i}', 'Priority': 20,
+                          'DestinationArchive': f'Archived-Senders/Sender{i}',
+                          'DestinationArchivePolicy': 'Flat',
+                          'Regexps': [{'header': 'From:', 'regex': f'.*sender{i}@'}]})
+        else:
+            rules.append({'name': f'host{i}', 'Priority': 10,
+                          'DestinationArchive': f'Archived-Hosts/Host{i % 13}',
+                          'DestinationArchivePolicy': 'ByYear',
+                          'Regexps': [{'header': 'From:', 'regex': f'.*@host{i % 13}\\.example\\.com'}]})
+    return rules
+
+
+def make_config(args, port, rules):
+    # Returns the archive_mail configuration for the stand-in server
+    return {
+        'connection': {'server': '127.0.0.1', 'user': 'bench@example.com', 'port': port, 'ssl': False},
+        'mailbox': 'Archive',
+        'OlderThen': args.older_then,
+        'FetchBatchSize': args.batch_size,
+        'PipelineDepth': args.pipeline_depth,
+        'List-Id-Destination': 'AUTO-ARCHIVE',
+        'Date-Destination': 'DATE-ARCHIVE',
+        'Unknown-Date-Destination': 'DATEFAIL-ARCHIVE',
+        'ArchiveRules': rules,
+        }
+
+
+def seeded_store(args):
+    # Returns a Store with the synthetic mailbox tree
+    store=Store()
+    seed(store, 'Archive', ['box%d' % i for i in range(args.boxes)], args.messages, args.folders)
+    return store
+
+
+def run_archive_mail(args, server, rules):
+    # Runs archive_mail.py against the server, returns the measurements
+    # of the run followed by the phases of its --metrics summary
+    results=[]
+    archive_mail=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'archive_mail.py')
+    with tempfile.TemporaryDirectory() as directory:
+        config=os.path.join(directory, 'config.yaml')
+        with open(config, 'w') as fp:
+            yaml.safe_dump(make_config(args, server.server_address[1], rules), fp)
+        cwd=os.getcwd()
+        argv=sys.argv
+        os.chdir(directory)
+        metrics=os.path.join(directory, 'metrics.json')
+        sys.argv=['archive_mail.py', config, '--metrics', metrics] + (['--async'] if args.use_async else [])
+        try:
+            with contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+                with Phase('archive_mail', server, results):
+                    try:
+                        runpy.run_path(archive_mail, run_name='__main__')
+                    except SystemExit:
+                        pass
+        finally:
+            sys.argv=argv
+            os.chdir(cwd)
+        with open(metrics) as fp:
+            summary=json.load(fp)
+    for name, seconds in summary['phases'].items():
+        results.append({'phase': name, 'wall_time': seconds})
+    return results
+
+
+def print_results(results, out=sys.stdout):
+    # The phases only have a time, the other columns are left empty
+    columns=('commands', 'round_trips', 'bytes_in', 'bytes_out', 'peak_rss_kb')
+    print ('%-14s %10s %9s %12s %12s %12s %12s' % ('phase', 'wall (s)', 'commands', 'round-trips',
+                                                   'bytes in', 'bytes out', 'peak RSS kB'), file=out)
+    for r in results:
+        print ('%-14s %10.3f %9s %12s %12s %12s %12s' % ((r['phase'], r['wall_time'])
+                                                         + tuple(r.get(column, '') for column in columns)), file=out)
+
+
+##########################################################3
+
+
+##########
+#  Parse commandLine
+parser = argparse.ArgumentParser(description="Benchmark archive_mail against a local IMAP stand-in")
+parser.add_argument("--messages", type=int, default=5000, help="number of generated messages")
+parser.add_argument("--boxes", type=int, default=3, help="number of mailboxes below Archive")
+parser.add_argument("--folders", type=int, default=0, help="number of other folders on the server")
+parser.add_argument("--rules", type=int, default=30, help="number of generated ArchiveRules")
+parser.add_argument("--latency", type=float, default=0.0, help="delay of every command, in seconds")
+parser.add_argument("--capabilities", default=None,
+                    help="capabilities of the server (default: %s)" % ' '.join(DEFAULT_CAPABILITIES))
+parser.add_argument("--batch-size", type=int, default=500, help="FetchBatchSize")
+parser.add_argument("--pipeline-depth", type=int, default=4, help="PipelineDepth")
+parser.add_argument("--older-then", type=int, default=30, help="OlderThen")
+parser.add_argument("--runs", type=int, default=1, help="number of runs")
+parser.add_argument("--async", dest="use_async", action="store_true", help="run archive_mail with --async")
+parser.add_argument("--json", help="write the results to this file")
+args = parser.parse_args()
+
+capabilities=DEFAULT_CAPABILITIES
+if args.capabilities:
+    capabilities=args.capabilities.split()
+
+# The stand-in accepts any password
+lib.get_password=lambda hostname, username: 'bench'
+
+server=ImapStandInServer(latency=args.latency, capabilities=capabilities)
+server.serve_in_thread()
+rules=make_rules(args.rules)
+
+# Stays open: progressbar keeps the stderr of its import as default
+devnull=open(os.devnull, 'w')
+
+runs=[]
+try:
+    for run in range(args.runs):
+        server.store=seeded_store(args)
+        results=run_archive_mail(args, server, rules)
+        print (f"Run {run+1}: {args.messages} messages in {args.boxes} mailboxes, latency {args.latency}s")
+        print_results(results)
+        runs.append(results)
+finally:
+    server.shutdown()
+
+if args.json:
+    with open(args.json, 'w') as fp:
+        json.dump({'parameters': vars(args), 'capabilities': list(capabilities), 'runs': runs}, fp, indent=2)
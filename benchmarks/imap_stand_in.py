@@ -0,0 +1,770 @@
+"""imap_stand_in
+
+A small scripted IMAP4rev1 server that keeps its mailboxes in memory.
+It implements just enough of the protocol (plus MOVE, UIDPLUS, CONDSTORE,
+QRESYNC, LIST-STATUS, ENABLE, IDLE and a bit of NOTIFY) for archive_mail
+to be run against it, and it counts commands and bytes so that runs can
+be compared.
+
+Any user name is accepted, and any password unless the server is given
+one. Responses can be delayed by a
+fixed latency to mimic a remote server; commands that a client pipelines
+share one delay, as they would share one network round-trip. Only the
+message headers are stored.
+"""
+
+import email.utils
+import re
+import select
+import socket
+import socketserver
+import threading
+import time
+from datetime import datetime, timedelta
+
+
+DEFAULT_CAPABILITIES = ('IMAP4rev1', 'LITERAL+', 'UIDPLUS', 'MOVE', 'ENABLE',
+                        'CONDSTORE', 'QRESYNC', 'LIST-STATUS', 'IDLE',
+                        'UNSELECT', 'AUTH=PLAIN')
+
+
+class Message():
+    """A stored message: its header block, flags and modification sequence"""
+
+    __slots__ = ('uid', 'header', 'flags', 'modseq', 'sent')
+
+    def __init__(self, uid, header, modseq):
+        self.uid = uid
+        self.header = header
+        self.flags = set()
+        self.modseq = modseq
+        self.sent = None
+        m = re.search(rb'^Date:[ \t]*(.*)$', header, re.M | re.I)
+        if m:
+            date_tuple = email.utils.parsedate_tz(m.group(1).decode('ascii', 'replace'))
+            if date_tuple:
+                self.sent = datetime.fromtimestamp(email.utils.mktime_tz(date_tuple)).date()
+            else:
+                # Like servers that take the arrival time when the Date
+                # cannot be parsed
+                self.sent = datetime.now().date()
+
+    def header_fields(self, names, negate=False):
+        """Returns the header lines of the named fields (RFC 3501 HEADER.FIELDS)"""
+        wanted = set(n.lower() for n in names)
+        out = []
+        keep = False
+        for line in self.header.split(b'\r\n'):
+            if not line:
+                continue
+            if line[:1] in (b' ', b'\t'):
+                if keep:
+                    out.append(line)
+                continue
+            name = line.split(b':', 1)[0].decode('ascii', 'replace').lower()
+            keep = (name in wanted) != negate
+            if keep:
+                out.append(line)
+        return b'\r\n'.join(out) + b'\r\n\r\n'
+
+    def header_values(self, name):
+        values = []
+        current = None
+        for line in self.header.split(b'\r\n'):
+            if line[:1] in (b' ', b'\t') and current is not None:
+                values[-1] += line
+                continue
+            current = None
+            if b':' in line:
+                n, v = line.split(b':', 1)
+                if n.decode('ascii', 'replace').lower() == name.lower():
+                    values.append(v.strip())
+                    current = n
+        return [v.decode('utf-8', 'replace') for v in values]
+
+
+class Mailbox():
+
+    def __init__(self, name, uidvalidity):
+        self.name = name
+        self.uidvalidity = uidvalidity
+        self.uidnext = 1
+        self.messages = {}
+        self.highestmodseq = 1
+        self.vanished = {}
+
+    def next_modseq(self):
+        self.highestmodseq += 1
+        return self.highestmodseq
+
+    def append(self, header, flags=()):
+        msg = Message(self.uidnext, header, self.next_modseq())
+        msg.flags.update(flags)
+        self.messages[self.uidnext] = msg
+        self.uidnext += 1
+        return msg
+
+    def expunge(self, uids):
+        if not uids:
+            return
+        modseq = self.next_modseq()
+        for uid in uids:
+            self.messages.pop(uid, None)
+            self.vanished[uid] = modseq
+
+    def uids(self):
+        return sorted(self.messages)
+
+
+class Store():
+    """The in-memory mail store shared by all sessions"""
+
+    def __init__(self, delimiter='/'):
+        self.delimiter = delimiter
+        self.mailboxes = {}
+        self.lock = threading.RLock()
+        self.uidvalidity = int(time.time())
+        self.create('INBOX')
+
+    def create(self, name):
+        with self.lock:
+            if name not in self.mailboxes:
+                self.uidvalidity += 1
+                self.mailboxes[name] = Mailbox(name, self.uidvalidity)
+            return self.mailboxes[name]
+
+    def has_children(self, name):
+        prefix = name + self.delimiter
+        return any(m.startswith(prefix) for m in self.mailboxes)
+
+
+_uid_set_re = re.compile(r'[\d*]+(:[\d*]+)?(,[\d*]+(:[\d*]+)?)*')
+
+
+def parse_uid_set(spec, maximum):
+    """Expands an IMAP sequence set into a set of integers
+
+    An empty or malformed set is answered with BAD, as a server does.
+    """
+    if not isinstance(spec, str) or not _uid_set_re.fullmatch(spec):
+        raise CommandError('BAD', 'invalid sequence set')
+    result = set()
+    for part in spec.split(','):
+        if ':' in part:
+            lo, hi = part.split(':')
+            lo = maximum if lo == '*' else int(lo)
+            hi = maximum if hi == '*' else int(hi)
+            if lo > hi:
+                lo, hi = hi, lo
+            result.update(range(lo, hi + 1))
+        else:
+            result.add(maximum if part == '*' else int(part))
+    return result
+
+
+def compress_uid_set(uids):
+    uids = sorted(uids)
+    parts = []
+    i = 0
+    while i < len(uids):
+        j = i
+        while j + 1 < len(uids) and uids[j + 1] == uids[j] + 1:
+            j += 1
+        parts.append(str(uids[i]) if i == j else '%d:%d' % (uids[i], uids[j]))
+        i = j + 1
+    return ','.join(parts)
+
+
+_literal_re = re.compile(rb'\{(\d+)(\+?)\}\r?\n$')
+
+_token_re = re.compile(rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|\{(\d+)\+?\}$|((?:[^\s()"\[]|\[[^\]]*\])+(?:<[^>]*>)?))')
+
+
+def tokenize(line):
+    """Parses an IMAP command line into nested lists of strings"""
+    stack = [[]]
+    pos = 0
+    line = line.rstrip(b'\r\n')
+    while pos < len(line):
+        m = _token_re.match(line, pos)
+        if not m:
+            if line[pos:].strip() == b'':
+                break
+            raise ValueError('cannot parse %r' % line[pos:])
+        pos = m.end()
+        if m.group(1):
+            stack.append([])
+        elif m.group(2):
+            inner = stack.pop()
+            stack[-1].append(inner)
+        elif m.group(3) is not None:
+            stack[-1].append(re.sub(rb'\\(.)', rb'\1', m.group(3)).decode('utf-8'))
+        elif m.group(4):
+            raise ValueError('literals are not supported')
+        else:
+            stack[-1].append(m.group(5).decode('utf-8'))
+    return stack[0]
+
+
+def quote(s):
+    return '"' + s.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+class Counters():
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with getattr(self, 'lock', threading.Lock()):
+            self.commands = {}
+            self.round_trips = 0
+            self.bytes_in = 0
+            self.bytes_out = 0
+
+    def count(self, name, nin):
+        with self.lock:
+            self.commands[name] = self.commands.get(name, 0) + 1
+            self.bytes_in += nin
+
+    def waited(self):
+        with self.lock:
+            self.round_trips += 1
+
+    def sent(self, n):
+        with self.lock:
+            self.bytes_out += n
+
+    def snapshot(self):
+        with self.lock:
+            return {'commands': dict(self.commands),
+                    'round_trips': self.round_trips,
+                    'bytes_in': self.bytes_in,
+                    'bytes_out': self.bytes_out}
+
+
+class Session(socketserver.StreamRequestHandler):
+
+    # Responses are buffered until the client waits for them
+    wbufsize = -1
+
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def pending(self):
+        # True when the client has sent more than has been handled, i.e.
+        # when it pipelines and is not waiting for this response
+        if select.select([self.connection], [], [], 0)[0]:
+            return True
+        self.connection.setblocking(False)
+        try:
+            return bool(self.rfile.peek(1))
+        finally:
+            self.connection.setblocking(True)
+
+    def send(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.wfile.write(data)
+        self.server.counters.sent(len(data))
+
+    def untagged(self, text):
+        self.send(b'* ' + (text.encode('utf-8') if isinstance(text, str) else text) + b'\r\n')
+
+    def handle(self):
+        self.selected = None
+        self.notify = set()
+        self.readonly = False
+        self.condstore = False
+        self.qresync = False
+        self.send('* OK [CAPABILITY %s] imap_stand_in ready\r\n' % ' '.join(self.server.capabilities))
+        self.wfile.flush()
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            # A literal ({n}, or {n+} without waiting for the go-ahead)
+            # is taken into the line as a quoted string
+            literal = _literal_re.search(line)
+            while literal:
+                if not literal.group(2):
+                    self.send('+ Ready for literal\r\n')
+                    self.wfile.flush()
+                data = self.rfile.read(int(literal.group(1)))
+                text = quote(data.decode('utf-8', 'replace')).encode('utf-8')
+                line = line[:literal.start()] + text + self.rfile.readline()
+                literal = _literal_re.search(line)
+            try:
+                tokens = tokenize(line)
+            except ValueError as e:
+                self.send(b'* BAD ' + str(e).encode() + b'\r\n')
+                self.wfile.flush()
+                continue
+            if len(tokens) < 2:
+                self.send(b'* BAD empty command\r\n')
+                self.wfile.flush()
+                continue
+            tag, command, args = tokens[0], tokens[1].upper(), tokens[2:]
+            if command == 'UID' and args:
+                name = 'UID ' + args[0].upper()
+            else:
+                name = command
+            self.server.counters.count(name, len(line))
+            if command == 'LOGOUT':
+                self.untagged('BYE logging out')
+                self.send('%s OK LOGOUT completed\r\n' % tag)
+                self.wfile.flush()
+                return
+            handler = getattr(self, 'do_' + command, None)
+            try:
+                if handler is None:
+                    raise CommandError('BAD', 'unknown command %s' % command)
+                if command == 'IDLE':
+                    result = handler(tag, args)
+                else:
+                    with self.server.store.lock:
+                        result = handler(tag, args)
+                self.send('%s OK %s\r\n' % (tag, result or command + ' completed'))
+            except CommandError as e:
+                self.send('%s %s %s\r\n' % (tag, e.typ, e.text))
+            except (IndexError, ValueError):
+                # Missing or malformed arguments
+                self.send('%s BAD invalid arguments for %s\r\n' % (tag, name))
+            # The latency is that of the network: a client that pipelines
+            # pays it once for all the commands that it sent ahead
+            if not self.pending():
+                self.server.counters.waited()
+                if self.server.latency:
+                    time.sleep(self.server.latency)
+                self.wfile.flush()
+
+    # Commands
+
+    def do_CAPABILITY(self, tag, args):
+        self.untagged('CAPABILITY ' + ' '.join(self.server.capabilities))
+
+    def do_NOOP(self, tag, args):
+        pass
+
+    def do_LOGIN(self, tag, args):
+        if self.server.password is not None and args[1] != self.server.password:
+            raise CommandError('NO', '[AUTHENTICATIONFAILED] invalid credentials')
+        return '[CAPABILITY %s] LOGIN completed' % ' '.join(self.server.capabilities)
+
+    def do_ENABLE(self, tag, args):
+        enabled = []
+        for a in args:
+            if a.upper() in ('CONDSTORE', 'QRESYNC') and a.upper() in self.server.capabilities:
+                enabled.append(a.upper())
+                self.condstore = True
+                if a.upper() == 'QRESYNC':
+                    self.qresync = True
+        self.untagged('ENABLED ' + ' '.join(enabled))
+
+    def _status_items(self, mbox, items):
+        out = []
+        for item in items:
+            item = item.upper()
+            if item == 'MESSAGES':
+                out.append('MESSAGES %d' % len(mbox.messages))
+            elif item == 'UIDNEXT':
+                out.append('UIDNEXT %d' % mbox.uidnext)
+            elif item == 'UIDVALIDITY':
+                out.append('UIDVALIDITY %d' % mbox.uidvalidity)
+            elif item == 'UNSEEN':
+                out.append('UNSEEN %d' % sum(1 for m in mbox.messages.values() if '\\Seen' not in m.flags))
+            elif item == 'RECENT':
+                out.append('RECENT 0')
+            elif item == 'HIGHESTMODSEQ' and 'CONDSTORE' in self.server.capabilities:
+                out.append('HIGHESTMODSEQ %d' % mbox.highestmodseq)
+        return ' '.join(out)
+
+    def do_LIST(self, tag, args):
+        if len(args) < 2:
+            raise CommandError('BAD', 'LIST needs two arguments')
+        reference, pattern = args[0], args[1]
+        store = self.server.store
+        delim = store.delimiter
+        if pattern == '':
+            self.untagged('LIST (\\Noselect) "%s" ""' % delim)
+            return
+        status_items = None
+        if len(args) >= 4 and isinstance(args[2], str) and args[2].upper() == 'RETURN':
+            ret = args[3]
+            if 'LIST-STATUS' not in self.server.capabilities:
+                raise CommandError('BAD', 'LIST-STATUS not supported')
+            for i, r in enumerate(ret):
+                if isinstance(r, str) and r.upper() == 'STATUS':
+                    status_items = ret[i + 1]
+        regex = '^' + ''.join('.*' if c == '*' else '[^%s]*' % re.escape(delim) if c == '%' else re.escape(c)
+                              for c in reference + pattern) + '$'
+        rx = re.compile(regex)
+        for name in sorted(store.mailboxes):
+            if not rx.match(name):
+                continue
+            flags = '\\HasChildren' if store.has_children(name) else '\\HasNoChildren'
+            self.untagged('LIST (%s) "%s" %s' % (flags, delim, quote(name)))
+            if status_items is not None:
+                self.untagged('STATUS %s (%s)' % (quote(name), self._status_items(store.mailboxes[name], status_items)))
+
+    def do_STATUS(self, tag, args):
+        mbox = self._mailbox(args[0])
+        self.untagged('STATUS %s (%s)' % (quote(mbox.name), self._status_items(mbox, args[1])))
+
+    def _mailbox(self, name):
+        mbox = self.server.store.mailboxes.get(name)
+        if mbox is None:
+            raise CommandError('NO', '[NONEXISTENT] no such mailbox %s' % name)
+        return mbox
+
+    def do_SELECT(self, tag, args, readonly=False):
+        mbox = self._mailbox(args[0])
+        self.selected = mbox
+        self.readonly = readonly
+        if len(args) > 1:
+            params = args[1]
+            if params and params[0].upper() == 'CONDSTORE':
+                self.condstore = True
+        self.untagged('%d EXISTS' % len(mbox.messages))
+        self.untagged('0 RECENT')
+        self.untagged('FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)')
+        self.untagged('OK [UIDVALIDITY %d] UIDs valid' % mbox.uidvalidity)
+        self.untagged('OK [UIDNEXT %d] Predicted next UID' % mbox.uidnext)
+        if self.condstore and 'CONDSTORE' in self.server.capabilities:
+            self.untagged('OK [HIGHESTMODSEQ %d] Highest' % mbox.highestmodseq)
+        return '[%s] %s completed' % ('READ-ONLY' if readonly else 'READ-WRITE',
+                                      'EXAMINE' if readonly else 'SELECT')
+
+    def do_EXAMINE(self, tag, args):
+        return self.do_SELECT(tag, args, readonly=True)
+
+    def do_CREATE(self, tag, args):
+        name = args[0].rstrip(self.server.store.delimiter)
+        if name in self.server.store.mailboxes:
+            raise CommandError('NO', '[ALREADYEXISTS] mailbox exists')
+        self.server.store.create(name)
+
+    def do_DELETE(self, tag, args):
+        self._mailbox(args[0])
+        del self.server.store.mailboxes[args[0]]
+
+    def _require_selected(self):
+        if self.selected is None:
+            raise CommandError('BAD', 'no mailbox selected')
+        return self.selected
+
+    def do_CLOSE(self, tag, args):
+        mbox = self._require_selected()
+        if not self.readonly:
+            mbox.expunge([m.uid for m in mbox.messages.values() if '\\Deleted' in m.flags])
+        self.selected = None
+
+    def do_UNSELECT(self, tag, args):
+        self._require_selected()
+        self.selected = None
+
+    def do_EXPUNGE(self, tag, args, uids=None):
+        mbox = self._require_selected()
+        order = mbox.uids()
+        gone = [u for u in order if '\\Deleted' in mbox.messages[u].flags and (uids is None or u in uids)]
+        for uid in reversed(gone):
+            self.untagged('%d EXPUNGE' % (order.index(uid) + 1))
+        mbox.expunge(gone)
+
+    def do_NOTIFY(self, tag, args):
+        # Only "NOTIFY NONE" and "NOTIFY SET (mailboxes ... (...))"
+        if 'NOTIFY' not in self.server.capabilities:
+            raise CommandError('BAD', 'NOTIFY not supported')
+        self.notify = set()
+        if args and args[0].upper() == 'SET':
+            for group in args[1:]:
+                if isinstance(group, list) and len(group) > 1 and str(group[0]).lower() == 'mailboxes':
+                    names = group[1] if isinstance(group[1], list) else [group[1]]
+                    for name in names:
+                        self._mailbox(name)
+                    self.notify.update(names)
+
+    def do_IDLE(self, tag, args):
+        mbox = self.selected
+        self.send('+ idling\r\n')
+        self.wfile.flush()
+        count = len(mbox.messages) if mbox else 0
+        store = self.server.store
+        with store.lock:
+            watched = dict((name, store.mailboxes[name].uidnext) for name in self.notify
+                           if name in store.mailboxes and store.mailboxes[name] is not mbox)
+        while True:
+            readable, _, _ = select.select([self.connection], [], [], 0.1)
+            if readable:
+                self.rfile.readline()
+                return 'IDLE terminated'
+            with store.lock:
+                if mbox and len(mbox.messages) != count:
+                    count = len(mbox.messages)
+                    self.untagged('%d EXISTS' % count)
+                    self.wfile.flush()
+                for name, uidnext in watched.items():
+                    other = store.mailboxes.get(name)
+                    if other is not None and other.uidnext != uidnext:
+                        watched[name] = other.uidnext
+                        self.untagged('STATUS %s (MESSAGES %d UIDNEXT %d)' % (quote(name), len(other.messages),
+                                                                             other.uidnext))
+                        self.wfile.flush()
+
+    def do_UID(self, tag, args):
+        mbox = self._require_selected()
+        sub = args[0].upper()
+        rest = args[1:]
+        if sub == 'SEARCH':
+            return self.uid_search(mbox, rest)
+        if sub == 'FETCH':
+            return self.uid_fetch(mbox, rest)
+        if sub in ('COPY', 'MOVE'):
+            if sub == 'MOVE' and 'MOVE' not in self.server.capabilities:
+                raise CommandError('BAD', 'MOVE not supported')
+            return self.uid_copy(mbox, rest, move=(sub == 'MOVE'))
+        if sub == 'STORE':
+            return self.uid_store(mbox, rest)
+        if sub == 'EXPUNGE':
+            if 'UIDPLUS' not in self.server.capabilities:
+                raise CommandError('BAD', 'UIDPLUS not supported')
+            uids = parse_uid_set(rest[0], mbox.uidnext - 1)
+            return self.do_EXPUNGE(tag, [], uids=uids)
+        raise CommandError('BAD', 'unknown UID command %s' % sub)
+
+    def _search_keys(self, mbox, keys):
+        """Returns a predicate for a list of search keys (implicit AND)"""
+        keys = list(keys)
+        preds = []
+        while keys:
+            preds.append(self._search_key(mbox, keys))
+        return lambda m: all(p(m) for p in preds)
+
+    def _search_key(self, mbox, keys):
+        """Consumes one search key (and its arguments) from keys"""
+        key = keys.pop(0)
+        if isinstance(key, list):
+            return self._search_keys(mbox, key)
+        k = key.upper()
+        top = max(mbox.uidnext - 1, 1)
+        if k == 'ALL':
+            return lambda m: True
+        if k == 'UID':
+            s = parse_uid_set(keys.pop(0), top)
+            return lambda m: m.uid in s
+        if re.match(r'^[\d*][\d:,*]*$', key):
+            s = parse_uid_set(key, top)
+            order = mbox.uids()
+            return lambda m: order.index(m.uid) + 1 in s
+        if k == 'NOT':
+            inner = self._search_key(mbox, keys)
+            return lambda m: not inner(m)
+        if k == 'OR':
+            a = self._search_key(mbox, keys)
+            b = self._search_key(mbox, keys)
+            return lambda m: a(m) or b(m)
+        if k in ('SENTBEFORE', 'SENTSINCE', 'SENTON', 'BEFORE', 'SINCE', 'ON'):
+            d = datetime.strptime(keys.pop(0), '%d-%b-%Y').date()
+            op = {'BEFORE': lambda a, b: a < b, 'SINCE': lambda a, b: a >= b,
+                  'ON': lambda a, b: a == b}[k.replace('SENT', '')]
+            return lambda m: m.sent is not None and op(m.sent, d)
+        if k == 'HEADER':
+            name, value = keys.pop(0), keys.pop(0).lower()
+            return lambda m: any(value in v.lower() for v in m.header_values(name))
+        if k in ('FROM', 'TO', 'SUBJECT', 'CC'):
+            value = keys.pop(0).lower()
+            return lambda m: any(value in v.lower() for v in m.header_values(k))
+        if k == 'MODSEQ':
+            n = int(keys.pop(0))
+            return lambda m: m.modseq > n
+        if k in ('DELETED', 'UNDELETED', 'SEEN', 'UNSEEN'):
+            flag = '\\' + k.replace('UN', '').capitalize()
+            want = not k.startswith('UN')
+            return lambda m: (flag in m.flags) == want
+        raise CommandError('BAD', 'unsupported search key %s' % key)
+
+    def uid_search(self, mbox, args):
+        if args and isinstance(args[0], str) and args[0].upper() == 'CHARSET':
+            args = args[2:]
+        pred = self._search_keys(mbox, args)
+        found = [str(m.uid) for m in sorted(mbox.messages.values(), key=lambda m: m.uid) if pred(m)]
+        self.untagged('SEARCH' + ''.join(' ' + u for u in found))
+
+    def uid_fetch(self, mbox, args):
+        uidspec = args[0]
+        items = args[1]
+        modifiers = args[2] if len(args) > 2 else []
+        if isinstance(items, str):
+            items = [items]
+        if len(items) == 1 and items[0].upper() == 'FAST':
+            items = ['FLAGS', 'INTERNALDATE', 'RFC822.SIZE']
+        changedsince = None
+        vanished = False
+        i = 0
+        while i < len(modifiers):
+            if modifiers[i].upper() == 'CHANGEDSINCE':
+                changedsince = int(modifiers[i + 1])
+                i += 2
+            elif modifiers[i].upper() == 'VANISHED':
+                vanished = True
+                i += 1
+            else:
+                i += 1
+        uids = parse_uid_set(uidspec, max(mbox.uidnext - 1, 1))
+        if vanished and changedsince is not None:
+            gone = [u for u, ms in mbox.vanished.items() if ms > changedsince and u in uids]
+            if gone:
+                self.untagged('VANISHED (EARLIER) ' + compress_uid_set(gone))
+        order = mbox.uids()
+        for n, uid in enumerate(order, 1):
+            if uid not in uids:
+                continue
+            m = mbox.messages[uid]
+            if changedsince is not None and m.modseq <= changedsince:
+                continue
+            parts = [b'UID ' + str(uid).encode()]
+            j = 0
+            while j < len(items):
+                item = items[j]
+                up = item.upper()
+                if up == 'UID':
+                    pass
+                elif up == 'FLAGS':
+                    parts.append(('FLAGS (%s)' % ' '.join(sorted(m.flags))).encode())
+                elif up == 'INTERNALDATE':
+                    parts.append(b'INTERNALDATE "01-Jan-2020 00:00:00 +0000"')
+                elif up == 'RFC822.SIZE':
+                    parts.append(('RFC822.SIZE %d' % len(m.header)).encode())
+                elif up == 'MODSEQ':
+                    parts.append(('MODSEQ (%d)' % m.modseq).encode())
+                elif up == 'ENVELOPE':
+                    parts.append(b'ENVELOPE (NIL NIL NIL NIL NIL NIL NIL NIL NIL NIL)')
+                elif up.startswith('BODY.PEEK[HEADER.FIELDS') or up.startswith('BODY[HEADER.FIELDS'):
+                    negate = '.NOT' in up
+                    names = re.search(r'\((.*)\)', item).group(1).split()
+                    data = m.header_fields(names, negate=negate)
+                    label = 'BODY[HEADER.FIELDS%s (%s)]' % ('.NOT' if negate else '',
+                                                          ' '.join(n.upper() for n in names))
+                    parts.append(label.encode() + (' {%d}\r\n' % len(data)).encode() + data)
+                elif up in ('BODY.PEEK[HEADER]', 'BODY[HEADER]', 'RFC822.HEADER'):
+                    data = m.header + b'\r\n'
+                    label = 'RFC822.HEADER' if up == 'RFC822.HEADER' else 'BODY[HEADER]'
+                    parts.append(label.encode() + (' {%d}\r\n' % len(data)).encode() + data)
+                else:
+                    raise CommandError('BAD', 'unsupported fetch item %s' % item)
+                j += 1
+            self.send(('* %d FETCH (' % n).encode() + b' '.join(parts) + b')\r\n')
+
+    def uid_copy(self, mbox, args, move=False):
+        uids = sorted(u for u in parse_uid_set(args[0], max(mbox.uidnext - 1, 1)) if u in mbox.messages)
+        dest = self._mailbox(args[1])
+        src, dst = [], []
+        for uid in uids:
+            m = mbox.messages[uid]
+            copy = dest.append(m.header, m.flags - {'\\Deleted'})
+            src.append(uid)
+            dst.append(copy.uid)
+        code = ''
+        if uids and 'UIDPLUS' in self.server.capabilities:
+            code = '[COPYUID %d %s %s] ' % (dest.uidvalidity, compress_uid_set(src), compress_uid_set(dst))
+        if move:
+            if code:
+                self.untagged('OK ' + code.strip())
+                code = ''
+            order = mbox.uids()
+            for uid in reversed(uids):
+                self.untagged('%d EXPUNGE' % (order.index(uid) + 1))
+            mbox.expunge(uids)
+        return code + ('MOVE' if move else 'COPY') + ' completed'
+
+    def uid_store(self, mbox, args):
+        uids = parse_uid_set(args[0], max(mbox.uidnext - 1, 1))
+        action = args[1].upper()
+        flags = args[2] if isinstance(args[2], list) else [args[2]]
+        silent = action.endswith('.SILENT')
+        order = mbox.uids()
+        for n, uid in enumerate(order, 1):
+            if uid not in uids:
+                continue
+            m = mbox.messages[uid]
+            if action.startswith('+'):
+                m.flags.update(flags)
+            elif action.startswith('-'):
+                m.flags.difference_update(flags)
+            else:
+                m.flags = set(flags)
+            m.modseq = mbox.next_modseq()
+            if not silent:
+                self.untagged('%d FETCH (UID %d FLAGS (%s))' % (n, uid, ' '.join(sorted(m.flags))))
+
+
+class CommandError(Exception):
+
+    def __init__(self, typ, text):
+        Exception.__init__(self, text)
+        self.typ = typ
+        self.text = text
+
+
+class ImapStandInServer(socketserver.ThreadingTCPServer):
+    """Threaded IMAP stand-in; bind to port 0 to get a free port"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 0), store=None, latency=0.0,
+                 capabilities=DEFAULT_CAPABILITIES, password=None):
+        socketserver.ThreadingTCPServer.__init__(self, address, Session)
+        self.store = store or Store()
+        self.latency = latency
+        self.capabilities = tuple(capabilities)
+        self.password = password
+        self.counters = Counters()
+
+    def serve_in_thread(self):
+        t = threading.Thread(target=self.serve_forever, daemon=True)
+        t.start()
+        return t
+
+
+def synthetic_header(i, now=None, lists=50, senders=200):
+    """Returns a plausible header block for the i-th generated message"""
+    now = now or datetime.now()
+    date = now - timedelta(hours=7 * i % (24 * 400))
+    lines = [
+        'Return-Path: <bounce-%d@lists.example.org>' % (i % lists),
+        'Received: from mx%d.example.net (mx%d.example.net [192.0.2.%d]) by imap.example.com with ESMTPS id %08x' % (i % 7, i % 7, i % 250, i),
+        'Received: from list%d.example.org by mx%d.example.net with SMTP id %08x;\r\n\t%s' % (i % lists, i % 7, i * 7, email.utils.format_datetime(date)),
+        'DKIM-Signature: v=1; a=rsa-sha256; c=relaxed/relaxed; d=example.org; s=s1;\r\n\th=from:to:subject:date; bh=' + 'A' * 44 + ';\r\n\tb=' + 'B' * 300,
+        'From: Sender %d <sender%d@host%d.example.com>' % (i % senders, i % senders, i % 13),
+        'To: user@example.com',
+        'Delivered-To: user@example.com',
+        'Subject: Generated message number %d' % i,
+        'Date: ' + email.utils.format_datetime(date),
+        'Message-ID: <%d.generated@example.com>' % i,
+    ]
+    if i % 3:
+        lines.append('List-Id: List number %d <list%d.lists.example.org>' % (i % lists, i % lists))
+        lines.append('Reply-To: list%d@lists.example.org' % (i % lists))
+    return ('\r\n'.join(lines) + '\r\n').encode('utf-8')
+
+
+def seed(store, root='Archive', boxes=('2019', '2020', 'misc'), messages=1000, folders=0):
+    """Fills store with a mailbox tree below root and messages spread over it
+
+    folders: number of other (empty) folders, to make the folder tree of
+    the account larger
+    """
+    store.create(root)
+    names = [root + store.delimiter + b for b in boxes] or [root]
+    for name in names:
+        store.create(name)
+    for i in range(folders):
+        path = ['Projects', 'P%03d' % (i // 10), 'F%d' % i]
+        for depth in range(1, len(path) + 1):
+            store.create(store.delimiter.join(path[:depth]))
+    for i in range(messages):
+        store.mailboxes[names[i % len(names)]].append(synthetic_header(i))
+    return names
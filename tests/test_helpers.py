@@ -0,0 +1,198 @@
+""" test_helpers
+
+Unit tests for the helpers of OMK_imap_tools_lib that do not need a
+server: UID sets, FETCH responses, header parsing, the header cache and
+the mailbox tree.
+
+    python -m pytest tests
+
+"""
+
+import email
+import email.policy
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import OMK_imap_tools_lib as lib
+
+
+class UidSetsTest(unittest.TestCase):
+
+    def test_ranges(self):
+        self.assertEqual(list(lib.uid_sets(['7', '1', '2', '3', '9', '10', b'11', 5])), ['1:3,5,7,9:11'])
+        self.assertEqual(list(lib.uid_sets([])), [])
+        self.assertEqual(list(lib.uid_sets(['4', '4'])), ['4'])
+
+    def test_max_length(self):
+        uids=list(range(1, 1000, 2))
+        sets=list(lib.uid_sets(uids, max_length=50))
+        self.assertTrue(all(len(s) <= 50 for s in sets))
+        self.assertEqual([int(u) for s in sets for u in lib.expand_uid_set(s)], uids)
+
+    def test_max_count(self):
+        sets=list(lib.uid_sets(list(range(1, 26)) + [30, 31], max_count=10))
+        self.assertEqual(sets, ['1:10', '11:20', '21:25,30:31', ])
+        self.assertTrue(all(len(lib.expand_uid_set(s)) <= 10 for s in sets))
+
+    def test_round_trip(self):
+        uids=[3, 4, 5, 100, 101, 250, 251, 252, 400]
+        for max_length in (3, 8, 20, 8000):
+            for max_count in (None, 1, 2, 4):
+                with self.subTest(max_length=max_length, max_count=max_count):
+                    sets=list(lib.uid_sets(uids, max_length, max_count))
+                    self.assertEqual([int(u) for s in sets for u in lib.expand_uid_set(s)], uids)
+
+
+class ParseFetchHeadersTest(unittest.TestCase):
+
+    def test_uid_in_prefix(self):
+        data=[(b'1 (UID 17 BODY[HEADER] {12}', b'Subject: a\r\n'), b')',
+              (b'2 (UID 18 BODY[HEADER] {12}', b'Subject: b\r\n'), b')']
+        self.assertEqual(list(lib.parse_fetch_headers(data)),
+                         [('17', b'Subject: a\r\n'), ('18', b'Subject: b\r\n')])
+
+    def test_uid_in_trailer(self):
+        data=[(b'1 (BODY[HEADER] {12}', b'Subject: a\r\n'), b' UID 17)',
+              (b'2 (BODY[HEADER] {12}', b'Subject: b\r\n'), b' UID 18)']
+        self.assertEqual(list(lib.parse_fetch_headers(data)),
+                         [('17', b'Subject: a\r\n'), ('18', b'Subject: b\r\n')])
+
+    def test_flag_updates_are_skipped(self):
+        data=[b'3 (FLAGS (\\Seen) UID 20)',
+              (b'1 (UID 17 BODY[HEADER] {12}', b'Subject: a\r\n'), b')',
+              b'4 (UID 21 FLAGS (\\Deleted))']
+        self.assertEqual(list(lib.parse_fetch_headers(data)), [('17', b'Subject: a\r\n')])
+
+
+HEADER = (b'Received: from a by b\r\n'
+          b'\twith smtp\r\n'
+          b'From: Olaf <olaf@example.com>\r\n'
+          b'Subject: A folded\r\n'
+          b' subject line\r\n'
+          b'List-Id: List number 3 <list3.lists.example.org>\r\n'
+          b'X-Empty:\r\n'
+          b'Date: Mon, 3 Feb 2020 10:00:00 +0100\r\n'
+          b'Received: from c by d\r\n'
+          b'\r\n'
+          b'Body: not a header\r\n')
+
+
+class ParseHeaderFieldsTest(unittest.TestCase):
+
+    def test_like_email_message(self):
+        # Values come out the way email.message.Message (compat32) returns them
+        message=email.message_from_bytes(HEADER, policy=email.policy.compat32)
+        self.assertEqual(lib.parse_header_fields(HEADER), list(message.items()))
+
+    def test_wanted(self):
+        self.assertEqual(lib.parse_header_fields(HEADER, set(['received', 'list-id'])),
+                         [('Received', 'from a by b\r\n\twith smtp'),
+                          ('List-Id', 'List number 3 <list3.lists.example.org>'),
+                          ('Received', 'from c by d')])
+
+    def test_string_and_garbage(self):
+        self.assertEqual(lib.parse_header_fields('Subject: x\nno colon here\nTo: y\n'), [('Subject', 'x')])
+        self.assertEqual(lib.parse_header_fields(b''), [])
+
+    def test_message_container(self):
+        mc=lib.MessageContainer('17', HEADER, wanted=set(['subject', 'date', 'list-id']))
+        self.assertEqual(mc.get_uid(), '17')
+        self.assertEqual(mc.get('subject'), 'A folded\r\n subject line')
+        self.assertIsNone(mc.get('From'))
+        self.assertEqual(mc.get_datetime().year, 2020)
+
+    def test_message_container_decodes_lazily(self):
+        mc=lib.MessageContainer('17', HEADER)
+        self.assertIsInstance(dict(mc.fields)['List-Id'], bytes)
+        self.assertEqual(mc.get_all('received'), ['from a by b\r\n\twith smtp', 'from c by d'])
+        self.assertEqual([value for name, value in mc.fields if name == 'Received'],
+                         ['from a by b\r\n\twith smtp', 'from c by d'])
+        self.assertEqual(list(mc.raw_items()), lib.parse_header_fields(HEADER))
+
+
+class HeaderCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory=tempfile.TemporaryDirectory()
+        self.filename=os.path.join(self.directory.name, 'cache.sqlite')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def messages(self, *uids):
+        return [lib.MessageContainer(str(uid), HEADER) for uid in uids]
+
+    def test_store_and_iterate(self):
+        cache=lib.HeaderCache(self.filename, 'olaf@example.com', set(['subject', 'list-id']))
+        self.assertFalse(cache.set_uidvalidity('Archive', 1))
+        cache.store('Archive', self.messages(3, 1, 2))
+        self.assertEqual(cache.uids('Archive'), set(['1', '2', '3']))
+        found=list(cache.iterate('Archive', ['2', '3'], batch_size=1))
+        self.assertEqual([mc.get_uid() for mc in found], ['2', '3'])
+        self.assertEqual(found[0].get('Subject'), 'A folded\r\n subject line')
+        self.assertIsNone(found[0].get('From'))
+        cache.forget('Archive', ['1'])
+        cache.prune('Archive', ['3', '4'])
+        self.assertEqual(cache.uids('Archive'), set(['3']))
+        cache.close()
+
+    def test_uidvalidity_and_fields(self):
+        cache=lib.HeaderCache(self.filename, 'olaf@example.com', set(['subject']))
+        cache.set_uidvalidity('Archive', 1)
+        cache.store('Archive', self.messages(1))
+        cache.set_state('Archive', 100, 2, 'ALL')
+        self.assertTrue(cache.set_uidvalidity('Archive', 1))
+        self.assertEqual(cache.get_state('Archive'), (100, 2, 'ALL'))
+        cache.close()
+
+        # More fields are needed now: the cached headers are dropped
+        cache=lib.HeaderCache(self.filename, 'olaf@example.com', set(['subject', 'from']))
+        self.assertFalse(cache.set_uidvalidity('Archive', 1))
+        self.assertEqual(cache.uids('Archive'), set())
+        cache.store('Archive', self.messages(1))
+        # A new UIDVALIDITY drops them as well
+        self.assertFalse(cache.set_uidvalidity('Archive', 2))
+        self.assertEqual(cache.uids('Archive'), set())
+        cache.close()
+
+    def test_accounts_are_apart(self):
+        first=lib.HeaderCache(self.filename, 'a@example.com')
+        second=lib.HeaderCache(self.filename, 'b@example.com')
+        first.set_uidvalidity('Archive', 1)
+        second.set_uidvalidity('Archive', 1)
+        first.store('Archive', self.messages(1, 2))
+        self.assertEqual(second.uids('Archive'), set())
+        first.close()
+        second.close()
+
+
+class ImapNodeTest(unittest.TestCase):
+
+    def test_add_path_and_lookup(self):
+        root=lib.ImapNode(delimiter='.')
+        root.add_path('Archive.2020', number_of_messages=3)
+        root.add_path('Archive', flags=['HasChildren'])
+        self.assertEqual([node.path() for node in root.walk()], ['Archive', 'Archive.2020'])
+        self.assertIs(root.lookup('Archive.2020'), root.findnode('Archive.2020'))
+        root.set_delimiter('/')
+        self.assertEqual(root.lookup('Archive/2020').number_of_messages, 3)
+        self.assertIsNone(root.lookup('Archive.2020'))
+
+    def test_add_child(self):
+        root=lib.ImapNode()
+        archive=root.add_path('Archive')
+        archive.add_child(lib.ImapNode('2021', parent=archive))
+        self.assertEqual([node.name for node in archive.children], ['2021'])
+        self.assertIs(root.lookup('Archive/2021'), archive.children[0])
+        with self.assertRaises(AttributeError):
+            archive.children.append(lib.ImapNode('2022', parent=archive))
+        with self.assertRaises(Exception):
+            archive.add_child(lib.ImapNode('2022', parent=root))
+
+
+if __name__ == '__main__':
+    unittest.main()
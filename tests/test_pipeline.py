@@ -0,0 +1,221 @@
+""" test_pipeline
+
+Tests of ImapPipeline, fetch_message_headers, idle, AsyncImapConnection and
+the move queues against the IMAP stand-in of the benchmarks, with and without
+latency.
+
+    python -m pytest tests
+
+"""
+
+import asyncio
+import imaplib
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+import OMK_imap_tools_lib as lib
+from imap_stand_in import DEFAULT_CAPABILITIES, ImapStandInServer, seed, synthetic_header
+
+
+class PipelineTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server=ImapStandInServer(latency=0.01)
+        cls.boxes=seed(cls.server.store, messages=90)
+        cls.server.serve_in_thread()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def setUp(self):
+        self.connection=imaplib.IMAP4('127.0.0.1', self.server.server_address[1])
+        self.connection.login('test@example.com', 'test')
+
+    def tearDown(self):
+        self.connection.logout()
+
+    def test_results_in_order(self):
+        commands=[(box, 'STATUS', (lib.imap_quote(box), '(MESSAGES)')) for box in self.boxes]
+        results=list(lib.ImapPipeline(self.connection, 2).run(commands))
+        self.assertEqual([key for key, typ, data in results], self.boxes)
+        self.assertTrue(all(typ == 'OK' for key, typ, data in results))
+        status={}
+        for key, typ, data in results:
+            status.update(lib.parse_status_response(data))
+        self.assertEqual(dict((box, status[box]['MESSAGES']) for box in self.boxes),
+                         dict((box, 30) for box in self.boxes))
+
+    def test_same_as_one_by_one(self):
+        self.connection.select(lib.imap_quote(self.boxes[0]))
+        typ, data=self.connection.uid('search', None, 'ALL')
+        uids=[uid.decode('ascii') for uid in data[0].split()]
+        fields=set(['subject', 'list-id', 'date'])
+        pipelined=list(lib.fetch_message_headers(self.connection, uids, 7, 4, fields))
+        one_by_one=list(lib.fetch_message_headers(self.connection, uids, 7, 1, fields))
+        self.assertEqual([mc.get_uid() for mc in pipelined], uids)
+        self.assertEqual([list(mc.raw_items()) for mc in pipelined], [list(mc.raw_items()) for mc in one_by_one])
+
+    def test_failed_command(self):
+        commands=[('missing', 'STATUS', ('"No such box"', '(MESSAGES)')),
+                  (self.boxes[0], 'STATUS', (lib.imap_quote(self.boxes[0]), '(MESSAGES)'))]
+        results=list(lib.ImapPipeline(self.connection, 4).run(commands))
+        self.assertEqual([(key, typ) for key, typ, data in results], [('missing', 'NO'), (self.boxes[0], 'OK')])
+
+
+class IdleTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server=ImapStandInServer()
+        cls.boxes=seed(cls.server.store, messages=9)
+        cls.server.serve_in_thread()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def setUp(self):
+        self.connection=imaplib.IMAP4('127.0.0.1', self.server.server_address[1])
+        self.connection.login('test@example.com', 'test')
+        self.connection.select(lib.imap_quote(self.boxes[0]))
+        self.connection.response('EXISTS')
+
+    def tearDown(self):
+        self.connection.logout()
+
+    def test_timeout(self):
+        self.assertEqual(lib.idle(self.connection, 0.3), [])
+
+    def test_new_message(self):
+        def deliver():
+            time.sleep(0.3)
+            with self.server.store.lock:
+                self.server.store.mailboxes[self.boxes[0]].append(synthetic_header(1))
+        threading.Thread(target=deliver).start()
+        started=time.monotonic()
+        self.assertIn('EXISTS', lib.idle(self.connection, 10))
+        self.assertLess(time.monotonic()-started, 5)
+
+    def test_pending_response(self):
+        # An EXISTS that came in before IDLE is not waited for again
+        self.connection.noop()
+        self.connection.untagged_responses['EXISTS']=[b'4']
+        started=time.monotonic()
+        self.assertEqual(lib.idle(self.connection, 10), ['EXISTS'])
+        self.assertLess(time.monotonic()-started, 5)
+
+
+class AsyncConnectionTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.servers=[ImapStandInServer(latency=0.01, password='sch\u00f6n g\u00e9heim', capabilities=capabilities)
+                     for capabilities in (DEFAULT_CAPABILITIES,
+                                          [c for c in DEFAULT_CAPABILITIES if c != 'LITERAL+'])]
+        for server in cls.servers:
+            cls.boxes=seed(server.store, messages=300)
+            server.serve_in_thread()
+
+    @classmethod
+    def tearDownClass(cls):
+        for server in cls.servers:
+            server.shutdown()
+
+    def connect(self, server, password='sch\u00f6n g\u00e9heim'):
+        return lib.open_async_connection('127.0.0.1', 'test@example.com', password,
+                                         port=server.server_address[1], use_ssl=False)
+
+    def test_login_utf8_password(self):
+        async def login(server):
+            connection=await self.connect(server)
+            typ, data=await connection.list()
+            await connection.logout()
+            with self.assertRaises(Exception):
+                await self.connect(server, 'schon geheim')
+            return typ
+        for server in self.servers:
+            with self.subTest(capabilities=server.capabilities):
+                self.assertEqual(asyncio.run(login(server)), 'OK')
+
+    def test_select_while_fetching(self):
+        # The FETCH that is in flight keeps its responses when another
+        # mailbox is selected
+        async def fetch_and_select():
+            connection=await self.connect(self.servers[0])
+            await connection.select(lib.imap_quote(self.boxes[0]))
+            fetching=asyncio.ensure_future(connection.uid('fetch', '1:*', '(BODY.PEEK[HEADER])'))
+            while 'FETCH' not in connection.untagged_responses and not fetching.done():
+                await asyncio.sleep(0)
+            typ, exists=await connection.select(lib.imap_quote(self.boxes[1]))
+            typ, fetched=await fetching
+            await connection.logout()
+            return exists, fetched
+        exists, fetched=asyncio.run(fetch_and_select())
+        self.assertEqual(exists, [b'100'])
+        self.assertEqual(len(list(lib.parse_fetch_headers(fetched))), 100)
+
+
+class MoveQueueTest(unittest.TestCase):
+    # MoveQueue and AsyncMoveQueue move the same messages: with MOVE, by
+    # COPY and UID EXPUNGE (UIDPLUS) and by COPY and EXPUNGE
+
+    capabilities=(DEFAULT_CAPABILITIES,
+                  [c for c in DEFAULT_CAPABILITIES if c != 'MOVE'],
+                  [c for c in DEFAULT_CAPABILITIES if c not in ('MOVE', 'UIDPLUS')])
+
+    def queue_messages(self, queue):
+        # Queues UIDs 1 to 7 for Dest/A, 8 and 9 for Dest/B, with flushes
+        # in between as the threshold is 3
+        for uid in range(1, 10):
+            queue.add(['Dest', 'A' if uid < 8 else 'B'], [str(uid)])
+
+    def move(self, capabilities, use_async):
+        # Returns the moved UIDs and the number of messages per mailbox
+        server=ImapStandInServer(capabilities=capabilities)
+        boxes=seed(server.store, boxes=['misc'], messages=10)
+        server.serve_in_thread()
+        try:
+            if use_async:
+                async def move():
+                    connection=await lib.open_async_connection('127.0.0.1', 'test@example.com', 'test',
+                                                               port=server.server_address[1], use_ssl=False)
+                    await connection.select(lib.imap_quote(boxes[0]))
+                    queue=lib.AsyncMoveQueue(connection, '/', 3, folders=lib.FolderRegistry('/'))
+                    self.queue_messages(queue)
+                    moved=await queue.finish()
+                    await connection.logout()
+                    return moved
+                moved=asyncio.run(move())
+            else:
+                connection=imaplib.IMAP4('127.0.0.1', server.server_address[1])
+                connection.login('test@example.com', 'test')
+                connection.select(lib.imap_quote(boxes[0]))
+                queue=lib.MoveQueue(connection, '/', 3, folders=lib.FolderRegistry('/'))
+                self.queue_messages(queue)
+                moved=queue.finish()
+                connection.logout()
+        finally:
+            server.shutdown()
+        return (sorted(moved, key=int),
+                dict((name, len(mailbox.messages)) for name, mailbox in server.store.mailboxes.items()))
+
+    def test_same_messages_moved(self):
+        for capabilities in self.capabilities:
+            with self.subTest(capabilities=capabilities):
+                moved, counts=self.move(capabilities, False)
+                self.assertEqual(moved, [str(uid) for uid in range(1, 10)])
+                self.assertEqual(counts['Archive/misc'], 1)
+                self.assertEqual((counts['Dest/A'], counts['Dest/B']), (7, 2))
+                self.assertEqual(self.move(capabilities, True), (moved, counts))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,184 @@
+""" test_rules
+
+Compares RuleSet.matching, with its literal prefilter and exact-value
+index, against trying the rules one by one with re.match.
+
+    python -m pytest tests
+
+"""
+
+import os
+import re
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import OMK_imap_tools_lib as lib
+
+
+# Regexes as they appear in ArchiveRules, including the ones that are
+# easy to take apart the wrong way: quantifiers with braces, classes
+# that start with "]" and escaped characters.
+REGEXES = [
+    r".*<list3.lists.example.org>",
+    r".*ISOC Newsletter <isoc-newsletter.elists.isoc.org>",
+    r"<spc-123456-0>",
+    r".*spc-\d{6}-0.*",
+    r"<\d{3}\.generated@example\.com>",
+    r".*[^]]abc",
+    r".*[]x]abc.*",
+    r".*x[\]]yz",
+    r"a{2}bc",
+    r".*cullen-international.*",
+    r"olaf@example\.com$",
+    r"^olaf@example\.com\s*$",
+    r".*by wrong.example.com",
+    r".*(foo|bar)baz",
+    r"(?i).*shout.*",
+    r".*Announcement list for all ISOC members.*",
+    r"price\$",
+    r"price\$\s*$",
+    r"\^up.*",
+    r" $",
+    r"trailing $",
+    r" leading$",
+    ]
+
+VALUES = [
+    "List number 3 <list3.lists.example.org>",
+    "ISOC Newsletter <isoc-newsletter.elists.isoc.org>",
+    "<spc-123456-0>",
+    "Asana <spc-123456-0>",
+    "spc-654321-0",
+    "x spc-12345-0",
+    "<123.generated@example.com>",
+    "<12.generated@example.com>",
+    "<1234.generated@example.com>",
+    "zabc",
+    "]abc",
+    "xabc",
+    "x]yz",
+    "aabc",
+    "abc",
+    "aaabc",
+    "The cullen-international team",
+    "olaf@example.com",
+    "olaf@example.com  ",
+    "olaf@example.com and more",
+    "from a by wrong.example.com with smtp",
+    "foobaz",
+    "barbaz",
+    "SHOUT",
+    "Announcement list for all ISOC members <announce>",
+    "price$ now",
+    "price$",
+    "price",
+    "^up and away",
+    "up",
+    "trailing ",
+    " leading",
+    " ",
+    "",
+    ]
+
+
+def make_rules(regexes, header="List-Id:"):
+    # Returns one rule per regex, the first one with the highest priority
+    return [{'name': 'rule%d' % i, 'Priority': len(regexes)-i,
+             'DestinationArchive': 'Archive/rule%d' % i, 'DestinationArchivePolicy': 'Flat',
+             'Regexps': [{'header': header, 'regex': regex}]}
+            for i, regex in enumerate(regexes)]
+
+
+def reference_matching(rules, mc):
+    # Returns the names of the rules that match mc, tried one by one with re.match
+    names=[]
+    for rule in sorted(rules, key=lambda r: r['Priority'], reverse=True):
+        for condition in rule['Regexps']:
+            found=mc.get_all(condition['header'].rstrip(':')) or []
+            if not any(re.match(condition['regex'], v, re.DOTALL) for v in found):
+                break
+        else:
+            names.append(rule['name'])
+    return names
+
+
+class RuleSetMatchingTest(unittest.TestCase):
+
+    def test_single_rule(self):
+        # Every regex on its own, against every value
+        for regex in REGEXES:
+            rules=make_rules([regex])
+            ruleset=lib.RuleSet(rules)
+            for value in VALUES:
+                mc=lib.MessageContainer('1', fields=[('List-Id', value)])
+                with self.subTest(regex=regex, value=value):
+                    self.assertEqual([rule.name for rule in ruleset.matching(mc)],
+                                     reference_matching(rules, mc))
+
+    def test_first_match_wins(self):
+        # All regexes together, the first rule that matches comes first
+        rules=make_rules(REGEXES)
+        ruleset=lib.RuleSet(rules)
+        for value in VALUES:
+            mc=lib.MessageContainer('1', fields=[('List-Id', value)])
+            with self.subTest(value=value):
+                self.assertEqual([rule.name for rule in ruleset.matching(mc)],
+                                 reference_matching(rules, mc))
+
+
+class RequiredLiteralsTest(unittest.TestCase):
+
+    def test_quantifier_with_braces(self):
+        self.assertEqual(lib._required_literals(r".*spc-\d{6}-0.*"), ['spc-', '-0'])
+        self.assertEqual(lib._required_literals(r"<\d{3}\.generated@example\.com>"),
+                         ['<', '.generated@example.com>'])
+        self.assertEqual(lib._required_literals(r"a{2}bc"), ['bc'])
+
+    def test_class_starting_with_bracket(self):
+        self.assertEqual(lib._required_literals(r"[^]]abc"), ['abc'])
+        self.assertEqual(lib._required_literals(r"[]x]abc"), ['abc'])
+        self.assertEqual(lib._required_literals(r"x[\]]yz"), ['x', 'yz'])
+
+    def test_literals_are_in_every_match(self):
+        for regex in REGEXES:
+            for value in VALUES:
+                if re.match(regex, value, re.DOTALL):
+                    for literal in lib._required_literals(regex):
+                        with self.subTest(regex=regex, value=value):
+                            self.assertIn(literal, value)
+
+    def test_alternatives_and_flags(self):
+        self.assertEqual(lib._required_literals(r"a|b"), [])
+        self.assertEqual(lib._required_literals(r"(?i)abc"), [])
+
+
+class ExactKeyTest(unittest.TestCase):
+
+    def test_keys(self):
+        self.assertEqual(lib._exact_key(r".*<list3.lists.example.org>"), "<list3.lists.example.org>")
+        self.assertEqual(lib._exact_key(r".*Name <id>.*"), "<id>")
+        self.assertEqual(lib._exact_key(r"olaf@example\.com$"), "olaf@example.com")
+        self.assertEqual(lib._exact_key(r"^olaf@example\.com\s*$"), "olaf@example.com")
+
+    def test_no_key(self):
+        self.assertIsNone(lib._exact_key(r".*cullen-international.*"))
+        self.assertIsNone(lib._exact_key(r".*spc-\d{6}-0.*"))
+        self.assertIsNone(lib._exact_key(r"a|b"))
+
+    def test_no_key_with_outer_whitespace(self):
+        # Values are looked up stripped
+        self.assertIsNone(lib._exact_key(r" $"))
+        self.assertIsNone(lib._exact_key(r"trailing $"))
+        self.assertIsNone(lib._exact_key(r"^ leading$"))
+        self.assertEqual(lib._exact_key(r"in between$"), "in between")
+
+    def test_escaped_anchors_are_characters(self):
+        self.assertIsNone(lib._exact_key(r"price\$"))
+        self.assertEqual(lib._exact_key(r"price\$\s*$"), "price$")
+        self.assertEqual(lib._exact_key(r"\^up$"), "^up")
+
+
+if __name__ == '__main__':
+    unittest.main()